@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Benchmark the `map_merge` filter on large lists of dictionaries.
+
+Usage:
+
+    $ python benchmarks/map_merge.py [SIZE ...]
+
+The nested-loop implementation the filter used to have is run as a baseline
+(and to check that the results are the same) for sizes up to 2000 items:
+beyond that it takes minutes.
+'''
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+from copy import deepcopy as deep_copy
+
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+FILTER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                           'roles', 'common', 'filter_plugins', 'dict.py')
+
+DEFAULT_SIZES = [1000, 2000, 10000, 50000, 100000]
+
+MAX_BASELINE_SIZE = 2000
+
+# ------------------------------------------------------------------------------
+# BASELINE ---------------------------------------------------------------------
+
+def baseline_map_merge(subject, other, key):
+    '''The previous implementation: nested loops and identity scans.'''
+    matched = []
+    result = []
+    for subject_item in subject:
+        for other_item in other:
+            if (key in subject_item and key in other_item and
+                subject_item[key] == other_item[key]):
+                matched.append(subject_item)
+                matched.append(other_item)
+                result_item = deep_copy(subject_item)
+                result_item.update(other_item)
+                result.append(result_item)
+    for item in subject + other:
+        if len([m for m in matched if item is m]) == 0:
+            result.append(item)
+    return result
+
+# ------------------------------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
+
+def load_source(name, path):
+    try:
+        from importlib.util import spec_from_file_location, module_from_spec
+    except ImportError: # Python 2.
+        import imp
+        return imp.load_source(name, path)
+    spec = spec_from_file_location(name, path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# ------------------------------------------------------------------------------
+# DATA -------------------------------------------------------------------------
+
+def make_data(size):
+    '''Mimic `storage.yml`: facts returned by a module, merged into the
+    `partitions` variable (half of them match).
+    '''
+    partitions = [{'name': 'part-{}'.format(idx),
+                   'type': 'physical',
+                   'mount': {'path': '/data/{}'.format(idx), 'check': 1},
+                   'flags': ['lvm']}
+                  for idx in range(size)]
+    results = [{'name': 'part-{}'.format(idx),
+                'device': '/dev/sda{}'.format(idx),
+                'topology': {'rotational': False, 'discard': True}}
+               for idx in range(0, 2 * size, 2)]
+    return results, partitions
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    plugin = load_source('dict_filters', FILTER_PATH)
+
+    print('{:>8} {:>12} {:>12}'.format('items', 'hash join', 'baseline'))
+    for size in sizes:
+        results, partitions = make_data(size)
+        merge = lambda: plugin.map_merge(results, partitions,
+                                         'match_key', 'name')
+        elapsed = min(timeit.repeat(merge, number=1, repeat=3))
+        baseline = ''
+        if size <= MAX_BASELINE_SIZE:
+            expected = baseline_map_merge(results, partitions, 'name')
+            if merge() != expected:
+                sys.exit('Results differ from the baseline ({} items)'.format(
+                    size))
+            baseline = '{:.4f}s'.format(timeit.timeit(
+                lambda: baseline_map_merge(results, partitions, 'name'),
+                number=1))
+        print('{:>8} {:>11.4f}s {:>12}'.format(size, elapsed, baseline))
+
+# ------------------------------------------------------------------------------
+# ENTRY POINT ------------------------------------------------------------------
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
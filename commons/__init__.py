@@ -1,6 +1,14 @@
 import base_object
+import block_device
+import build_supervisor
 import chroot
+import config_editor
+import mount_info
 
 __all__ = ['COMMONS']
 
-COMMONS = [base_object.BaseObject, chroot.chrooted]
+COMMONS = [base_object.BaseObject, block_device.BlockDevice,
+           build_supervisor.read_pressure, build_supervisor.process_tree,
+           build_supervisor.BuildSupervisor, chroot.chrooted,
+           config_editor.atomic_write, config_editor.ConfigEditor,
+           mount_info.MountInfo]
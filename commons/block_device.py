@@ -0,0 +1,133 @@
+import os
+
+# ------------------------------------------------------------------------------
+# BlockDevice ------------------------------------------------------------------
+
+class BlockDevice(object):
+    '''Topology of a block device, as exposed by sysfs.
+    Partitions don't have a request queue: queue attributes are read from the
+    disk holding them.
+    '''
+    SYSFS_DIR = '/sys/class/block'
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(os.path.realpath(path))
+        self.sysfs_dir = os.path.realpath(os.path.join(self.SYSFS_DIR,
+                                                       self.name))
+
+    @property
+    def exists(self):
+        return os.path.isdir(self.sysfs_dir)
+
+    @property
+    def is_partition(self):
+        return os.path.isfile(os.path.join(self.sysfs_dir, 'partition'))
+
+    @property
+    def disk(self):
+        '''The whole disk (itself, unless it's a partition).'''
+        if self.is_partition:
+            return BlockDevice(os.path.join(
+                '/dev', os.path.basename(os.path.dirname(self.sysfs_dir))))
+        return self
+
+    def read(self, attr, default=None):
+        try:
+            with open(os.path.join(self.sysfs_dir, attr)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return default
+
+    def read_int(self, attr, default=0):
+        try:
+            return int(self.read(attr))
+        except (TypeError, ValueError):
+            return default
+
+    def queue(self, attr, default=0):
+        return self.disk.read_int(os.path.join('queue', attr), default)
+
+    @property
+    def size(self):
+        '''Size in bytes (sysfs always counts 512-byte sectors).'''
+        return self.read_int('size') * 512
+
+    @property
+    def logical_block_size(self):
+        return self.queue('logical_block_size', 512)
+
+    @property
+    def physical_block_size(self):
+        return self.queue('physical_block_size', 512)
+
+    @property
+    def minimum_io_size(self):
+        return self.queue('minimum_io_size', 0)
+
+    @property
+    def optimal_io_size(self):
+        return self.queue('optimal_io_size', 0)
+
+    @property
+    def rotational(self):
+        return self.queue('rotational', 1) == 1
+
+    @property
+    def discard(self):
+        return self.queue('discard_max_bytes', 0) > 0
+
+    @property
+    def is_nvme(self):
+        if self.disk.name.startswith('nvme'):
+            return True
+        # Stacked devices (dm, md) are NVMe-backed if all their slaves are.
+        slaves = self.disk.slaves
+        return len(slaves) > 0 and all(slave.is_nvme for slave in slaves)
+
+    @property
+    def partitions(self):
+        try:
+            names = sorted(os.listdir(self.sysfs_dir))
+        except OSError:
+            names = []
+        return [BlockDevice(os.path.join('/dev', name)) for name in names
+                if os.path.isfile(os.path.join(self.sysfs_dir, name,
+                                               'partition'))]
+
+    @property
+    def slaves(self):
+        return self._related('slaves')
+
+    @property
+    def holders(self):
+        return self._related('holders')
+
+    @property
+    def dm_name(self):
+        return self.read('dm/name')
+
+    @property
+    def dm_uuid(self):
+        return self.read('dm/uuid')
+
+    def _related(self, kind):
+        try:
+            names = sorted(os.listdir(os.path.join(self.sysfs_dir, kind)))
+        except OSError:
+            names = []
+        return [BlockDevice(os.path.join('/dev', name)) for name in names]
+
+    def to_dict(self):
+        return {'name':                self.name,
+                'size':                self.size,
+                'logical_block_size':  self.logical_block_size,
+                'physical_block_size': self.physical_block_size,
+                'minimum_io_size':     self.minimum_io_size,
+                'optimal_io_size':     self.optimal_io_size,
+                'rotational':          self.rotational,
+                'discard':             self.discard,
+                'nvme':                self.is_nvme}
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
@@ -0,0 +1,247 @@
+import os
+import select
+import signal
+import subprocess
+import tempfile
+import time
+
+# ------------------------------------------------------------------------------
+# BuildSupervisor --------------------------------------------------------------
+
+PRESSURE_DIR = '/proc/pressure'
+
+PRESSURE_RESOURCES = ['cpu', 'memory', 'io']
+
+def read_pressure(resource):
+    '''Share of time (%, averaged over 10 seconds) some tasks have been stalled
+    on `resource` (`cpu`, `memory` or `io`), from the pressure stall
+    information of the kernel.
+    '''
+    with open(os.path.join(PRESSURE_DIR, resource)) as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] == 'some':
+                return float(dict(field.split('=')
+                                  for field in fields[1:])['avg10'])
+    return 0.0
+
+def process_tree(root):
+    '''Descendants of the process `root`, as
+    `{pid: (start time, state, children)}`.
+    '''
+    processes = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                stat = f.read()
+        except (IOError, OSError): # Exited meanwhile.
+            continue
+        # The command name (2nd field) can contain spaces and parenthesis.
+        fields = stat[stat.rindex(')') + 2:].split()
+        processes[int(name)] = (int(fields[1]), int(fields[19]), fields[0])
+    children = {}
+    for pid, (ppid, _, _) in processes.items():
+        children.setdefault(ppid, []).append(pid)
+    tree = {}
+    queue = [root]
+    while queue:
+        pid = queue.pop()
+        for child in children.get(pid, []):
+            tree[child] = processes[child][1:] + (children.get(child, []),)
+            queue.append(child)
+    return tree
+
+class BuildSupervisor(object):
+    '''Run a build keeping the pressure of the system within `bounds` (the
+    maximum `some` pressure of each resource, e.g. `{'memory': 10}`), by
+    changing the number of parallel jobs between `min_jobs` and `max_jobs`.
+    With `jobserver`, the supervisor is the `make` jobserver of the build
+    (through `MAKEFLAGS`) and holds back tokens. Otherwise the most recent
+    running leaf processes of the build (e.g. `cc1plus`) are paused
+    (`SIGSTOP`) and resumed (`SIGCONT`) later.
+    Every `interval` seconds, the jobs are lowered by one if a resource is
+    over its bound, and raised by one if all the resources are under
+    `hysteresis` times their bounds.
+    '''
+    POLL_INTERVAL = 1
+
+    def __init__(self, bounds, max_jobs, min_jobs=1, interval=10,
+                 hysteresis=0.5, jobserver=False):
+        self.bounds = self.check_bounds(bounds)
+        self.max_jobs = max(1, max_jobs)
+        self.min_jobs = max(1, min(min_jobs, self.max_jobs))
+        self.interval = interval
+        self.hysteresis = hysteresis
+        self.jobserver = jobserver
+        self.jobs = self.max_jobs
+        self.timeline = []
+        self.decisions = []
+        self._start = None
+        self._token_fds = None
+        self._withheld = 0
+        self._paused = {}
+
+    @staticmethod
+    def check_bounds(bounds):
+        '''Return the pressure `bounds` as numbers.
+        Raise `ValueError` if they aren't valid.
+        '''
+        unknown = sorted(set(bounds) - set(PRESSURE_RESOURCES))
+        if unknown:
+            raise ValueError('Unknown pressure resources: {} (expected: '
+                             '{})'.format(', '.join(unknown),
+                                          ', '.join(PRESSURE_RESOURCES)))
+        try:
+            return dict((resource, float(bound))
+                        for resource, bound in bounds.items())
+        except (TypeError, ValueError):
+            raise ValueError('Pressure bounds must be numbers')
+
+    @staticmethod
+    def supported():
+        return all(os.path.exists(os.path.join(PRESSURE_DIR, resource))
+                   for resource in PRESSURE_RESOURCES)
+
+    def run(self, command, env=None):
+        '''Run the shell `command` under supervision.
+        Return its status code, standard output and standard error.
+        '''
+        env = dict(env or os.environ)
+        if self.jobserver:
+            env['MAKEFLAGS'] = '{} -j{} --jobserver-auth={},{}'.format(
+                env.get('MAKEFLAGS', ''), self.max_jobs,
+                *self._open_jobserver()).strip()
+        out, err = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+        self._start = time.time()
+        try:
+            process = subprocess.Popen(command, shell=True, env=env,
+                                       stdout=out, stderr=err,
+                                       close_fds=not self.jobserver)
+            next_check = self._start + self.interval
+            while process.poll() is None:
+                self._enforce(process.pid)
+                if time.time() >= next_check:
+                    self._check()
+                    next_check += self.interval
+        finally:
+            self._release()
+        out.seek(0)
+        err.seek(0)
+        return (process.returncode, out.read().decode('utf-8', 'replace'),
+                err.read().decode('utf-8', 'replace'))
+
+    def report(self):
+        return {'bounds':    self.bounds,
+                'mode':      'jobserver' if self.jobserver else 'pause',
+                'jobs':      {'min': self.min_jobs, 'max': self.max_jobs,
+                              'final': self.jobs},
+                'timeline':  self.timeline,
+                'decisions': self.decisions}
+
+    def _check(self):
+        '''Sample the pressure and decide the number of jobs.'''
+        now = round(time.time() - self._start, 1)
+        pressure = dict((resource, read_pressure(resource))
+                        for resource in PRESSURE_RESOURCES)
+        self.timeline.append(dict(pressure, time=now, jobs=self.jobs))
+        over = sorted(resource for resource, bound in self.bounds.items()
+                      if pressure[resource] > bound)
+        if over and self.jobs > self.min_jobs:
+            self.jobs -= 1
+            reason = ', '.join('{} {} > {}'.format(
+                resource, pressure[resource], self.bounds[resource])
+                for resource in over)
+        elif not over and self.jobs < self.max_jobs and \
+             all(pressure[resource] < bound * self.hysteresis
+                 for resource, bound in self.bounds.items()):
+            self.jobs += 1
+            reason = 'pressure under {:.0%} of the bounds'.format(
+                self.hysteresis)
+        else:
+            return
+        self.decisions.append({'time': now, 'jobs': self.jobs,
+                               'reason': reason})
+
+    def _open_jobserver(self):
+        read_fd, write_fd = os.pipe()
+        for fd in [read_fd, write_fd]:
+            if hasattr(os, 'set_inheritable'): # Python 3.
+                os.set_inheritable(fd, True)
+        # Non-blocking reads from a separate open file description, so `make`
+        # keeps blocking on the shared one.
+        reader = os.open('/proc/self/fd/{}'.format(read_fd),
+                         os.O_RDONLY | os.O_NONBLOCK)
+        # `make` itself holds an implicit token.
+        os.write(write_fd, b'+' * (self.max_jobs - 1))
+        self._token_fds = (read_fd, write_fd, reader)
+        return read_fd, write_fd
+
+    def _enforce(self, pid):
+        '''Make the build run `self.jobs` jobs, for `POLL_INTERVAL` seconds.'''
+        if self.jobserver:
+            self._withhold_tokens(time.time() + self.POLL_INTERVAL)
+        else:
+            time.sleep(self.POLL_INTERVAL)
+            self._pause_jobs(pid)
+
+    def _withhold_tokens(self, deadline):
+        withhold = self.max_jobs - self.jobs
+        if self._withheld > withhold:
+            os.write(self._token_fds[1], b'+' * (self._withheld - withhold))
+            self._withheld = withhold
+        # Tokens in use are taken back when `make` returns them, competing
+        # with `make` for them: wait for them instead of polling.
+        now = time.time()
+        while now < deadline:
+            if self._withheld < withhold and \
+               select.select([self._token_fds[2]], [], [], deadline - now)[0]:
+                try:
+                    self._withheld += len(os.read(self._token_fds[2],
+                                                  withhold - self._withheld))
+                except OSError: # Taken by `make`.
+                    pass
+            elif self._withheld >= withhold:
+                time.sleep(deadline - now)
+            now = time.time()
+
+    def _pause_jobs(self, pid):
+        tree = process_tree(pid)
+        self._paused = dict((leaf, start)
+                            for leaf, start in self._paused.items()
+                            if tree.get(leaf, (None,))[0] == start)
+        # Idle leaves (e.g. waiting on a pipe) aren't jobs.
+        running = sorted((start, leaf)
+                         for leaf, (start, state, children) in tree.items()
+                         if not children and state in 'RD' and
+                            leaf not in self._paused)
+        if len(running) > self.jobs:
+            for start, leaf in running[self.jobs:]: # The most recent ones.
+                self._signal(leaf, signal.SIGSTOP)
+                self._paused[leaf] = start
+        else:
+            for leaf, start in sorted(self._paused.items(),
+                                      key=lambda item: item[1]
+                                      )[:self.jobs - len(running)]:
+                self._signal(leaf, signal.SIGCONT)
+                del self._paused[leaf]
+
+    def _signal(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError: # Exited meanwhile.
+            pass
+
+    def _release(self):
+        '''Resume the paused processes and close the jobserver.'''
+        for pid in self._paused:
+            self._signal(pid, signal.SIGCONT)
+        self._paused = {}
+        if self._token_fds:
+            for fd in self._token_fds:
+                os.close(fd)
+            self._token_fds = None
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
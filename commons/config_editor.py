@@ -0,0 +1,134 @@
+import os
+import re
+import tempfile
+
+# ------------------------------------------------------------------------------
+# ConfigEditor -----------------------------------------------------------------
+
+def _replace_file(tmp_path, path):
+    '''Move the (already synced) `tmp_path` over `path`, keeping its mode.'''
+    if os.path.exists(path):
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    else:
+        os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+
+def atomic_write(path, content):
+    '''Replace the file at `path` with `content`, without leaving it truncated
+    or half-written if something goes wrong.
+    Nothing is written if the file already has that content.
+    Return `True` if the file has been written.
+    '''
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        _replace_file(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+class ConfigEditor(object):
+    '''Edit a line-based configuration file with many rules at once.
+    Each rule is `(regexp, replacement, append_if_missing, template)`: lines
+    matching `regexp` are replaced by `replacement` (`None` removes them),
+    taken literally unless `template` is set (then it's a `re` template). The
+    first matching rule wins. If no line matches a rule with
+    `append_if_missing`, its replacement is appended to the file.
+    The file is read and rewritten in a single streaming pass and replaced
+    atomically, only if its content changes (a missing file is created only
+    if there's something to write).
+    '''
+    def __init__(self, path, rules=None):
+        self.path = path
+        self.rules = []
+        for rule in rules or []:
+            self.rule(*rule)
+
+    def rule(self, regexp, replacement, append_if_missing=False,
+             template=False):
+        self.rules.append((re.compile(regexp), replacement, append_if_missing,
+                           template))
+        return self
+
+    @staticmethod
+    def terminated(line):
+        '''`line` ending with a newline (e.g. the last line of a file).'''
+        if line is None or line.endswith('\n'):
+            return line
+        return line + '\n'
+
+    def edit(self, lines):
+        '''Yield `(old line, new line)` pairs (`None` for missing lines).
+        New lines always end with a newline.
+        '''
+        matched = [False] * len(self.rules)
+        for line in lines:
+            new_line = self.terminated(line)
+            for idx, (regexp, replacement, _, template) in \
+                    enumerate(self.rules):
+                md = regexp.match(line.rstrip('\n'))
+                if md:
+                    matched[idx] = True
+                    if replacement is None:
+                        new_line = None
+                    elif template:
+                        new_line = md.expand(replacement) + '\n'
+                    else:
+                        new_line = replacement + '\n'
+                    break
+            yield line, new_line
+        for idx, (_, replacement, append_if_missing, _) in \
+                enumerate(self.rules):
+            if append_if_missing and not matched[idx] and replacement:
+                yield None, replacement + '\n'
+
+    def apply(self):
+        '''Apply the rules. Return `True` if the file has been changed.'''
+        try:
+            src = open(self.path)
+        except (IOError, OSError):
+            src = None
+        changed = False
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            prefix='.{}.'.format(os.path.basename(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as dst:
+                for old_line, new_line in self.edit(src or []):
+                    # A missing final newline alone isn't a change.
+                    if new_line != self.terminated(old_line):
+                        changed = True
+                    if new_line is not None:
+                        dst.write(new_line)
+                if changed:
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            if changed:
+                _replace_file(tmp_path, self.path)
+            else:
+                os.remove(tmp_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            if src is not None:
+                src.close()
+        return changed
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
@@ -0,0 +1,57 @@
+import re
+
+# ------------------------------------------------------------------------------
+# MountInfo --------------------------------------------------------------------
+
+class MountInfo(object):
+    '''Mount table of the current process, read from `/proc/self/mountinfo`
+    (see `proc(5)`).
+    Each mount is a dict holding its `id` and the `parent` mount id, so the
+    real mount tree (including stacked, bind and shared mounts) can be built.
+    '''
+    PATH = '/proc/self/mountinfo'
+
+    def __init__(self, path=None):
+        with open(path or self.PATH) as f:
+            self.mounts = [self.parse_line(line) for line in f if line.strip()]
+        self.by_id = dict((mount['id'], mount) for mount in self.mounts)
+
+    @staticmethod
+    def unescape(value):
+        '''Decode octal escapes (e.g. `\\040` for spaces).'''
+        return re.sub(r'\\([0-7]{3})',
+                      lambda md: chr(int(md.group(1), 8)), value)
+
+    @classmethod
+    def parse_line(cls, line):
+        fields = line.split()
+        # Optional fields (propagation) are terminated by a single hyphen.
+        sep = fields.index('-', 6)
+        return {'id':          int(fields[0]),
+                'parent':      int(fields[1]),
+                'device':      fields[2],
+                'root':        cls.unescape(fields[3]),
+                'path':        cls.unescape(fields[4]),
+                'opts':        fields[5],
+                'propagation': fields[6:sep],
+                'fs':          fields[sep + 1],
+                'source':      cls.unescape(fields[sep + 2]),
+                'super_opts':  fields[sep + 3] if len(fields) > sep + 3 else ''}
+
+    def under(self, root):
+        '''Mounts at or below the path `root`.'''
+        root = root.rstrip('/') or '/'
+        prefix = root if root == '/' else root + '/'
+        return [mount for mount in self.mounts
+                if mount['path'] == root or mount['path'].startswith(prefix)]
+
+    def find(self, path):
+        '''The mount visible at `path` (i.e. the last one mounted there).'''
+        found = None
+        for mount in self.mounts:
+            if mount['path'] == path:
+                found = mount
+        return found
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
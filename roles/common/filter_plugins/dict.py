@@ -3,29 +3,76 @@
 # ------------------------------------------------------------------------------
 # IMPORTS ----------------------------------------------------------------------
 
-from copy import deepcopy as deep_copy
 from ansible.errors import AnsibleFilterError
 
 # ------------------------------------------------------------------------------
 # MATCHERS ---------------------------------------------------------------------
 
-def match_key(subject_item, other_item, *key):
-    if len(key) == 1:
-        subject_key = other_key = key[0]
-    elif len(key) == 2:
-        subject_key, other_key = key
-    else:
-        raise AnsibleFilterError('Too many keys to be matched ({} > 2)'.format(
-            key))
-
-    return (subject_key in subject_item
-        and other_key in other_item
-        and subject_item[subject_key] == other_item[other_key])
+class KeyMatcher(object):
+    '''Match items having equal values for a key.
+    A key can be a path into nested dictionaries (e.g. `mount.path`) or a list
+    of keys (composite key). When two keys are given, the first is looked up
+    in subject items and the second one in other items.
+    Items are matched by hashing their key values, so each side is scanned
+    only once.
+    '''
+    MISSING = object()
+
+    def __init__(self, *key):
+        if len(key) == 1:
+            subject_key = other_key = key[0]
+        elif len(key) == 2:
+            subject_key, other_key = key
+        else:
+            raise AnsibleFilterError('Too many keys to be matched ({} > 2)'.format(
+                key))
+        self._subject_key = self._parse(subject_key)
+        self._other_key = self._parse(other_key)
+
+    def subject_key(self, item):
+        return self._lookup(item, self._subject_key)
+
+    def other_key(self, item):
+        return self._lookup(item, self._other_key)
+
+    @staticmethod
+    def _parse(key):
+        return list(key) if isinstance(key, (list, tuple)) else [key]
+
+    def _lookup(self, item, keys):
+        values = []
+        for key in keys:
+            value = item
+            # Literal keys win over nested paths.
+            if isinstance(item, dict) and key in item:
+                path = [key]
+            else:
+                path = key.split('.')
+            for component in path:
+                if not isinstance(value, dict) or not component in value:
+                    return self.MISSING
+                value = value[component]
+            values.append(freeze(value))
+        return tuple(values)
 
 MATCHERS = {
-    'match_key': match_key,
+    'match_key': KeyMatcher,
 }
 
+# ------------------------------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
+
+def freeze(value):
+    '''Get a hashable equivalent of `value`.'''
+    if isinstance(value, dict):
+        return frozenset((key, freeze(val)) for key, val in value.items())
+    elif isinstance(value, (list, tuple)):
+        return tuple(freeze(val) for val in value)
+    elif isinstance(value, set):
+        return frozenset(freeze(val) for val in value)
+    else:
+        return value
+
 # ------------------------------------------------------------------------------
 # FILTERS ----------------------------------------------------------------------
 
@@ -39,35 +86,51 @@ def map_merge(subject, other, match_fn, *args):
     Dictionaries are merged if the `match_fn` applied to the single elements,
     returns true.
     Additional arguments are passed to the match function.
-    '''
 
+    The other list is indexed by key once (hash join): each subject item
+    is merged with every other item having the same key, in order. Items that
+    never matched are then appended, unmodified.
+    '''
     try:
-        match_fn = MATCHERS[match_fn]
+        matcher = MATCHERS[match_fn](*args)
     except KeyError:
         raise AnsibleFilterError('Unknown match function')
 
     subject = list(subject)
     other   = list(other)
-    matched = []
+    matched = set() # Identities of matched items.
     result  = []
 
+    index = {}
+    for other_item in other:
+        key = matcher.other_key(other_item)
+        if key is not KeyMatcher.MISSING:
+            try:
+                index.setdefault(key, []).append(other_item)
+            except TypeError:
+                raise AnsibleFilterError('Unhashable key: {}'.format(key))
+
     for subject_item in subject:
-        for other_item in other:
-            if match_fn(subject_item, other_item, *args):
-                # Keep track of matched items.
-                matched.append(subject_item)
-                matched.append(other_item)
-                # Compute the resulting item
-                # (merging subject item with other item).
-                result_item = deep_copy(subject_item)
-                result_item.update(other_item)
-                result.append(result_item)
+        key = matcher.subject_key(subject_item)
+        if key is KeyMatcher.MISSING:
+            continue
+        try:
+            other_items = index.get(key, [])
+        except TypeError:
+            raise AnsibleFilterError('Unhashable key: {}'.format(key))
+        for other_item in other_items:
+            # Keep track of matched items.
+            matched.add(id(subject_item))
+            matched.add(id(other_item))
+            # Compute the resulting item (merging subject item with other
+            # item): only the top-level dictionary is changed, so a shallow
+            # copy is enough.
+            result_item = dict(subject_item)
+            result_item.update(other_item)
+            result.append(result_item)
 
     # Add items that never matched, without modifying them.
-    for item in subject + other:
-        if len([m for m in matched if item is m]) == 0:
-            # This item never matched.
-            result.append(item)
+    result += [item for item in subject + other if not id(item) in matched]
 
     return result
 
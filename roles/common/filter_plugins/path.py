@@ -3,6 +3,7 @@
 # ------------------------------------------------------------------------------
 # PLUGIN -----------------------------------------------------------------------
 
+from ansible.errors import AnsibleFilterError
 from sys import maxsize as max_size
 
 # FILTERS ----------------------------------------------------------------------
@@ -19,6 +20,101 @@ def sorted_by_path(subject, attribute=None):
         return len([component for component in path.split('/') if component])
     return sorted(subject, key=sort_fn)
 
+def mount_levels(subject, attribute='path', source=None, opts=None):
+    '''Group the mount entries of `subject` into dependency waves: the entries
+    in a wave only depend on entries in the previous waves, so they can be
+    mounted concurrently.
+    An entry depends on:
+    - The entries mounted at the nearest ancestor path (using the real tree of
+      the mount paths, not just the number of path components).
+    - The entries mounted before it at the same path (stacked mounts).
+    - For bind mounts (`bind` or `rbind` in the options at `opts`), the
+      entries holding the path at `source`.
+    Entries without a path (or not mounted on a path, like swaps) are put in a
+    final wave.
+    '''
+    def lookup(elem, attr):
+        if attr is None:
+            return None
+        value = elem
+        for key in attr.split('.'):
+            if not isinstance(value, dict) or not key in value:
+                return None
+            value = value[key]
+        return value
+
+    def components(path):
+        return [component for component in path.split('/') if component]
+
+    # Build the prefix tree of the mount paths: each node holds the indexes of
+    # the entries mounted there.
+    tree = {'entries': [], 'children': {}}
+    nodes = {}
+    unplaced = []
+    for idx, elem in enumerate(subject):
+        path = lookup(elem, attribute)
+        if not path or not path.startswith('/'):
+            unplaced.append(elem)
+            continue
+        node = tree
+        ancestors = []
+        for component in components(path):
+            ancestors.append(node)
+            node = node['children'].setdefault(component,
+                                               {'entries': [], 'children': {}})
+        nodes[idx] = (node, ancestors, list(node['entries']))
+        node['entries'].append(idx)
+
+    def holder(path):
+        '''The entries of the deepest mount path containing `path`.'''
+        found = tree['entries']
+        node = tree
+        for component in components(path):
+            node = node['children'].get(component)
+            if node is None:
+                break
+            if node['entries']:
+                found = node['entries']
+        return found
+
+    def dependencies(idx):
+        node, ancestors, stacked = nodes[idx]
+        deps = list(stacked)
+        for ancestor in reversed(ancestors):
+            if ancestor['entries']:
+                deps.extend(ancestor['entries'])
+                break
+        elem_opts = lookup(subject[idx], opts) or []
+        if not isinstance(elem_opts, list):
+            elem_opts = elem_opts.split(',')
+        if 'bind' in elem_opts or 'rbind' in elem_opts:
+            deps.extend(dep for dep in holder(lookup(subject[idx], source) or '')
+                        if dep != idx)
+        return deps
+
+    levels = {}
+    def level(idx, visiting):
+        if not idx in levels:
+            if idx in visiting:
+                raise AnsibleFilterError(
+                    'Circular mount dependency: `{}`'.format(
+                        lookup(subject[idx], attribute)))
+            visiting.add(idx)
+            levels[idx] = 1 + max([level(dep, visiting)
+                                   for dep in dependencies(idx)] or [-1])
+            visiting.remove(idx)
+        return levels[idx]
+
+    waves = []
+    for idx in sorted(nodes):
+        lvl = level(idx, set())
+        while len(waves) <= lvl:
+            waves.append([])
+        waves[lvl].append(subject[idx])
+    if unplaced:
+        waves.append(unplaced)
+    return waves
+
 # ------------------------------------------------------------------------------
 # PLUGIN -----------------------------------------------------------------------
 
@@ -26,4 +122,5 @@ class FilterModule(object):
     '''Ansible jinja2 filters for working with paths.'''
 
     def filters(self):
-        return {'sorted_by_path': sorted_by_path}
+        return {'sorted_by_path': sorted_by_path,
+                'mount_levels':   mount_levels}
@@ -0,0 +1,429 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import multiprocessing, os, select, signal, subprocess, tempfile, time
+
+# ------------------------------------------------------------------------------
+# MODULE INFORMATIONS ----------------------------------------------------------
+
+DOCUMENTATION = '''
+---
+module: build_supervisor
+short_description: Run a build keeping the system pressure within bounds
+description:
+    - The command (e.g. `emerge`) is run while the pressure stall information
+      of the system (`/proc/pressure`) is checked. When a resource is over
+      its bound, the most recent running jobs of the build are paused, and
+      resumed when the pressure is back low.
+    - With `jobserver` (for `make` commands), the jobs are limited through
+      the `make` jobserver instead.
+    - The pressure over time and the decisions are reported.
+    - Without pressure stall information (Linux < 4.20 or `psi=0`), the
+      command is run unsupervised.
+author:
+    - "Alessandro Molari"
+'''
+
+EXAMPLES = '''
+- name: Update packages
+  build_supervisor:
+    command: emerge --update --deep @world
+    pressure:
+      memory: 10
+      io:     60
+    chroot: /mnt/gentoo
+'''
+
+# ------------------------------------------------------------------------------
+# COMMONS (copy&paste) ---------------------------------------------------------
+
+class BaseObject(object):
+    import syslog, os
+
+    '''Base class for all classes that use AnsibleModule.
+    Dependencies:
+    - `chrooted` function.
+    '''
+    def __init__(self, module, params=None):
+        syslog.openlog('ansible-{module}-{name}'.format(
+            module=os.path.basename(__file__), name=self.__class__.__name__))
+        self.work_dir = None
+        self.chroot = None
+        self._module = module
+        self._command_prefix = None
+        if params:
+            self._parse_params(params)
+
+    @property
+    def command_prefix(self):
+        return self._command_prefix
+
+    @command_prefix.setter
+    def command_prefix(self, value):
+        self._command_prefix = value
+
+    def run_command(self, command=None, **kwargs):
+        if not 'check_rc' in kwargs:
+            kwargs['check_rc'] = True
+        if command is None and self.command_prefix is None:
+            self.fail('Invalid command')
+        if self.command_prefix:
+            command = '{prefix} {command}'.format(
+                prefix=self.command_prefix, command=command or '')
+        if self.work_dir and not self.chroot:
+            command = 'cd {work_dir}; {command}'.format(
+                work_dir=self.work_dir, command=command)
+        if self.chroot:
+            command = chrooted(command, self.chroot, work_dir=self.work_dir)
+        self.log('Performing command `{}`'.format(command))
+        rc, out, err = self._module.run_command(command, **kwargs)
+        if rc != 0:
+            self.log('Command `{}` returned invalid status code: `{}`'.format(
+                command, rc), level=syslog.LOG_WARNING)
+        return {'rc': rc,
+                'out': out,
+                'out_lines': [line for line in out.split('\n') if line],
+                'err': err,
+                'err_lines': [line for line in out.split('\n') if line]}
+
+    def log(self, msg, level=syslog.LOG_DEBUG):
+        '''Log to the system logging facility of the target system.'''
+        if os.name == 'posix': # syslog is unsupported on Windows.
+            syslog.syslog(level, str(msg))
+
+    def fail(self, msg):
+        self._module.fail_json(msg=msg)
+
+    def exit(self, changed=True, msg='', result=None):
+        self._module.exit_json(changed=changed, msg=msg, result=result)
+
+    def _parse_params(self, params):
+        for param in params:
+            if param in self._module.params:
+                value = self._module.params[param]
+                t = self._module.argument_spec[param].get('type')
+                if t == 'str' and value in ['None', 'none']:
+                    value = None
+                setattr(self, param, value)
+            else:
+                setattr(self, param, None)
+
+def chrooted(command, path, profile='/etc/profile', work_dir=None):
+    prefix = "chroot {path} bash -c 'source {profile}; ".format(
+        path=path, profile=profile)
+    if work_dir:
+        prefix += 'cd {work_dir}; '.format(work_dir=work_dir)
+    prefix += command
+    prefix += "'"
+    return prefix
+
+PRESSURE_DIR = '/proc/pressure'
+
+PRESSURE_RESOURCES = ['cpu', 'memory', 'io']
+
+def read_pressure(resource):
+    '''Share of time (%, averaged over 10 seconds) some tasks have been stalled
+    on `resource` (`cpu`, `memory` or `io`), from the pressure stall
+    information of the kernel.
+    '''
+    with open(os.path.join(PRESSURE_DIR, resource)) as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] == 'some':
+                return float(dict(field.split('=')
+                                  for field in fields[1:])['avg10'])
+    return 0.0
+
+def process_tree(root):
+    '''Descendants of the process `root`, as
+    `{pid: (start time, state, children)}`.
+    '''
+    processes = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                stat = f.read()
+        except (IOError, OSError): # Exited meanwhile.
+            continue
+        # The command name (2nd field) can contain spaces and parenthesis.
+        fields = stat[stat.rindex(')') + 2:].split()
+        processes[int(name)] = (int(fields[1]), int(fields[19]), fields[0])
+    children = {}
+    for pid, (ppid, _, _) in processes.items():
+        children.setdefault(ppid, []).append(pid)
+    tree = {}
+    queue = [root]
+    while queue:
+        pid = queue.pop()
+        for child in children.get(pid, []):
+            tree[child] = processes[child][1:] + (children.get(child, []),)
+            queue.append(child)
+    return tree
+
+class BuildSupervisor(object):
+    '''Run a build keeping the pressure of the system within `bounds` (the
+    maximum `some` pressure of each resource, e.g. `{'memory': 10}`), by
+    changing the number of parallel jobs between `min_jobs` and `max_jobs`.
+    With `jobserver`, the supervisor is the `make` jobserver of the build
+    (through `MAKEFLAGS`) and holds back tokens. Otherwise the most recent
+    running leaf processes of the build (e.g. `cc1plus`) are paused
+    (`SIGSTOP`) and resumed (`SIGCONT`) later.
+    Every `interval` seconds, the jobs are lowered by one if a resource is
+    over its bound, and raised by one if all the resources are under
+    `hysteresis` times their bounds.
+    '''
+    POLL_INTERVAL = 1
+
+    def __init__(self, bounds, max_jobs, min_jobs=1, interval=10,
+                 hysteresis=0.5, jobserver=False):
+        self.bounds = self.check_bounds(bounds)
+        self.max_jobs = max(1, max_jobs)
+        self.min_jobs = max(1, min(min_jobs, self.max_jobs))
+        self.interval = interval
+        self.hysteresis = hysteresis
+        self.jobserver = jobserver
+        self.jobs = self.max_jobs
+        self.timeline = []
+        self.decisions = []
+        self._start = None
+        self._token_fds = None
+        self._withheld = 0
+        self._paused = {}
+
+    @staticmethod
+    def check_bounds(bounds):
+        '''Return the pressure `bounds` as numbers.
+        Raise `ValueError` if they aren't valid.
+        '''
+        unknown = sorted(set(bounds) - set(PRESSURE_RESOURCES))
+        if unknown:
+            raise ValueError('Unknown pressure resources: {} (expected: '
+                             '{})'.format(', '.join(unknown),
+                                          ', '.join(PRESSURE_RESOURCES)))
+        try:
+            return dict((resource, float(bound))
+                        for resource, bound in bounds.items())
+        except (TypeError, ValueError):
+            raise ValueError('Pressure bounds must be numbers')
+
+    @staticmethod
+    def supported():
+        return all(os.path.exists(os.path.join(PRESSURE_DIR, resource))
+                   for resource in PRESSURE_RESOURCES)
+
+    def run(self, command, env=None):
+        '''Run the shell `command` under supervision.
+        Return its status code, standard output and standard error.
+        '''
+        env = dict(env or os.environ)
+        if self.jobserver:
+            env['MAKEFLAGS'] = '{} -j{} --jobserver-auth={},{}'.format(
+                env.get('MAKEFLAGS', ''), self.max_jobs,
+                *self._open_jobserver()).strip()
+        out, err = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+        self._start = time.time()
+        try:
+            process = subprocess.Popen(command, shell=True, env=env,
+                                       stdout=out, stderr=err,
+                                       close_fds=not self.jobserver)
+            next_check = self._start + self.interval
+            while process.poll() is None:
+                self._enforce(process.pid)
+                if time.time() >= next_check:
+                    self._check()
+                    next_check += self.interval
+        finally:
+            self._release()
+        out.seek(0)
+        err.seek(0)
+        return (process.returncode, out.read().decode('utf-8', 'replace'),
+                err.read().decode('utf-8', 'replace'))
+
+    def report(self):
+        return {'bounds':    self.bounds,
+                'mode':      'jobserver' if self.jobserver else 'pause',
+                'jobs':      {'min': self.min_jobs, 'max': self.max_jobs,
+                              'final': self.jobs},
+                'timeline':  self.timeline,
+                'decisions': self.decisions}
+
+    def _check(self):
+        '''Sample the pressure and decide the number of jobs.'''
+        now = round(time.time() - self._start, 1)
+        pressure = dict((resource, read_pressure(resource))
+                        for resource in PRESSURE_RESOURCES)
+        self.timeline.append(dict(pressure, time=now, jobs=self.jobs))
+        over = sorted(resource for resource, bound in self.bounds.items()
+                      if pressure[resource] > bound)
+        if over and self.jobs > self.min_jobs:
+            self.jobs -= 1
+            reason = ', '.join('{} {} > {}'.format(
+                resource, pressure[resource], self.bounds[resource])
+                for resource in over)
+        elif not over and self.jobs < self.max_jobs and \
+             all(pressure[resource] < bound * self.hysteresis
+                 for resource, bound in self.bounds.items()):
+            self.jobs += 1
+            reason = 'pressure under {:.0%} of the bounds'.format(
+                self.hysteresis)
+        else:
+            return
+        self.decisions.append({'time': now, 'jobs': self.jobs,
+                               'reason': reason})
+
+    def _open_jobserver(self):
+        read_fd, write_fd = os.pipe()
+        for fd in [read_fd, write_fd]:
+            if hasattr(os, 'set_inheritable'): # Python 3.
+                os.set_inheritable(fd, True)
+        # Non-blocking reads from a separate open file description, so `make`
+        # keeps blocking on the shared one.
+        reader = os.open('/proc/self/fd/{}'.format(read_fd),
+                         os.O_RDONLY | os.O_NONBLOCK)
+        # `make` itself holds an implicit token.
+        os.write(write_fd, b'+' * (self.max_jobs - 1))
+        self._token_fds = (read_fd, write_fd, reader)
+        return read_fd, write_fd
+
+    def _enforce(self, pid):
+        '''Make the build run `self.jobs` jobs, for `POLL_INTERVAL` seconds.'''
+        if self.jobserver:
+            self._withhold_tokens(time.time() + self.POLL_INTERVAL)
+        else:
+            time.sleep(self.POLL_INTERVAL)
+            self._pause_jobs(pid)
+
+    def _withhold_tokens(self, deadline):
+        withhold = self.max_jobs - self.jobs
+        if self._withheld > withhold:
+            os.write(self._token_fds[1], b'+' * (self._withheld - withhold))
+            self._withheld = withhold
+        # Tokens in use are taken back when `make` returns them, competing
+        # with `make` for them: wait for them instead of polling.
+        now = time.time()
+        while now < deadline:
+            if self._withheld < withhold and \
+               select.select([self._token_fds[2]], [], [], deadline - now)[0]:
+                try:
+                    self._withheld += len(os.read(self._token_fds[2],
+                                                  withhold - self._withheld))
+                except OSError: # Taken by `make`.
+                    pass
+            elif self._withheld >= withhold:
+                time.sleep(deadline - now)
+            now = time.time()
+
+    def _pause_jobs(self, pid):
+        tree = process_tree(pid)
+        self._paused = dict((leaf, start)
+                            for leaf, start in self._paused.items()
+                            if tree.get(leaf, (None,))[0] == start)
+        # Idle leaves (e.g. waiting on a pipe) aren't jobs.
+        running = sorted((start, leaf)
+                         for leaf, (start, state, children) in tree.items()
+                         if not children and state in 'RD' and
+                            leaf not in self._paused)
+        if len(running) > self.jobs:
+            for start, leaf in running[self.jobs:]: # The most recent ones.
+                self._signal(leaf, signal.SIGSTOP)
+                self._paused[leaf] = start
+        else:
+            for leaf, start in sorted(self._paused.items(),
+                                      key=lambda item: item[1]
+                                      )[:self.jobs - len(running)]:
+                self._signal(leaf, signal.SIGCONT)
+                del self._paused[leaf]
+
+    def _signal(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError: # Exited meanwhile.
+            pass
+
+    def _release(self):
+        '''Resume the paused processes and close the jobserver.'''
+        for pid in self._paused:
+            self._signal(pid, signal.SIGCONT)
+        self._paused = {}
+        if self._token_fds:
+            for fd in self._token_fds:
+                os.close(fd)
+            self._token_fds = None
+
+# ------------------------------------------------------------------------------
+# LOGIC ------------------------------------------------------------------------
+
+class SupervisedCommand(BaseObject):
+    '''Run `command` under a `BuildSupervisor`.'''
+    def __init__(self, module):
+        super(SupervisedCommand, self).__init__(module,
+            params=['command', 'pressure', 'max_jobs', 'min_jobs', 'interval',
+                    'jobserver', 'work_dir', 'chroot'])
+        try:
+            self.pressure = BuildSupervisor.check_bounds(self.pressure or {})
+        except ValueError as err:
+            self.fail(str(err))
+
+    def run(self):
+        if not BuildSupervisor.supported():
+            result = self.run_command(self.command)
+            return result['out'], result['err'], {'supported': False}
+
+        supervisor = BuildSupervisor(
+            self.pressure, self.max_jobs or multiprocessing.cpu_count(),
+            min_jobs=self.min_jobs, interval=self.interval,
+            jobserver=self.jobserver)
+        command = self.command
+        if self.work_dir and not self.chroot:
+            command = 'cd {work_dir}; {command}'.format(
+                work_dir=self.work_dir, command=command)
+        if self.chroot:
+            command = chrooted(command, self.chroot, work_dir=self.work_dir)
+        self.log('Performing supervised command `{}`'.format(command))
+        rc, out, err = supervisor.run(command)
+        report = dict(supervisor.report(), supported=True)
+        if rc != 0:
+            self._module.fail_json(msg='Command `{}` failed'.format(command),
+                                   rc=rc, stdout=out, stderr=err,
+                                   result=report)
+        return out, err, report
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    module = AnsibleModule(argument_spec={
+        'command':   {'type': 'str', 'required': True},
+        # Maximum `some` pressure (%) by resource (`cpu`, `memory`, `io`).
+        'pressure':  {'type': 'dict', 'required': False,
+                      'default': {'memory': 10, 'io': 60}},
+        # Jobs when there's no pressure (default: CPUs).
+        'max_jobs':  {'type': 'int', 'required': False, 'default': None},
+        'min_jobs':  {'type': 'int', 'required': False, 'default': 1},
+        # Seconds between the pressure checks.
+        'interval':  {'type': 'int', 'required': False, 'default': 10},
+        'jobserver': {'type': 'bool', 'required': False, 'default': False},
+        'work_dir':  {'type': 'str', 'required': False, 'default': None},
+        'chroot':    {'type': 'str', 'required': False, 'default': None},
+    })
+
+    supervised_command = SupervisedCommand(module)
+    out, err, result = supervised_command.run()
+    module.exit_json(changed=True, msg='Command successfully executed',
+                     stdout=out, stderr=err, result=result)
+
+# ------------------------------------------------------------------------------
+# ENTRY POINT ------------------------------------------------------------------
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
@@ -1,3 +1,4 @@
 class TestModule(object):
     def tests(self):
-        return {'equalto': lambda a, b: a == b}
+        return {'equalto': lambda a, b: a == b,
+                'in':      lambda a, b: a in b}
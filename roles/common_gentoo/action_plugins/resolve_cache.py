@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+'''Resolution of module parameters on the controller, shared by the
+`select_mirror` and `select_stage` action plugins.
+'''
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import fcntl, hashlib, json, os, sys, tempfile, time
+
+PY3K = sys.version_info >= (3, 0)
+
+if PY3K:
+    import importlib.util
+else:
+    import imp
+
+try:
+    from ansible.module_utils.parsing.convert_bool import boolean
+except ImportError:
+    from ansible.utils.boolean import boolean
+
+# ------------------------------------------------------------------------------
+# RESOLVE CACHE ----------------------------------------------------------------
+
+# Seconds a resolution is reused for (by all the hosts and plays).
+CACHE_TTL = 3600
+
+CACHE_DIR = os.path.expanduser('~/.ansible/resolve_cache')
+
+class ResolveError(Exception):
+    pass
+
+def raise_error(msg):
+    '''Fail handler for the library `resolve` functions.'''
+    raise ResolveError(msg)
+
+def load_library(name):
+    '''Load the module `name` from the `library` directory of this role.'''
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'library', '{}.py'.format(name))
+    mod_name = '_library_{}'.format(name)
+    if PY3K:
+        spec = importlib.util.spec_from_file_location(mod_name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return imp.load_source(mod_name, path)
+
+def module_params(argument_spec, args):
+    '''Validate `args` as `AnsibleModule` would do, filling the defaults.'''
+    unknown = set(args) - set(argument_spec)
+    if unknown:
+        raise_error('Unsupported parameters: {}'.format(
+            ', '.join(sorted(unknown))))
+    params = {}
+    for name, spec in argument_spec.items():
+        value = args.get(name, spec.get('default'))
+        if value is None:
+            if spec.get('required'):
+                raise_error('Missing required argument: {}'.format(name))
+        elif spec.get('type') == 'bool':
+            value = boolean(value)
+        elif spec.get('type') == 'str' and value in ['None', 'none']:
+            value = None
+        if 'choices' in spec and value is not None and \
+           value not in spec['choices']:
+            raise_error('Value of {} must be one of: {}'.format(
+                name, ', '.join(spec['choices'])))
+        params[name] = value
+    return params
+
+class ResolveCache(object):
+    '''Memoize resolutions on the controller.
+    Tasks of different hosts run in different (forked) workers, so the cache
+    lives in files: the first worker asking for a set of parameters resolves
+    it while holding a lock, the others wait for it and reuse its result.
+    '''
+    def __init__(self, name, ttl=CACHE_TTL, cache_dir=CACHE_DIR):
+        self.name = name
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+
+    def path(self, params):
+        key = json.dumps([self.name, params], sort_keys=True)
+        return os.path.join(self.cache_dir, '{}-{}.json'.format(
+            self.name, hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+    def read(self, path):
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if time.time() - entry['time'] > self.ttl:
+            return None
+        return entry['value']
+
+    def write(self, path, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                        prefix='.{}.'.format(
+                                            os.path.basename(path)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'time': time.time(), 'value': value}, f)
+        os.rename(tmp_path, path)
+
+    def get(self, params, resolve_fn):
+        '''Return `(value, seconds)`: `seconds` is the time spent resolving,
+        `None` if the value comes from the cache.
+        Failures aren't cached.
+        '''
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir, 0o700)
+            except OSError:
+                pass # Created by another worker.
+        path = self.path(params)
+        with open('{}.lock'.format(path), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            value = self.read(path)
+            if value is not None:
+                return value, None
+            start = time.time()
+            value = resolve_fn(params, raise_error)
+            seconds = round(time.time() - start, 3)
+            self.write(path, value)
+            return value, seconds
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import os, sys
+
+from ansible.plugins.action import ActionBase
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+# Ansible doesn't load action plugins as a package: make the helpers next to
+# them importable.
+PLUGINS_DIR = os.path.dirname(os.path.abspath(__file__))
+if PLUGINS_DIR not in sys.path:
+    sys.path.insert(0, PLUGINS_DIR)
+
+from resolve_cache import CACHE_DIR, CACHE_TTL, ResolveCache, ResolveError, \
+                          load_library, module_params, raise_error
+
+# ------------------------------------------------------------------------------
+# PLUGIN -----------------------------------------------------------------------
+
+# Parameters the mirrors list (and the GeoIP database) depend on.
+LOAD_PARAMS = ['mirrors', 'geoip_db', 'geoip_csv']
+
+class ActionModule(ActionBase):
+    '''Select the Gentoo mirror on the controller.
+    The parameters are the ones of the `select_mirror` module, plus
+    `cache_ttl` (seconds the mirrors list is reused for). The GeoIP paths
+    refer to the controller. The selected mirror (`mirror_url`) and the
+    ranking (`mirror_urls`) are set as facts.
+    The mirrors list is downloaded (and the GeoIP database built) once for
+    all the hosts; only the selection is done per host.
+    Unless `ip` is provided, the host is geo-located by the address of its
+    default route (`ansible_default_ipv4`) when it's public. Behind NAT it's
+    private: provide the public one.
+    '''
+    TRANSFERS_FILES = False
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+
+        args = dict(self._task.args)
+        ttl = int(args.pop('cache_ttl', CACHE_TTL))
+        cache = ResolveCache('select_mirror', ttl=ttl)
+        if 'geoip_db' not in args:
+            args['geoip_db'] = os.path.join(CACHE_DIR, 'ip-country.db')
+        try:
+            library = load_library('select_mirror')
+            params = module_params(library.ARGUMENT_SPEC, args)
+            warnings = self.default_ip(library, params, task_vars or {})
+            loaded, seconds = cache.get(
+                dict((name, params[name]) for name in LOAD_PARAMS),
+                self.load_mirrors(library))
+            value = library.resolve(params, raise_error, (
+                False, library.MirrorInfo(loaded)))
+        except ResolveError as err:
+            result.update(failed=True, msg=str(err))
+            return result
+        except Exception as err: # E.g. the list can't be downloaded.
+            result.update(failed=True,
+                          msg='Cannot select the mirror: {}'.format(err))
+            return result
+
+        if seconds is not None: # Only the loading worker reports it.
+            display.display('select_mirror: mirrors loaded in {}s'.format(
+                seconds))
+        facts = {'mirror_url':  value['result'],
+                 'mirror_urls': value['mirrors']}
+        warnings.extend(value.get('warnings', []))
+        if warnings:
+            result['warnings'] = warnings
+        result.update(changed=False, msg='A Gentoo mirror has been selected.',
+                      result=value['result'], geo_loc=value['geo_loc'],
+                      cached=seconds is None, resolve_seconds=seconds,
+                      ansible_facts=facts)
+        return result
+
+    @staticmethod
+    def default_ip(library, params, task_vars):
+        '''Geo-locate the host, not the controller (the library would use
+        the address of the latter). Return the warnings.
+        '''
+        if not params['geo_loc'] or params['ip'] is not None:
+            return []
+        ip = (task_vars.get('ansible_default_ipv4') or {}).get('address')
+        if ip is None:
+            return ['The address of the host is unknown (facts not '
+                    'gathered?): the controller is geo-located']
+        if library.ip_to_int(ip) is None or library.is_private(ip):
+            return ['The address of the host `{}` is private: the controller '
+                    'is geo-located (provide the public one with `ip`)'.format(
+                        ip)]
+        params['ip'] = ip
+        return []
+
+    @staticmethod
+    def load_mirrors(library):
+        '''Load the mirrors (see the library `load_mirrors`) as JSON.'''
+        def load(params, fail_handler):
+            return library.load_mirrors(params)[1].info
+        return load
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import os, sys
+
+from ansible.plugins.action import ActionBase
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+# Ansible doesn't load action plugins as a package: make the helpers next to
+# them importable.
+PLUGINS_DIR = os.path.dirname(os.path.abspath(__file__))
+if PLUGINS_DIR not in sys.path:
+    sys.path.insert(0, PLUGINS_DIR)
+
+from resolve_cache import CACHE_TTL, ResolveCache, ResolveError, \
+                          load_library, module_params
+
+# ------------------------------------------------------------------------------
+# PLUGIN -----------------------------------------------------------------------
+
+class ActionModule(ActionBase):
+    '''Select the Stage once, on the controller, for all the hosts.
+    The parameters are the ones of the `select_stage` module, plus
+    `cache_ttl` (seconds the selection is reused for). The selected Stage
+    path (`stage_path`) is set as fact.
+    '''
+    TRANSFERS_FILES = False
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+
+        args = dict(self._task.args)
+        ttl = int(args.pop('cache_ttl', CACHE_TTL))
+        cache = ResolveCache('select_stage', ttl=ttl)
+        try:
+            library = load_library('select_stage')
+            params = module_params(library.ARGUMENT_SPEC, args)
+            value, seconds = cache.get(params, library.resolve)
+        except ResolveError as err:
+            result.update(failed=True, msg=str(err))
+            return result
+        except Exception as err: # E.g. the list can't be downloaded.
+            result.update(failed=True,
+                          msg='Cannot select the Stage: {}'.format(err))
+            return result
+
+        if seconds is not None: # Only the resolving worker reports it.
+            display.display('select_stage: resolved in {}s'.format(seconds))
+        facts = {'stage_path': value['result']}
+        result.update(changed=False, msg='A Stage archive has been selected.',
+                      result=value['result'], cached=seconds is None,
+                      resolve_seconds=seconds, ansible_facts=facts)
+        return result
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+from ansible.errors import AnsibleFilterError
+
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+DISTCC_PORT = 3632
+
+# ------------------------------------------------------------------------------
+# FILTERS ----------------------------------------------------------------------
+
+def distcc_hosts(names, hostvars, port=DISTCC_PORT):
+    '''Describe the inventory hosts `names` as distcc helpers: address, port
+    (`distccd.port` of the host, if any) and cores (from the gathered facts).
+    '''
+    helpers = []
+    for name in names:
+        try:
+            host_vars = hostvars[name]
+        except KeyError:
+            raise AnsibleFilterError('Unknown host `{}`'.format(name))
+        distccd = host_vars.get('distccd') or {}
+        helpers.append({
+            'host':  host_vars.get('ansible_host') or name,
+            'port':  distccd.get('port') or port,
+            'cores': (distccd.get('jobs') or
+                      host_vars.get('ansible_processor_vcpus') or 1)})
+    return helpers
+
+# ------------------------------------------------------------------------------
+# PLUGIN -----------------------------------------------------------------------
+
+class FilterModule(object):
+    '''Ansible jinja2 filters for distcc.'''
+
+    def filters(self):
+        return {'distcc_hosts': distcc_hosts}
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
@@ -3,6 +3,8 @@
 # ------------------------------------------------------------------------------
 # IMPORTS ----------------------------------------------------------------------
 
+import os, re
+
 from ansible.errors import AnsibleFilterError
 from sys import version_info as py_version_info
 
@@ -10,6 +12,162 @@ PY3K = py_version_info >= (3, 0)
 if PY3K:
     basestring = str
 
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+# Mount options profiles: options for every filesystem (`all`), followed by the
+# filesystem specific ones.
+# - `default`: used when nothing is known about the device.
+# - `ssd`: no access time updates at all; btrfs compression is cheap compared
+#   to the device speed. Online discard is only used by btrfs (`async`
+#   batches it), the others rely on periodic `fstrim`.
+# - `hdd`: stronger compression, since the disk is the bottleneck.
+MOUNT_PROFILES = {
+    'default': {'all':   ['defaults', 'relatime'],
+                'ext3':  ['acl'],
+                'ext4':  ['acl']},
+    'ssd':     {'all':   ['defaults', 'noatime', 'lazytime'],
+                'ext3':  ['acl'],
+                'ext4':  ['acl', 'commit=60'],
+                'btrfs': ['ssd', 'compress=zstd:1', 'discard=async']},
+    'hdd':     {'all':   ['defaults', 'relatime', 'lazytime'],
+                'ext3':  ['acl'],
+                'ext4':  ['acl'],
+                'btrfs': ['compress=zstd:3', 'autodefrag']},
+}
+
+# Paths needed to boot: they're never mounted lazily. Paths below the ones in
+# `CRITICAL_TREES` are critical too.
+CRITICAL_PATHS = ['/', '/usr', '/var', '/boot', '/etc', '/tmp', '/var/log',
+                  '/var/tmp']
+CRITICAL_TREES = ['/boot', '/usr', '/etc']
+
+# Paths (and the paths below them) mounted lazily by the `auto` lazy policy.
+LAZY_TREES = ['/data', '/srv', '/vm', '/mnt', '/media', '/backup']
+
+# Options mounting an entry on first access, instead of at boot.
+LAZY_OPTS = ['noauto', 'x-systemd.automount', 'x-systemd.idle-timeout={}',
+             'nofail']
+
+# ------------------------------------------------------------------------------
+# FIELDS -----------------------------------------------------------------------
+
+# Each field is computed from the values already extracted from the item, so
+# that `mount_spec` reads the item only once.
+
+def _device(item, kind):
+    if kind == 'tmp':
+        return 'tmpfs'
+    else: # If it's not a particular case the `device` value must be set.
+        return item['device']
+
+def _path(mount, fs, root_dir):
+    if fs == 'swap':
+        return 'none'
+    else:
+        path = re.sub('/+', '/', '/'.join([root_dir, mount['path']]))
+        return path.rstrip('/') or '/'
+
+def _fs(kind, fs):
+    if kind == 'tmp':
+        return 'tmpfs'
+    elif (fs or '').startswith('fat'):
+        return 'vfat'
+    else: # If it's not a particular case the `fs` value must be set.
+        if fs is None:
+            raise AnsibleFilterError('Missing filesystem')
+        return fs
+
+def _profile(mount, topology):
+    profile = mount.get('profile')
+    if profile is None:
+        if topology.get('rotational') is None:
+            profile = 'default'
+        elif topology['rotational']:
+            profile = 'hdd'
+        else:
+            profile = 'ssd'
+    elif not profile in MOUNT_PROFILES:
+        raise AnsibleFilterError('Unsupported mount profile `{}`'.format(
+                                 profile))
+    return profile
+
+def _in_trees(path, trees):
+    return any(path == tree or path.startswith(tree + '/') for tree in trees)
+
+def _lazy(kind, mount, fs, default):
+    '''Tell if the entry should be mounted on first access.
+    The policy is `mount.lazy` (or `default`): `True`, `False` or `auto`.
+    '''
+    policy = mount.get('lazy', default)
+    if kind == 'tmp' or fs == 'swap' or not policy:
+        return False
+    path = _path(mount, fs, '/')
+    critical = path in CRITICAL_PATHS or _in_trees(path, CRITICAL_TREES)
+    if policy == 'auto':
+        return not critical and _in_trees(path, LAZY_TREES)
+    elif policy is True:
+        if critical:
+            raise AnsibleFilterError(
+                'Cannot mount `{}` lazily: it is needed to boot'.format(path))
+        return True
+    else:
+        raise AnsibleFilterError('Invalid mount lazy: `{}`'.format(policy))
+
+def _opts(mount, fs, topology, lazy=False, idle_timeout=600, priority=None):
+    '''Return the mount options and the name of the profile they come from.'''
+    opts = mount.get('opts')
+    if opts:
+        if isinstance(opts, list):
+            opts_value, profile = list(opts), 'user'
+        elif isinstance(opts, basestring):
+            opts_value, profile = opts.split(','), 'user'
+        else:
+            raise AnsibleFilterError('Cannot handle mount options')
+    elif fs == 'swap':
+        if priority is not None:
+            return 'sw,pri={}'.format(int(priority)), 'swap'
+        return 'sw', 'swap'
+    else:
+        profile = _profile(mount, topology)
+        opts_value = (MOUNT_PROFILES[profile]['all'] +
+                      MOUNT_PROFILES[profile].get(fs, []))
+        if topology.get('discard') is False:
+            opts_value = [opt for opt in opts_value
+                          if not opt.startswith('discard')]
+    if lazy:
+        opts_value += [opt.format(idle_timeout) for opt in LAZY_OPTS
+                       if not opt.format(idle_timeout) in opts_value]
+    return ','.join(opts_value), profile
+
+def _backup(mount):
+    dump_value = mount.get('backup', False)
+    if dump_value is True:
+        return '1'
+    elif dump_value is False:
+        return '0'
+    else:
+        raise AnsibleFilterError('Invalid mount backup: not boolean')
+
+def _check(mount, fs):
+    min_check_value = 0
+    max_check_value = 2
+    check_value = int(mount.get('check', 0 if fs == 'swap' else 1))
+
+    if check_value < min_check_value or check_value > max_check_value:
+        raise AnsibleFilterError('Invalid mount check: not in ({},{})'.format(
+                                 min_check_value, max_check_value))
+    if fs == 'btrfs' and check_value != 0:
+        raise AnsibleFilterError("Filesystem `btfs` doesn't allow fs checking")
+
+    return str(check_value)
+
+def _state(kind, states, default):
+    state = states.get(kind, default)
+    if not state in ['present', 'absent', 'mounted', 'unmounted']:
+        raise AnsibleFilterError('Unsupported mount state')
+    return state
+
 # ------------------------------------------------------------------------------
 # FILTERS ----------------------------------------------------------------------
 
@@ -18,20 +176,14 @@ def mount_device(item):
     It's a mandatory preference, except:
     - When the partition type is `tmp`.
     '''
-    if item.get('type') == 'tmp':
-        return 'tmpfs'
-    else: # If it's not a particular case the `device` value must be set.
-        return item['device']
+    return _device(item, item.get('type'))
 
 def mount_path(item, root_dir='/'):
     '''Get the mount path.
     It's a mandatory preference, except:
     - When the filesystem is `swap`.
     '''
-    if item.get('fs') == 'swap':
-        return 'none'
-    else:
-        return '/'.join([root_dir, item['mount']['path']]).replace('//', '/')
+    return _path(item.get('mount', {}), item.get('fs'), root_dir)
 
 def mount_fs(item):
     '''Get the mount filesystem.
@@ -39,73 +191,96 @@ def mount_fs(item):
     - When the type is `tmp`.
     If the filesystem is `fat*` it will be normalized to `vfat`.
     '''
-    if item.get('type') == 'tmp':
-        return 'tmpfs'
-    elif item.get('fs', '').startswith('fat'):
-        return 'vfat'
-    else: # If it's not a particular case the `fs` value must be set.
-        return item['fs']
+    return _fs(item.get('type'), item.get('fs'))
 
-def mount_opts(item):
+def mount_opts(item, lazy=False, idle_timeout=600):
     '''Get the mount options.
     It's a optional preference, but when it's given, it should be a
     comma-separated string or a list.
-    If the filesystem is `swap`, it will be automatically computed.
+    If the filesystem is `swap`, it will be automatically computed (using the
+    item `priority`, if any).
+    Otherwise the options come from a profile (see `MOUNT_PROFILES`), chosen
+    by `mount.profile` or by the device facts in `topology`.
+    Lazy entries (see `mount_lazy`) get the automount options.
     '''
-    opts_value = None
-
-    if item.get('mount', {}).get('opts'):
-        print(item['mount'])
-        if isinstance(item['mount']['opts'], list):
-            opts_value = ','.join(item['mount']['opts'])
-        elif isinstance(item['mount']['opts'], basestring):
-            opts_value = item['mount']['opts']
-        else:
-            raise AnsibleFilterError('Cannot handle mount options')
-    elif item.get('fs') == 'swap':
-        opts_value = 'sw'
-    else: # Default filesystem options.
-        opts_value = 'defaults,relatime'
-        if item.get('fs') in ['ext4', 'ext3']:
-            opts_value += ',acl'
+    kind = item.get('type')
+    fs = item.get('fs')
+    mount = item.get('mount', {})
+    return _opts(mount, fs, item.get('topology') or {},
+                 _lazy(kind, mount, fs, lazy), idle_timeout,
+                 item.get('priority'))[0]
 
-    return opts_value
+def mount_lazy(item, lazy=False):
+    '''Tell if the item should be mounted on first access (by a systemd
+    automount unit) instead of at boot.
+    The policy is `mount.lazy`, or `lazy` when not given:
+    - `True`: always (an error for the paths needed to boot).
+    - `False`: never.
+    - `auto`: only for data paths (see `LAZY_TREES`).
+    '''
+    return _lazy(item.get('type'), item.get('mount', {}), item.get('fs'), lazy)
+
+def mount_profile(item):
+    '''Get the name of the profile the mount options come from (`user` if they
+    are given by `mount.opts`).
+    '''
+    return _opts(item.get('mount', {}), item.get('fs'),
+                 item.get('topology') or {})[1]
 
 def mount_backup(item):
     '''Get the mount backup preference.
     Default is `False`.
     '''
-    dump_value = item.get('mount', {}).get('backup', False)
-    if dump_value is True:
-        return '1'
-    elif dump_value is False:
-        return '0'
-    else:
-        raise AnsibleFilterError('Invalid mount backup: not boolean')
+    return _backup(item.get('mount', {}))
 
 def mount_check(item):
     '''Get the mount check preference.
     Default is check enabled with normal priority.
     '''
-    min_check_value = 0
-    max_check_value = 2
-    check_value = int(item.get('mount', {}).get('check', 1))
-
-    if check_value < min_check_value or check_value > max_check_value:
-        raise AnsibleFilterError('Invalid mount check: not in ({},{})'.format(
-                                 min_check_value, max_check_value))
-    if item.get('fs') == 'btrfs' and check_value != 0:
-        raise AnsibleFilterError("Filesystem `btfs` doesn't allow fs checking")
-
-    return str(check_value)
+    return _check(item.get('mount', {}), item.get('fs'))
 
 def mount_state(item, states, default=None):
     '''Get the mount state looking up `states` based on item's type.
     '''
-    state = states.get(item.get('type'), default)
-    if not state in ['present', 'absent', 'mounted', 'unmounted']:
-        raise AnsibleFilterError('Unsupported mount state')
-    return state
+    return _state(item.get('type'), states, default)
+
+def mount_spec(item, root_dir='/', states={}, default='mounted', lazy=False,
+               idle_timeout=600):
+    '''Get the whole mount record of an item (i.e. the results of all the
+    `mount_*` filters) in a single pass.
+    '''
+    kind = item.get('type')
+    fs = item.get('fs')
+    mount = item.get('mount', {})
+    lazy_value = _lazy(kind, mount, fs, lazy)
+    opts, profile = _opts(mount, fs, item.get('topology') or {}, lazy_value,
+                          idle_timeout, item.get('priority'))
+    return {'name':    item.get('name'),
+            'device':  _device(item, kind),
+            'path':    _path(mount, fs, root_dir),
+            'fs':      _fs(kind, fs),
+            'opts':    opts,
+            'profile': profile,
+            'lazy':    lazy_value,
+            'backup':  _backup(mount),
+            'check':   _check(mount, fs),
+            'state':   _state(kind, states, default)}
+
+def crypttab_spec(item, password='none'):
+    '''Get the `crypttab` record of an encrypted partition.
+    The mapping name is the one the partition has been opened with (i.e. its
+    `/dev/mapper/<name>` device, as referenced by `fstab`), not the partition
+    name.
+    '''
+    device = item.get('device') or ''
+    if os.path.dirname(device) != '/dev/mapper':
+        raise AnsibleFilterError(
+            'Encrypted partition `{}` has no mapped device: merge the '
+            '`create_partition` results first'.format(item.get('name')))
+    return {'name':     os.path.basename(device),
+            'device':   item['raw_device'],
+            'password': password,
+            'opts':     item.get('crypt_opts') or 'luks'}
 
 # ------------------------------------------------------------------------------
 # PLUGIN -----------------------------------------------------------------------
@@ -118,6 +293,10 @@ class FilterModule(object):
                 'mount_path':   mount_path,
                 'mount_fs':     mount_fs,
                 'mount_opts':   mount_opts,
+                'mount_profile': mount_profile,
+                'mount_lazy':   mount_lazy,
                 'mount_backup': mount_backup,
                 'mount_check':  mount_check,
-                'mount_state':  mount_state}
+                'mount_state':  mount_state,
+                'mount_spec':   mount_spec,
+                'crypttab_spec': crypttab_spec}
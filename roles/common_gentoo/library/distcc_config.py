@@ -0,0 +1,437 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import multiprocessing, os, re, tempfile
+
+# ------------------------------------------------------------------------------
+# MODULE INFORMATIONS ----------------------------------------------------------
+
+DOCUMENTATION = '''
+---
+module: distcc_config
+short_description: Configure distcc for Portage (and `make`)
+description:
+    - The `configure` action writes the distcc hosts file and sets
+      `MAKEOPTS` and `FEATURES` in `make.conf`, sizing the jobs from the
+      aggregate core count of the helpers.
+    - The `stats` action parses the distcc client log and reports the share
+      of compile jobs that ran remotely.
+author:
+    - "Alessandro Molari"
+'''
+
+EXAMPLES = '''
+# Distribute the compilations of the chroot to two helpers.
+- name: Configure distcc
+  distcc_config:
+    hosts:
+      - host:  10.0.0.2
+        cores: 8
+      - host:  10.0.0.3
+        cores: 4
+    pump:   no
+    log:    /var/log/distcc.log
+    chroot: /mnt/gentoo
+
+# Test with several `distccd` instances on localhost (`localhost` is special
+# for distcc, so use its address).
+- name: Configure distcc
+  distcc_config:
+    hosts: ["127.0.0.1:3633/2", "127.0.0.1:3634/2"]
+    chroot: /mnt/gentoo
+
+- name: Distcc statistics
+  distcc_config:
+    action: stats
+    log:    /var/log/distcc.log
+    chroot: /mnt/gentoo
+'''
+
+# ------------------------------------------------------------------------------
+# COMMONS (copy&paste) ---------------------------------------------------------
+
+class BaseObject(object):
+    import syslog, os
+
+    '''Base class for all classes that use AnsibleModule.
+    Dependencies:
+    - `chrooted` function.
+    '''
+    def __init__(self, module, params=None):
+        syslog.openlog('ansible-{module}-{name}'.format(
+            module=os.path.basename(__file__), name=self.__class__.__name__))
+        self.work_dir = None
+        self.chroot = None
+        self._module = module
+        self._command_prefix = None
+        if params:
+            self._parse_params(params)
+
+    @property
+    def command_prefix(self):
+        return self._command_prefix
+
+    @command_prefix.setter
+    def command_prefix(self, value):
+        self._command_prefix = value
+
+    def run_command(self, command=None, **kwargs):
+        if not 'check_rc' in kwargs:
+            kwargs['check_rc'] = True
+        if command is None and self.command_prefix is None:
+            self.fail('Invalid command')
+        if self.command_prefix:
+            command = '{prefix} {command}'.format(
+                prefix=self.command_prefix, command=command or '')
+        if self.work_dir and not self.chroot:
+            command = 'cd {work_dir}; {command}'.format(
+                work_dir=self.work_dir, command=command)
+        if self.chroot:
+            command = chrooted(command, self.chroot, work_dir=self.work_dir)
+        self.log('Performing command `{}`'.format(command))
+        rc, out, err = self._module.run_command(command, **kwargs)
+        if rc != 0:
+            self.log('Command `{}` returned invalid status code: `{}`'.format(
+                command, rc), level=syslog.LOG_WARNING)
+        return {'rc': rc,
+                'out': out,
+                'out_lines': [line for line in out.split('\n') if line],
+                'err': err,
+                'err_lines': [line for line in out.split('\n') if line]}
+
+    def log(self, msg, level=syslog.LOG_DEBUG):
+        '''Log to the system logging facility of the target system.'''
+        if os.name == 'posix': # syslog is unsupported on Windows.
+            syslog.syslog(level, str(msg))
+
+    def fail(self, msg):
+        self._module.fail_json(msg=msg)
+
+    def exit(self, changed=True, msg='', result=None):
+        self._module.exit_json(changed=changed, msg=msg, result=result)
+
+    def _parse_params(self, params):
+        for param in params:
+            if param in self._module.params:
+                value = self._module.params[param]
+                t = self._module.argument_spec[param].get('type')
+                if t == 'str' and value in ['None', 'none']:
+                    value = None
+                setattr(self, param, value)
+            else:
+                setattr(self, param, None)
+
+def chrooted(command, path, profile='/etc/profile', work_dir=None):
+    prefix = "chroot {path} bash -c 'source {profile}; ".format(
+        path=path, profile=profile)
+    if work_dir:
+        prefix += 'cd {work_dir}; '.format(work_dir=work_dir)
+    prefix += command
+    prefix += "'"
+    return prefix
+
+def _replace_file(tmp_path, path):
+    '''Move the (already synced) `tmp_path` over `path`, keeping its mode.'''
+    if os.path.exists(path):
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    else:
+        os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+
+def atomic_write(path, content):
+    '''Replace the file at `path` with `content`, without leaving it truncated
+    or half-written if something goes wrong.
+    Nothing is written if the file already has that content.
+    Return `True` if the file has been written.
+    '''
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        _replace_file(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+class ConfigEditor(object):
+    '''Edit a line-based configuration file with many rules at once.
+    Each rule is `(regexp, replacement, append_if_missing, template)`: lines
+    matching `regexp` are replaced by `replacement` (`None` removes them),
+    taken literally unless `template` is set (then it's a `re` template). The
+    first matching rule wins. If no line matches a rule with
+    `append_if_missing`, its replacement is appended to the file.
+    The file is read and rewritten in a single streaming pass and replaced
+    atomically, only if its content changes (a missing file is created only
+    if there's something to write).
+    '''
+    def __init__(self, path, rules=None):
+        self.path = path
+        self.rules = []
+        for rule in rules or []:
+            self.rule(*rule)
+
+    def rule(self, regexp, replacement, append_if_missing=False,
+             template=False):
+        self.rules.append((re.compile(regexp), replacement, append_if_missing,
+                           template))
+        return self
+
+    @staticmethod
+    def terminated(line):
+        '''`line` ending with a newline (e.g. the last line of a file).'''
+        if line is None or line.endswith('\n'):
+            return line
+        return line + '\n'
+
+    def edit(self, lines):
+        '''Yield `(old line, new line)` pairs (`None` for missing lines).
+        New lines always end with a newline.
+        '''
+        matched = [False] * len(self.rules)
+        for line in lines:
+            new_line = self.terminated(line)
+            for idx, (regexp, replacement, _, template) in \
+                    enumerate(self.rules):
+                md = regexp.match(line.rstrip('\n'))
+                if md:
+                    matched[idx] = True
+                    if replacement is None:
+                        new_line = None
+                    elif template:
+                        new_line = md.expand(replacement) + '\n'
+                    else:
+                        new_line = replacement + '\n'
+                    break
+            yield line, new_line
+        for idx, (_, replacement, append_if_missing, _) in \
+                enumerate(self.rules):
+            if append_if_missing and not matched[idx] and replacement:
+                yield None, replacement + '\n'
+
+    def apply(self):
+        '''Apply the rules. Return `True` if the file has been changed.'''
+        try:
+            src = open(self.path)
+        except (IOError, OSError):
+            src = None
+        changed = False
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            prefix='.{}.'.format(os.path.basename(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as dst:
+                for old_line, new_line in self.edit(src or []):
+                    # A missing final newline alone isn't a change.
+                    if new_line != self.terminated(old_line):
+                        changed = True
+                    if new_line is not None:
+                        dst.write(new_line)
+                if changed:
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            if changed:
+                _replace_file(tmp_path, self.path)
+            else:
+                os.remove(tmp_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            if src is not None:
+                src.close()
+        return changed
+
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+DISTCC_PORT = 3632
+
+HOSTS_FILE = '/etc/distcc/hosts'
+
+MAKE_CONF = '/etc/portage/make.conf'
+
+# `host[:port][/limit][,options]` entries of the hosts file.
+HOST_SPEC_REGEXP = re.compile(
+    r'^(?P<host>[^:/,]+)(:(?P<port>\d+))?(/(?P<cores>\d+))?(,.*)?$')
+
+# Lines written by the distcc client (with `DISTCC_VERBOSE=1`).
+COMPILED_REGEXP = re.compile(r'compile (?P<file>\S+) on (?P<host>\S+) '
+                             r'completed ok')
+FALLBACK_REGEXP = re.compile(r'failed to distribute.*running locally instead')
+
+# ------------------------------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
+
+def parse_host(host):
+    '''Normalize an helper, given as `host[:port][/cores]` or as a dict with
+    `host`, `port` and `cores`.
+    '''
+    if isinstance(host, dict):
+        return {'host':  str(host['host']),
+                'port':  int(host.get('port') or DISTCC_PORT),
+                'cores': int(host.get('cores') or 1)}
+    md = HOST_SPEC_REGEXP.match(str(host).strip())
+    if not md:
+        return None
+    return {'host':  md.group('host'),
+            'port':  int(md.group('port') or DISTCC_PORT),
+            'cores': int(md.group('cores') or 1)}
+
+def is_local(host):
+    return host.split('/')[0].split(':')[0] == 'localhost'
+
+# ------------------------------------------------------------------------------
+# LOGIC ------------------------------------------------------------------------
+
+class DistccConfig(BaseObject):
+    '''Make Portage (and `make` invocations using the returned `jobs`)
+    distribute the compilations to the helpers with distcc.
+    '''
+    def __init__(self, module):
+        super(DistccConfig, self).__init__(module,
+            params=['action', 'hosts', 'local_slots', 'jobs', 'pump', 'log',
+                    'chroot'])
+        self.root_dir = self.chroot or '/'
+
+    def path(self, path):
+        return os.path.join(self.root_dir, path.lstrip('/'))
+
+    def helpers(self):
+        helpers = []
+        for host in self.hosts:
+            helper = parse_host(host)
+            if helper is None:
+                self.fail('Invalid distcc host `{}`'.format(host))
+            if helper['host'] == 'localhost':
+                self.fail('`localhost` means "compile locally" for distcc: '
+                          'use `127.0.0.1` for local distccd instances')
+            helpers.append(helper)
+        return helpers
+
+    def render_hosts(self, helpers, local_slots):
+        options = ',cpp,lzo' if self.pump else ',lzo'
+        specs = ['{host}:{port}/{cores}{options}'.format(options=options,
+                                                         **helper)
+                 for helper in helpers]
+        if local_slots:
+            specs.insert(0, 'localhost/{}'.format(local_slots))
+        return '# Written by Ansible (distcc_config).\n{}\n'.format(
+            ' '.join(specs))
+
+    def configure(self):
+        helpers = self.helpers()
+        local_cores = multiprocessing.cpu_count()
+        local_slots = (min(2, local_cores) if self.local_slots is None
+                       else self.local_slots)
+        remote_cores = sum(helper['cores'] for helper in helpers)
+        # Remote cores + local ones (which also preprocess and link); the
+        # load limit keeps the local machine from being overcommitted.
+        jobs = self.jobs or remote_cores + local_cores
+        load = local_cores
+
+        hosts_file = self.path(HOSTS_FILE)
+        if not os.path.isdir(os.path.dirname(hosts_file)):
+            os.makedirs(os.path.dirname(hosts_file))
+        changed = atomic_write(hosts_file,
+                               self.render_hosts(helpers, local_slots))
+
+        features = 'distcc distcc-pump' if self.pump else 'distcc'
+        make_conf = ConfigEditor(self.path(MAKE_CONF)) \
+            .rule(r'MAKEOPTS=.*', 'MAKEOPTS="-j{} -l{}"'.format(jobs, load),
+                  True) \
+            .rule(r'FEATURES="\$\{FEATURES\} distcc.*"',
+                  'FEATURES="${{FEATURES}} {}"'.format(features), True)
+        if self.log:
+            make_conf.rule(r'DISTCC_LOG=.*',
+                           'DISTCC_LOG="{}"'.format(self.log), True) \
+                     .rule(r'DISTCC_VERBOSE=.*', 'DISTCC_VERBOSE="1"', True)
+        else:
+            make_conf.rule(r'DISTCC_(LOG|VERBOSE)=.*', None)
+        changed = make_conf.apply() or changed
+
+        return changed, {'hosts':        helpers,
+                         'local_slots':  local_slots,
+                         'remote_cores': remote_cores,
+                         'jobs':         jobs,
+                         'load':         load,
+                         'pump':         self.pump}
+
+    def stats(self):
+        '''Count the compile jobs run by each host, from the client log.'''
+        if not self.log:
+            self.fail('The `stats` action needs the distcc `log`')
+        per_host = {}
+        fallbacks = 0
+        try:
+            with open(self.path(self.log)) as f:
+                for line in f:
+                    md = COMPILED_REGEXP.search(line)
+                    if md:
+                        host = md.group('host').split(',')[0].split('/')[0]
+                        per_host[host] = per_host.get(host, 0) + 1
+                    elif FALLBACK_REGEXP.search(line):
+                        fallbacks += 1
+        except (IOError, OSError) as err:
+            self.fail('Cannot read the distcc log: {}'.format(err))
+        remote = sum(count for host, count in per_host.items()
+                     if not is_local(host))
+        local = sum(per_host.values()) - remote + fallbacks
+        return False, {'remote':       remote,
+                       'local':        local,
+                       'fallbacks':    fallbacks,
+                       'per_host':     per_host,
+                       'remote_share': (round(float(remote) / (remote + local),
+                                              4)
+                                        if remote + local else None)}
+
+    def run(self):
+        if self.action == 'stats':
+            return self.stats()
+        return self.configure()
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    module = AnsibleModule(argument_spec={
+        'action':      {'choices': ['configure', 'stats'], 'required': False,
+                        'default': 'configure'},
+        'hosts':       {'type': 'list', 'required': False, 'default': []},
+        'local_slots': {'type': 'int', 'required': False, 'default': None},
+        'jobs':        {'type': 'int', 'required': False, 'default': None},
+        'pump':        {'type': 'bool', 'required': False, 'default': False},
+        'log':         {'type': 'str', 'required': False, 'default': None},
+        'chroot':      {'type': 'str', 'required': False, 'default': None},
+    })
+
+    distcc_config = DistccConfig(module)
+    changed, result = distcc_config.run()
+    module.exit_json(changed=changed, msg='Distcc configured', result=result)
+
+# ------------------------------------------------------------------------------
+# ENTRY POINT ------------------------------------------------------------------
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
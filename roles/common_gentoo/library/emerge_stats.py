@@ -0,0 +1,355 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import heapq, os, re, sqlite3
+
+# ------------------------------------------------------------------------------
+# MODULE INFORMATIONS ----------------------------------------------------------
+
+DOCUMENTATION = '''
+---
+module: emerge_stats
+short_description: Build durations of the packages, from `emerge.log`
+description:
+    - The new lines of `emerge.log` (from the offset reached by the previous
+      run) are parsed and the build duration of each merged package is
+      stored in a sqlite database on the target.
+    - The history and the percentiles of the durations of each package are
+      reported, along with the slowest packages.
+    - Given a list of (independent) `packages`, they're ordered
+      longest-first and the time to build them with `jobs` parallel jobs is
+      predicted.
+author:
+    - "Alessandro Molari"
+'''
+
+EXAMPLES = '''
+- name: Emerge statistics
+  emerge_stats:
+    chroot: /mnt/gentoo
+
+- name: Order packages
+  emerge_stats:
+    packages: [www-client/firefox, app-editors/neovim, dev-lang/rust]
+    jobs:     2
+    chroot:   /mnt/gentoo
+  register: _output
+- command: "emerge {{ _output.result.order | join(' ') }}"
+'''
+
+# ------------------------------------------------------------------------------
+# COMMONS (copy&paste) ---------------------------------------------------------
+
+class BaseObject(object):
+    import syslog, os
+
+    '''Base class for all classes that use AnsibleModule.
+    Dependencies:
+    - `chrooted` function.
+    '''
+    def __init__(self, module, params=None):
+        syslog.openlog('ansible-{module}-{name}'.format(
+            module=os.path.basename(__file__), name=self.__class__.__name__))
+        self.work_dir = None
+        self.chroot = None
+        self._module = module
+        self._command_prefix = None
+        if params:
+            self._parse_params(params)
+
+    @property
+    def command_prefix(self):
+        return self._command_prefix
+
+    @command_prefix.setter
+    def command_prefix(self, value):
+        self._command_prefix = value
+
+    def run_command(self, command=None, **kwargs):
+        if not 'check_rc' in kwargs:
+            kwargs['check_rc'] = True
+        if command is None and self.command_prefix is None:
+            self.fail('Invalid command')
+        if self.command_prefix:
+            command = '{prefix} {command}'.format(
+                prefix=self.command_prefix, command=command or '')
+        if self.work_dir and not self.chroot:
+            command = 'cd {work_dir}; {command}'.format(
+                work_dir=self.work_dir, command=command)
+        if self.chroot:
+            command = chrooted(command, self.chroot, work_dir=self.work_dir)
+        self.log('Performing command `{}`'.format(command))
+        rc, out, err = self._module.run_command(command, **kwargs)
+        if rc != 0:
+            self.log('Command `{}` returned invalid status code: `{}`'.format(
+                command, rc), level=syslog.LOG_WARNING)
+        return {'rc': rc,
+                'out': out,
+                'out_lines': [line for line in out.split('\n') if line],
+                'err': err,
+                'err_lines': [line for line in out.split('\n') if line]}
+
+    def log(self, msg, level=syslog.LOG_DEBUG):
+        '''Log to the system logging facility of the target system.'''
+        if os.name == 'posix': # syslog is unsupported on Windows.
+            syslog.syslog(level, str(msg))
+
+    def fail(self, msg):
+        self._module.fail_json(msg=msg)
+
+    def exit(self, changed=True, msg='', result=None):
+        self._module.exit_json(changed=changed, msg=msg, result=result)
+
+    def _parse_params(self, params):
+        for param in params:
+            if param in self._module.params:
+                value = self._module.params[param]
+                t = self._module.argument_spec[param].get('type')
+                if t == 'str' and value in ['None', 'none']:
+                    value = None
+                setattr(self, param, value)
+            else:
+                setattr(self, param, None)
+
+def chrooted(command, path, profile='/etc/profile', work_dir=None):
+    prefix = "chroot {path} bash -c 'source {profile}; ".format(
+        path=path, profile=profile)
+    if work_dir:
+        prefix += 'cd {work_dir}; '.format(work_dir=work_dir)
+    prefix += command
+    prefix += "'"
+    return prefix
+
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+START_REGEXP = re.compile(
+    r'^(?P<time>\d+):  >>> emerge \(\d+ of \d+\) (?P<cpv>\S+) to ')
+END_REGEXP = re.compile(
+    r'^(?P<time>\d+):  ::: completed emerge \(\d+ of \d+\) (?P<cpv>\S+) to ')
+# The builds still running when emerge stops never complete.
+TERMINATE_REGEXP = re.compile(r'^\d+:  \*\*\* terminating\.')
+
+CPV_REGEXP = re.compile(r'^(?P<cp>.+?)-(?P<version>\d[^-]*(?:-r\d+)?)$')
+
+ATOM_REGEXP = re.compile(r'^[<>=~!]*(?P<cpv>[^:\[]+)')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS builds (
+    cp       TEXT    NOT NULL,
+    version  TEXT    NOT NULL,
+    start    INTEGER NOT NULL,
+    duration INTEGER NOT NULL,
+    PRIMARY KEY (cp, start)
+);
+CREATE TABLE IF NOT EXISTS pending (
+    cpv   TEXT    PRIMARY KEY,
+    start INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key   TEXT    PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+
+# ------------------------------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
+
+def split_cpv(cpv):
+    '''Split `cpv` (e.g. `sys-libs/zlib-1.3-r1::gentoo`) into package and
+    version.
+    '''
+    cpv = cpv.split('::')[0]
+    md = CPV_REGEXP.match(cpv)
+    if md:
+        return md.group('cp'), md.group('version')
+    return cpv, ''
+
+def atom_package(atom):
+    '''Package of `atom` (e.g. `sys-libs/zlib` for `>=sys-libs/zlib-1.3:0`).'''
+    md = ATOM_REGEXP.match(atom.strip())
+    cpv = md.group('cpv') if md else atom.strip()
+    return split_cpv(cpv)[0] if re.match(r'^[<>=~]', atom) else cpv
+
+def percentile(values, pct):
+    '''Nearest-rank percentile of the sorted `values`.'''
+    rank = max(1, int(-(-len(values) * pct // 100)))
+    return values[min(rank, len(values)) - 1]
+
+def makespan(durations, jobs):
+    '''Completion time of `durations` scheduled longest-first (LPT) on `jobs`
+    workers.
+    '''
+    loads = [0] * max(1, jobs)
+    for duration in sorted(durations, reverse=True):
+        heapq.heapreplace(loads, loads[0] + duration)
+    return max(loads)
+
+# ------------------------------------------------------------------------------
+# LOGIC ------------------------------------------------------------------------
+
+class EmergeStats(BaseObject):
+    '''Collect the build durations from `emerge.log` into `db`.'''
+    def __init__(self, module):
+        super(EmergeStats, self).__init__(module,
+            params=['log', 'db', 'history', 'top', 'packages', 'jobs',
+                    'chroot'])
+        self.root_dir = self.chroot or '/'
+
+    def path(self, path):
+        '''`path` (inside the chroot) as seen from the host.'''
+        return os.path.join(self.root_dir, path.lstrip('/'))
+
+    def connect(self):
+        db = self.path(self.db)
+        if not os.path.isdir(os.path.dirname(db)):
+            os.makedirs(os.path.dirname(db))
+        conn = sqlite3.connect(db)
+        conn.executescript(SCHEMA)
+        return conn
+
+    def collect(self, conn):
+        '''Parse the lines of the log appended since the previous run.
+        Return the number of new builds.
+        '''
+        log = self.path(self.log)
+        if not os.path.exists(log):
+            return 0
+        state = dict(conn.execute('SELECT key, value FROM state'))
+        st = os.stat(log)
+        offset = state.get('offset', 0)
+        if state.get('inode') != st.st_ino or st.st_size < offset:
+            # Rotated or truncated: start over.
+            offset = 0
+            conn.execute('DELETE FROM pending')
+
+        builds = 0
+        with open(log, 'rb') as f:
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                if not line.endswith(b'\n'): # Being written: next time.
+                    break
+                offset += len(line)
+                line = line.decode('utf-8', 'replace')
+                md = START_REGEXP.match(line)
+                if md:
+                    conn.execute('INSERT OR REPLACE INTO pending VALUES (?, ?)',
+                                 (md.group('cpv').split('::')[0],
+                                  int(md.group('time'))))
+                    continue
+                md = END_REGEXP.match(line)
+                if md:
+                    cpv = md.group('cpv').split('::')[0]
+                    row = conn.execute('SELECT start FROM pending '
+                                       'WHERE cpv = ?', (cpv,)).fetchone()
+                    if row:
+                        cp, version = split_cpv(cpv)
+                        conn.execute(
+                            'INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?)',
+                            (cp, version, row[0],
+                             int(md.group('time')) - row[0]))
+                        conn.execute('DELETE FROM pending WHERE cpv = ?',
+                                     (cpv,))
+                        builds += 1
+                    continue
+                if TERMINATE_REGEXP.match(line):
+                    conn.execute('DELETE FROM pending')
+
+        conn.executemany('INSERT OR REPLACE INTO state VALUES (?, ?)',
+                         [('inode', st.st_ino), ('offset', offset)])
+        conn.commit()
+        return builds
+
+    def package_stats(self, conn):
+        '''Statistics of the build durations of each package.'''
+        durations = {}
+        for cp, version, duration in conn.execute(
+                'SELECT cp, version, duration FROM builds ORDER BY start'):
+            durations.setdefault(cp, []).append((version, duration))
+        stats = {}
+        for cp, builds in durations.items():
+            values = sorted(duration for _, duration in builds)
+            stats[cp] = {
+                'builds':  len(values),
+                'last':    builds[-1][1],
+                'mean':    round(float(sum(values)) / len(values), 1),
+                'p50':     percentile(values, 50),
+                'p90':     percentile(values, 90),
+                'max':     values[-1],
+                'total':   sum(values),
+                'history': [{'version': version, 'duration': duration}
+                            for version, duration in builds[-self.history:]]}
+        return stats
+
+    def plan(self, stats):
+        '''Order `packages` longest-first and predict their build time.
+        Packages never built are estimated with the median of all packages.
+        '''
+        medians = sorted(s['p50'] for s in stats.values())
+        default = percentile(medians, 50) if medians else 0
+        estimates = dict((atom, stats.get(atom_package(atom),
+                                          {'p50': default})['p50'])
+                         for atom in self.packages)
+        order = sorted(self.packages, key=lambda atom: -estimates[atom])
+        return {'order':     order,
+                'estimates': estimates,
+                'unknown':   [atom for atom in self.packages
+                              if atom_package(atom) not in stats],
+                'serial_seconds':    sum(estimates.values()),
+                'predicted_seconds': makespan(estimates.values(), self.jobs)}
+
+    def run(self):
+        conn = self.connect()
+        try:
+            builds = self.collect(conn)
+            stats = self.package_stats(conn)
+        finally:
+            conn.close()
+        slowest = sorted(stats, key=lambda cp: -stats[cp]['p50'])[:self.top]
+        result = {'new_builds': builds,
+                  'packages':   stats,
+                  'slowest':    [{'package': cp, 'p50': stats[cp]['p50']}
+                                 for cp in slowest],
+                  'total_seconds': sum(s['total'] for s in stats.values())}
+        if self.packages:
+            result.update(self.plan(stats))
+        return builds > 0, result
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    module = AnsibleModule(argument_spec={
+        'log':      {'type': 'str', 'required': False,
+                     'default': '/var/log/emerge.log'},
+        'db':       {'type': 'str', 'required': False,
+                     'default': '/var/lib/emerge_stats/builds.db'},
+        # Durations per package in the history.
+        'history':  {'type': 'int', 'required': False, 'default': 5},
+        # Number of slowest packages to report.
+        'top':      {'type': 'int', 'required': False, 'default': 10},
+        # Independent packages to order and whose build time to predict.
+        'packages': {'type': 'list', 'required': False, 'default': []},
+        'jobs':     {'type': 'int', 'required': False, 'default': 1},
+        'chroot':   {'type': 'str', 'required': False, 'default': None},
+    })
+
+    emerge_stats = EmergeStats(module)
+    changed, result = emerge_stats.run()
+    module.exit_json(changed=changed, msg='Emerge statistics collected',
+                     result=result)
+
+# ------------------------------------------------------------------------------
+# ENTRY POINT ------------------------------------------------------------------
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
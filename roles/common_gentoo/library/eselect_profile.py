@@ -4,25 +4,47 @@
 # ------------------------------------------------------------------------------
 # IMPORTS ----------------------------------------------------------------------
 
-import re, sys
+import os, re, sys
 
 PY3K = sys.version_info >= (3, 0)
 if PY3K:
-    basestring = str
+    from configparser import RawConfigParser, Error as ConfigError
+else:
+    from ConfigParser import RawConfigParser, Error as ConfigError
 
 # ------------------------------------------------------------------------------
 # MODULE INFORMATIONS ----------------------------------------------------------
 
 DOCUMENTATION = '''
 ---
-module: eselect
-short_description: Perform `eselect` commands
+module: eselect_profile
+short_description: Select the Portage profile
+description:
+    - The profiles are read from `profiles/profiles.desc` of the main
+      repository of the target system, without running `eselect`.
+    - The profile is set by atomically replacing the `make.profile` symlink.
 author:
     - "Alessandro Molari"
 '''
 
 EXAMPLES = '''
-TODO
+# Select the stable `default/linux/amd64/<version>/systemd` profile of the
+# Gentoo installation in `/mnt/gentoo`.
+- name: Select profile
+  eselect_profile:
+    arch:    amd64
+    systemd: yes
+    chroot:  /mnt/gentoo
+
+# Select an hardened no-multilib profile, accepting development profiles too.
+- name: Select profile
+  eselect_profile:
+    arch:      amd64
+    multilib:  no
+    hardened:  yes
+    systemd:   no
+    stability: dev
+    chroot:    /mnt/gentoo
 '''
 
 # ------------------------------------------------------------------------------
@@ -108,64 +130,180 @@ def chrooted(command, path, profile='/etc/profile', work_dir=None):
     prefix += "'"
     return prefix
 
+
 # ------------------------------------------------------------------------------
-# ESelectProfileExecutor -------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
 
-class ESelectProfileExecutor(BaseObject):
-    def __init__(self, module):
-        super(ESelectProfileExecutor, self).__init__(module,
-            params=['hardened', 'systemd', 'multilib', 'arch', 'selinux',
-                    'desktop', 'developer', 'chroot'])
-        self.command_prefix = 'eselect profile'
+# Profile stabilities, from the most to the least stable.
+STABILITIES = ['stable', 'dev', 'exp']
 
-    def set(self):
-        '''Set the profile.
-        '''
-        profile_regexp = []
-        profile_regexp.append(self.hardened or 'default')
-        profile_regexp.append('linux')
-        profile_regexp.append(self.arch)
-        profile_regexp.append('[^/]+')
-        if not self.multilib:
-            profile_regexp.append('no-multilib')
-            if self.hardened and self.selinux:
-                profile_regexp.append('selinux')
-        elif self.selinux:
-            profile_regexp.append('selinux')
-        elif self.developer:
-            profile_regexp.append('developer')
-        elif self.desktop:
-            profile_regexp.append(self.desktop)
-            if self.systemd:
-                profile_regexp.append('systemd')
-        elif self.systemd:
-            profile_regexp.append('systemd')
-        profile_regexp = '/'.join(profile_regexp)
+# Repository locations used when `repos.conf` doesn't tell it.
+DEFAULT_REPO_LOCATIONS = ['/var/db/repos/gentoo', '/usr/portage']
 
-        profile = None
-        for prof in self.list():
-            if re.match(profile_regexp, prof['name']):
-                profile = prof
+MAKE_PROFILE = '/etc/portage/make.profile'
 
-        if profile is None:
-            self.fail('Cannot find a valid profile')
+# ------------------------------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
 
-        self.run_command('set {id}'.format(id=profile['id']))
+def in_root(root_dir, path):
+    return os.path.join(root_dir, path.lstrip('/'))
 
-        return profile
+def version_key(version):
+    return tuple(int(part) for part in version.split('.')) if version else ()
 
-    def list(self):
-        result = []
+def parse_profile(arch, name, stability):
+    '''Index a profile by its kind (`default`, `hardened`, ...), release
+    version and flavors (the components following the version, e.g.
+    `no-multilib` or `systemd`).
+    '''
+    parts = name.split('/')
+    version = None
+    flavors = parts[3:] if len(parts) > 3 and parts[1] == 'linux' else []
+    for idx, part in enumerate(parts):
+        if re.match(r'^\d+(\.\d+)*$', part):
+            version = part
+            flavors = parts[idx + 1:]
+            break
+    return {'name':      name,
+            'arch':      arch,
+            'stability': stability,
+            'kind':      parts[0],
+            'version':   version,
+            'flavors':   flavors}
+
+def score(profile, wanted, max_stability):
+    '''Score a profile against the `wanted` flavors: the higher the better,
+    `None` when the profile isn't acceptable at all.
+    A profile must have all the wanted flavors and be stable enough; then
+    more stable profiles, with fewer unwanted flavors and newer releases win.
+    The profile name breaks the remaining ties, so that the resolution is
+    deterministic.
+    '''
+    if profile['stability'] not in STABILITIES or \
+       STABILITIES.index(profile['stability']) > \
+       STABILITIES.index(max_stability):
+        return None
+    components = set(profile['flavors'])
+    components.add(profile['kind'])
+    if not set(wanted) <= components:
+        return None
+    extras = len(components - set(wanted) - set(['default']))
+    return (-STABILITIES.index(profile['stability']),
+            -extras,
+            version_key(profile['version']),
+            profile['name'])
 
-        profs = self.run_command('list')['out_lines'][1:]
-        profs = map(lambda x: [e for e in re.split(r'\s+', x) if e], profs)
-        for prof in profs:
-            id_regexp = r'\[(\d+)\]'
-            result.append({'id':   int(re.match(id_regexp, prof[0]).group(1)),
-                           'name': prof[1]})
+# ------------------------------------------------------------------------------
+# LOGIC ------------------------------------------------------------------------
 
+class ProfileSelector(BaseObject):
+    '''Select the Portage profile of a (possibly chrooted) Gentoo system.'''
+    def __init__(self, module):
+        super(ProfileSelector, self).__init__(module,
+            params=['hardened', 'systemd', 'multilib', 'arch', 'selinux',
+                    'desktop', 'developer', 'stability', 'chroot'])
+        self.root_dir = self.chroot or '/'
+
+    def repo_location(self):
+        '''Location of the main repository, as configured in `repos.conf`.'''
+        paths = ['/usr/share/portage/config/repos.conf']
+        conf = in_root(self.root_dir, '/etc/portage/repos.conf')
+        if os.path.isdir(conf):
+            paths += [os.path.join('/etc/portage/repos.conf', name)
+                      for name in sorted(os.listdir(conf))
+                      if not name.startswith('.')]
+        else:
+            paths.append('/etc/portage/repos.conf')
+        parser = RawConfigParser()
+        try:
+            parser.read([in_root(self.root_dir, path) for path in paths])
+        except ConfigError as err:
+            self.fail('Invalid `repos.conf`: {}'.format(err))
+        main_repo = parser.defaults().get('main-repo', 'gentoo')
+        locations = list(DEFAULT_REPO_LOCATIONS)
+        if parser.has_option(main_repo, 'location'):
+            locations.insert(0, parser.get(main_repo, 'location'))
+        for location in locations:
+            if os.path.isfile(in_root(self.root_dir, os.path.join(
+                    location, 'profiles', 'profiles.desc'))):
+                return location.rstrip('/') or '/'
+        self.fail('Cannot find the Portage tree (tried: {})'.format(
+            ', '.join(locations)))
+
+    def profiles(self, repo_location):
+        '''Parse `profiles.desc` (lines `<arch> <profile> <stability>`).'''
+        result = []
+        path = in_root(self.root_dir, os.path.join(
+            repo_location, 'profiles', 'profiles.desc'))
+        with open(path) as f:
+            for line in f:
+                fields = line.split('#', 1)[0].split()
+                if len(fields) >= 3:
+                    result.append(parse_profile(*fields[:3]))
         return result
 
+    def wanted(self):
+        '''Flavors the profile must have.'''
+        wanted = []
+        if self.hardened:
+            wanted.append('hardened')
+        if not self.multilib:
+            wanted.append('no-multilib')
+        if self.selinux:
+            wanted.append('selinux')
+        elif self.developer:
+            wanted.append('developer')
+        elif self.desktop:
+            wanted += [f for f in self.desktop.split('/') if f]
+        if self.systemd and not self.selinux and not self.developer:
+            wanted.append('systemd')
+        return wanted
+
+    def resolve(self):
+        repo_location = self.repo_location()
+        wanted = self.wanted()
+        candidates = []
+        for profile in self.profiles(repo_location):
+            if profile['arch'] != self.arch:
+                continue
+            profile_score = score(profile, wanted, self.stability)
+            if profile_score is not None:
+                candidates.append((profile_score, profile))
+        if not candidates:
+            self.fail('Cannot find a `{}` profile with flavors: {}'.format(
+                self.arch, ', '.join(wanted) or '(none)'))
+        profile = max(candidates, key=lambda candidate: candidate[0])[1]
+        profile['path'] = os.path.join(repo_location, 'profiles',
+                                       profile['name'])
+        return profile
+
+    def set(self):
+        '''Point `make.profile` to the best profile.
+        Return whether the symlink has been changed and the profile.
+        '''
+        profile = self.resolve()
+        link = in_root(self.root_dir, MAKE_PROFILE)
+        # Relative target (as `eselect` does), valid inside and outside the
+        # chroot.
+        target = os.path.relpath(profile['path'], os.path.dirname(MAKE_PROFILE))
+        if os.path.islink(link):
+            current = os.path.normpath(os.path.join(
+                os.path.dirname(MAKE_PROFILE), os.readlink(link)))
+            if current == os.path.normpath(profile['path']):
+                return False, profile
+        elif os.path.exists(link):
+            self.fail('`{}` exists and is not a symlink'.format(link))
+        tmp_link = '{}.{}.tmp'.format(link, os.getpid())
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(target, tmp_link)
+        try:
+            os.rename(tmp_link, link)
+        except OSError:
+            os.remove(tmp_link)
+            raise
+        return True, profile
+
 # ------------------------------------------------------------------------------
 # MAIN FUNCTION ----------------------------------------------------------------
 
@@ -173,20 +311,23 @@ def main():
     module = AnsibleModule(argument_spec={
         'arch': {'type':     'str',
                  'required': True,
-                 'choices':  ['alpha', 'amd64', 'arm', 'hppa', 'ia64', 'mips',
-                              'ppc', 's390', 'sh', 'sparc', 'x86']},
+                 'choices':  ['alpha', 'amd64', 'arm', 'arm64', 'hppa', 'ia64',
+                              'mips', 'ppc', 'ppc64', 's390', 'sh', 'sparc',
+                              'x86']},
         'multilib':  {'type': 'bool', 'required': False, 'default': True},
         'hardened':  {'type': 'bool', 'required': False, 'default': False},
         'systemd':   {'type': 'bool', 'required': False, 'default': True},
         'selinux':   {'type': 'bool', 'required': False, 'default': False},
         'developer': {'type': 'bool', 'required': False, 'default': False},
         'desktop':   {'type': 'str',  'required': False, 'default': None},
+        'stability': {'choices': STABILITIES, 'required': False,
+                      'default': 'stable'},
         'chroot':    {'type': 'str',  'required': False, 'default': None},
     })
 
-    eselect_profile = ESelectProfileExecutor(module)
-    profile = eselect_profile.set()
-    module.exit_json(changed=True, profile=profile)
+    profile_selector = ProfileSelector(module)
+    changed, profile = profile_selector.set()
+    module.exit_json(changed=changed, profile=profile)
 
 # ------------------------------------------------------------------------------
 # ENTRY POINT ------------------------------------------------------------------
@@ -0,0 +1,587 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import math, multiprocessing, os, re, tempfile
+
+# ------------------------------------------------------------------------------
+# MODULE INFORMATIONS ----------------------------------------------------------
+
+DOCUMENTATION = '''
+---
+module: portage_tuning
+short_description: Tune `make.conf` for the hardware of the machine
+description:
+    - The CPUs (affinity and cgroup quota), the memory (and cgroup limit)
+      and the CPU flags of the machine are used to set `CFLAGS` (`-march`),
+      `CPU_FLAGS_X86`, `MAKEOPTS` and `EMERGE_DEFAULT_OPTS`.
+    - With `resolve_march`, `-march=native` is replaced by the CPU it stands
+      for (as detected by `gcc`), so that the flags mean the same on other
+      machines (e.g. distcc helpers).
+    - When there's enough memory, `PORTAGE_TMPDIR` is put on a tmpfs.
+    - `make.conf` is edited atomically and only when something changes.
+author:
+    - "Alessandro Molari"
+'''
+
+EXAMPLES = '''
+- name: Tune Portage
+  portage_tuning:
+    cflags: -ggdb
+    chroot: /mnt/gentoo
+
+# Leave MAKEOPTS alone (e.g. set by `distcc_config`), compile for this CPU
+# on the distcc helpers too and never use a tmpfs.
+- name: Tune Portage
+  portage_tuning:
+    makeopts:      no
+    resolve_march: yes
+    tmpfs:    no
+    chroot:   /mnt/gentoo
+'''
+
+# ------------------------------------------------------------------------------
+# COMMONS (copy&paste) ---------------------------------------------------------
+
+class BaseObject(object):
+    import syslog, os
+
+    '''Base class for all classes that use AnsibleModule.
+    Dependencies:
+    - `chrooted` function.
+    '''
+    def __init__(self, module, params=None):
+        syslog.openlog('ansible-{module}-{name}'.format(
+            module=os.path.basename(__file__), name=self.__class__.__name__))
+        self.work_dir = None
+        self.chroot = None
+        self._module = module
+        self._command_prefix = None
+        if params:
+            self._parse_params(params)
+
+    @property
+    def command_prefix(self):
+        return self._command_prefix
+
+    @command_prefix.setter
+    def command_prefix(self, value):
+        self._command_prefix = value
+
+    def run_command(self, command=None, **kwargs):
+        if not 'check_rc' in kwargs:
+            kwargs['check_rc'] = True
+        if command is None and self.command_prefix is None:
+            self.fail('Invalid command')
+        if self.command_prefix:
+            command = '{prefix} {command}'.format(
+                prefix=self.command_prefix, command=command or '')
+        if self.work_dir and not self.chroot:
+            command = 'cd {work_dir}; {command}'.format(
+                work_dir=self.work_dir, command=command)
+        if self.chroot:
+            command = chrooted(command, self.chroot, work_dir=self.work_dir)
+        self.log('Performing command `{}`'.format(command))
+        rc, out, err = self._module.run_command(command, **kwargs)
+        if rc != 0:
+            self.log('Command `{}` returned invalid status code: `{}`'.format(
+                command, rc), level=syslog.LOG_WARNING)
+        return {'rc': rc,
+                'out': out,
+                'out_lines': [line for line in out.split('\n') if line],
+                'err': err,
+                'err_lines': [line for line in out.split('\n') if line]}
+
+    def log(self, msg, level=syslog.LOG_DEBUG):
+        '''Log to the system logging facility of the target system.'''
+        if os.name == 'posix': # syslog is unsupported on Windows.
+            syslog.syslog(level, str(msg))
+
+    def fail(self, msg):
+        self._module.fail_json(msg=msg)
+
+    def exit(self, changed=True, msg='', result=None):
+        self._module.exit_json(changed=changed, msg=msg, result=result)
+
+    def _parse_params(self, params):
+        for param in params:
+            if param in self._module.params:
+                value = self._module.params[param]
+                t = self._module.argument_spec[param].get('type')
+                if t == 'str' and value in ['None', 'none']:
+                    value = None
+                setattr(self, param, value)
+            else:
+                setattr(self, param, None)
+
+def chrooted(command, path, profile='/etc/profile', work_dir=None):
+    prefix = "chroot {path} bash -c 'source {profile}; ".format(
+        path=path, profile=profile)
+    if work_dir:
+        prefix += 'cd {work_dir}; '.format(work_dir=work_dir)
+    prefix += command
+    prefix += "'"
+    return prefix
+
+def _replace_file(tmp_path, path):
+    '''Move the (already synced) `tmp_path` over `path`, keeping its mode.'''
+    if os.path.exists(path):
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    else:
+        os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+
+def atomic_write(path, content):
+    '''Replace the file at `path` with `content`, without leaving it truncated
+    or half-written if something goes wrong.
+    Nothing is written if the file already has that content.
+    Return `True` if the file has been written.
+    '''
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        _replace_file(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+class ConfigEditor(object):
+    '''Edit a line-based configuration file with many rules at once.
+    Each rule is `(regexp, replacement, append_if_missing, template)`: lines
+    matching `regexp` are replaced by `replacement` (`None` removes them),
+    taken literally unless `template` is set (then it's a `re` template). The
+    first matching rule wins. If no line matches a rule with
+    `append_if_missing`, its replacement is appended to the file.
+    The file is read and rewritten in a single streaming pass and replaced
+    atomically, only if its content changes (a missing file is created only
+    if there's something to write).
+    '''
+    def __init__(self, path, rules=None):
+        self.path = path
+        self.rules = []
+        for rule in rules or []:
+            self.rule(*rule)
+
+    def rule(self, regexp, replacement, append_if_missing=False,
+             template=False):
+        self.rules.append((re.compile(regexp), replacement, append_if_missing,
+                           template))
+        return self
+
+    @staticmethod
+    def terminated(line):
+        '''`line` ending with a newline (e.g. the last line of a file).'''
+        if line is None or line.endswith('\n'):
+            return line
+        return line + '\n'
+
+    def edit(self, lines):
+        '''Yield `(old line, new line)` pairs (`None` for missing lines).
+        New lines always end with a newline.
+        '''
+        matched = [False] * len(self.rules)
+        for line in lines:
+            new_line = self.terminated(line)
+            for idx, (regexp, replacement, _, template) in \
+                    enumerate(self.rules):
+                md = regexp.match(line.rstrip('\n'))
+                if md:
+                    matched[idx] = True
+                    if replacement is None:
+                        new_line = None
+                    elif template:
+                        new_line = md.expand(replacement) + '\n'
+                    else:
+                        new_line = replacement + '\n'
+                    break
+            yield line, new_line
+        for idx, (_, replacement, append_if_missing, _) in \
+                enumerate(self.rules):
+            if append_if_missing and not matched[idx] and replacement:
+                yield None, replacement + '\n'
+
+    def apply(self):
+        '''Apply the rules. Return `True` if the file has been changed.'''
+        try:
+            src = open(self.path)
+        except (IOError, OSError):
+            src = None
+        changed = False
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            prefix='.{}.'.format(os.path.basename(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as dst:
+                for old_line, new_line in self.edit(src or []):
+                    # A missing final newline alone isn't a change.
+                    if new_line != self.terminated(old_line):
+                        changed = True
+                    if new_line is not None:
+                        dst.write(new_line)
+                if changed:
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            if changed:
+                _replace_file(tmp_path, self.path)
+            else:
+                os.remove(tmp_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            if src is not None:
+                src.close()
+        return changed
+
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+MAKE_CONF = '/etc/portage/make.conf'
+
+PORTAGE_TMPDIR = '/var/tmp'
+
+# Unit mounting a tmpfs on `PORTAGE_TMPDIR/portage` (systemd).
+TMPFS_UNIT = 'var-tmp-portage.mount'
+
+# `/proc/cpuinfo` flags -> `CPU_FLAGS_X86` values (as `cpuid2cpuflags`).
+CPU_FLAGS_X86 = {
+    '3dnow':            '3dnow',
+    '3dnowext':         '3dnowext',
+    'ace_en':           'padlock',
+    'aes':              'aes',
+    'avx':              'avx',
+    'avx2':             'avx2',
+    'avx512_4fmaps':    'avx512_4fmaps',
+    'avx512_4vnniw':    'avx512_4vnniw',
+    'avx512_bf16':      'avx512_bf16',
+    'avx512_bitalg':    'avx512_bitalg',
+    'avx512_fp16':      'avx512_fp16',
+    'avx512_vbmi2':     'avx512_vbmi2',
+    'avx512_vnni':      'avx512_vnni',
+    'avx512_vpopcntdq': 'avx512_vpopcntdq',
+    'avx512bw':         'avx512bw',
+    'avx512cd':         'avx512cd',
+    'avx512dq':         'avx512dq',
+    'avx512er':         'avx512er',
+    'avx512f':          'avx512f',
+    'avx512ifma':       'avx512ifma',
+    'avx512pf':         'avx512pf',
+    'avx512vbmi':       'avx512vbmi',
+    'avx512vl':         'avx512vl',
+    'avx_vnni':         'avx_vnni',
+    'f16c':             'f16c',
+    'fma':              'fma3',
+    'fma4':             'fma4',
+    'mmx':              'mmx',
+    'mmxext':           'mmxext',
+    'pclmulqdq':        'pclmul',
+    'pni':              'sse3',
+    'popcnt':           'popcnt',
+    'rdrand':           'rdrand',
+    'sha_ni':           'sha',
+    'sse':              'sse',
+    'sse2':             'sse2',
+    'sse4_1':           'sse4_1',
+    'sse4_2':           'sse4_2',
+    'sse4a':            'sse4a',
+    'ssse3':            'ssse3',
+    'vpclmulqdq':       'vpclmulqdq',
+    'xop':              'xop',
+}
+
+SIZE_SUFFIXES = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+# ------------------------------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
+
+def parse_size(size):
+    md = re.match(r'^\s*(\d+)\s*([kmg]?)i?b?\s*$', str(size).lower())
+    if not md:
+        raise ValueError('Invalid size `{}`'.format(size))
+    return int(md.group(1)) * SIZE_SUFFIXES[md.group(2)]
+
+def read_first(paths):
+    '''Content of the first readable file of `paths` (`None` if none).'''
+    for path in paths:
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            pass
+    return None
+
+def cpu_count():
+    '''CPUs usable by this process: affinity mask and cgroup CPU quota.'''
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError: # Python 2.
+        cpus = multiprocessing.cpu_count()
+    quota = None
+    cpu_max = read_first(['/sys/fs/cgroup/cpu.max']) # cgroup v2.
+    if cpu_max and not cpu_max.startswith('max'):
+        limit, period = cpu_max.split()[:2]
+        quota = float(limit) / float(period)
+    else: # cgroup v1.
+        limit = read_first(['/sys/fs/cgroup/cpu/cpu.cfs_quota_us',
+                            '/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_quota_us'])
+        period = read_first(['/sys/fs/cgroup/cpu/cpu.cfs_period_us',
+                             '/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_period_us'])
+        if limit and period and int(limit) > 0:
+            quota = float(limit) / float(period)
+    if quota is not None:
+        cpus = min(cpus, max(1, int(math.ceil(quota))))
+    return cpus
+
+def memory():
+    '''Memory (bytes) usable by this process: total and cgroup limit.'''
+    total = 0
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                total = int(line.split()[1]) * 1024
+                break
+    limit = read_first(['/sys/fs/cgroup/memory.max', # cgroup v2.
+                        '/sys/fs/cgroup/memory/memory.limit_in_bytes'])
+    if limit and limit.isdigit():
+        total = min(total, int(limit))
+    return total
+
+def cpu_flags():
+    '''Flags of the first CPU in `/proc/cpuinfo`.'''
+    with open('/proc/cpuinfo') as f:
+        for line in f:
+            if line.startswith('flags'):
+                return line.split(':', 1)[1].split()
+    return []
+
+def cpu_flags_x86(flags):
+    result = set(CPU_FLAGS_X86[flag] for flag in flags if flag in CPU_FLAGS_X86)
+    if 'sse' in result: # SSE includes the MMX extensions.
+        result.add('mmxext')
+    return sorted(result)
+
+# ------------------------------------------------------------------------------
+# LOGIC ------------------------------------------------------------------------
+
+class PortageTuning(BaseObject):
+    '''Compute the Portage settings suiting the hardware and apply them.'''
+    def __init__(self, module):
+        super(PortageTuning, self).__init__(module,
+            params=['march', 'resolve_march', 'optimization', 'cflags', 'cpu_flags',
+                    'makeopts', 'jobs', 'mem_per_job', 'emerge_jobs',
+                    'tmpfs', 'tmpfs_min_memory', 'tmpfs_ratio', 'systemd',
+                    'activate', 'chroot'])
+        self.root_dir = self.chroot or '/'
+
+    def path(self, path):
+        '''`path` (inside the chroot) as seen from the host.'''
+        return os.path.join(self.root_dir, path.lstrip('/'))
+
+    def settings(self):
+        cpus = cpu_count()
+        mem = memory()
+        # Each job (e.g. a C++ compiler) may need `mem_per_job` of memory.
+        jobs = self.jobs or max(1, min(cpus, mem // parse_size(
+            self.mem_per_job)))
+        emerge_jobs = self.emerge_jobs or max(1, jobs // 4)
+        march = self.march
+        if march == 'native' and self.resolve_march:
+            march = self.native_march()
+        flags = ['-march={}'.format(march), self.optimization, '-pipe']
+        if self.cflags:
+            flags.append(self.cflags)
+        if self.tmpfs == 'auto':
+            use_tmpfs = mem >= parse_size(self.tmpfs_min_memory)
+        else:
+            use_tmpfs = self.tmpfs == 'yes'
+        is_x86 = re.match(r'(i.86|x86_64)$', os.uname()[4]) is not None
+        return {'cpus':          cpus,
+                'memory':        mem,
+                'cflags':        ' '.join(flags),
+                'cpu_flags_x86': (cpu_flags_x86(cpu_flags())
+                                  if self.cpu_flags and is_x86 else None),
+                'jobs':          jobs,
+                'load':          cpus,
+                'emerge_jobs':   emerge_jobs,
+                'tmpfs':         use_tmpfs,
+                'tmpfs_size':    (int(mem * self.tmpfs_ratio)
+                                  if use_tmpfs else None)}
+
+    def native_march(self):
+        '''The CPU `-march=native` stands for, according to `gcc`.'''
+        out = self.run_command('gcc -march=native -Q --help=target')['out']
+        match = re.search(r'^\s*-march=\s+(\S+)\s*$', out, re.MULTILINE)
+        if match is None or match.group(1) == 'native':
+            self.fail('Cannot resolve `-march=native`')
+        return match.group(1)
+
+    def make_conf(self, settings):
+        '''Rules editing `make.conf`.'''
+        editor = ConfigEditor(self.path(MAKE_CONF))
+        try:
+            with open(editor.path) as f:
+                common_flags = any(line.startswith('COMMON_FLAGS=')
+                                   for line in f)
+        except (IOError, OSError):
+            common_flags = False
+        editor.rule(r'COMMON_FLAGS=.*',
+                    'COMMON_FLAGS="{}"'.format(settings['cflags']))
+        # Flags referring to `COMMON_FLAGS` (as in recent stages) are kept.
+        for name in ['CFLAGS', 'CXXFLAGS', 'FCFLAGS', 'FFLAGS']:
+            editor.rule(r'{}=(?!"\$\{{COMMON_FLAGS\}}"$).*'.format(name),
+                        '{}="{}"'.format(name, settings['cflags']),
+                        name in ['CFLAGS', 'CXXFLAGS'] and not common_flags)
+        if settings['cpu_flags_x86'] is not None:
+            editor.rule(r'CPU_FLAGS_X86=.*', 'CPU_FLAGS_X86="{}"'.format(
+                ' '.join(settings['cpu_flags_x86'])), True)
+        if self.makeopts:
+            editor.rule(r'MAKEOPTS=.*', 'MAKEOPTS="-j{} -l{}"'.format(
+                settings['jobs'], settings['load']), True)
+        editor.rule(r'EMERGE_DEFAULT_OPTS="\$\{EMERGE_DEFAULT_OPTS\} --jobs.*',
+                    'EMERGE_DEFAULT_OPTS="${{EMERGE_DEFAULT_OPTS}} '
+                    '--jobs={} --load-average={}"'.format(
+                        settings['emerge_jobs'], settings['load']), True)
+        return editor
+
+    def tmpfs_options(self, settings):
+        return 'size={},mode=775,uid=portage,gid=portage,noatime'.format(
+            settings['tmpfs_size'])
+
+    def setup_tmpfs(self, settings):
+        '''Mount (at boot, and now if `activate`) a tmpfs on the Portage build
+        directory, or stop doing so.
+        Return whether something has been changed.
+        '''
+        mount_point = os.path.join(PORTAGE_TMPDIR, 'portage')
+        changed = False
+        if self.systemd:
+            unit = self.path(os.path.join('/etc/systemd/system', TMPFS_UNIT))
+            wants = self.path(os.path.join(
+                '/etc/systemd/system/local-fs.target.wants', TMPFS_UNIT))
+            if settings['tmpfs']:
+                if not os.path.isdir(os.path.dirname(wants)):
+                    os.makedirs(os.path.dirname(wants))
+                changed = atomic_write(unit, '\n'.join([
+                    '# Written by Ansible (portage_tuning).',
+                    '[Unit]',
+                    'Description=Portage build directory (tmpfs)',
+                    '',
+                    '[Mount]',
+                    'What=tmpfs',
+                    'Where={}'.format(mount_point),
+                    'Type=tmpfs',
+                    'Options={}'.format(self.tmpfs_options(settings)),
+                    '']))
+                if not os.path.lexists(wants):
+                    os.symlink(os.path.join('..', TMPFS_UNIT), wants)
+                    changed = True
+            else:
+                for path in [wants, unit]:
+                    if os.path.lexists(path):
+                        os.remove(path)
+                        changed = True
+        else:
+            fstab = ConfigEditor(self.path('/etc/fstab')).rule(
+                r'\S+\s+{}\s+tmpfs\s.*'.format(re.escape(mount_point)),
+                ('tmpfs {} tmpfs {} 0 0'.format(
+                    mount_point, self.tmpfs_options(settings))
+                 if settings['tmpfs'] else None), True)
+            changed = fstab.apply()
+
+        build_dir = self.path(mount_point)
+        if settings['tmpfs'] and self.activate and \
+           not os.path.ismount(build_dir):
+            if not os.path.isdir(build_dir):
+                os.makedirs(build_dir)
+            # The `portage` user is resolved inside the chroot.
+            self.run_command('mount -t tmpfs -o {} tmpfs {}'.format(
+                self.tmpfs_options(settings), mount_point))
+            changed = True
+        return changed
+
+    def run(self):
+        settings = self.settings()
+        editor = self.make_conf(settings)
+        try:
+            with open(editor.path) as f:
+                changes = [{'old': (old or '').rstrip('\n') or None,
+                            'new': (new or '').rstrip('\n') or None}
+                           for old, new in editor.edit(f)
+                           if new != editor.terminated(old)]
+        except (IOError, OSError):
+            changes = [{'old': None, 'new': new.rstrip('\n')}
+                       for _, new in editor.edit([])]
+        changed = editor.apply()
+        changed = self.setup_tmpfs(settings) or changed
+        return changed, {'settings': settings, 'changes': changes}
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    module = AnsibleModule(argument_spec={
+        'march':            {'type': 'str', 'required': False,
+                             'default': 'native'},
+        # Replace `native` with the detected CPU.
+        'resolve_march':    {'type': 'bool', 'required': False,
+                             'default': False},
+        'optimization':     {'type': 'str', 'required': False,
+                             'default': '-O2'},
+        # Additional compiler flags.
+        'cflags':           {'type': 'str', 'required': False,
+                             'default': None},
+        'cpu_flags':        {'type': 'bool', 'required': False,
+                             'default': True},
+        'makeopts':         {'type': 'bool', 'required': False,
+                             'default': True},
+        'jobs':             {'type': 'int', 'required': False,
+                             'default': None},
+        'mem_per_job':      {'type': 'str', 'required': False,
+                             'default': '2G'},
+        'emerge_jobs':      {'type': 'int', 'required': False,
+                             'default': None},
+        'tmpfs':            {'choices': ['auto', 'yes', 'no'],
+                             'required': False, 'default': 'auto'},
+        'tmpfs_min_memory': {'type': 'str', 'required': False,
+                             'default': '12G'},
+        'tmpfs_ratio':      {'type': 'float', 'required': False,
+                             'default': 0.5},
+        'systemd':          {'type': 'bool', 'required': False,
+                             'default': True},
+        'activate':         {'type': 'bool', 'required': False,
+                             'default': True},
+        'chroot':           {'type': 'str', 'required': False,
+                             'default': None},
+    })
+
+    portage_tuning = PortageTuning(module)
+    changed, result = portage_tuning.run()
+    module.exit_json(changed=changed, msg='Portage tuned', result=result)
+
+# ------------------------------------------------------------------------------
+# ENTRY POINT ------------------------------------------------------------------
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
@@ -0,0 +1,414 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import hashlib, os, re, sys, threading, time
+
+PY3K = sys.version_info >= (3, 0)
+
+if PY3K:
+    from urllib.request import urlopen as url_open
+    from queue import Queue, Empty
+else:
+    from urllib2 import urlopen as url_open
+    from Queue import Queue, Empty
+
+# ------------------------------------------------------------------------------
+# MODULE INFORMATIONS ----------------------------------------------------------
+
+DOCUMENTATION = '''
+---
+module: prefetch_distfiles
+short_description: Download the distfiles of packages ahead of `emerge`
+description:
+    - The files to fetch for `packages` are listed by `emerge --pretend
+      --fetchonly` and their sizes and checksums are read from the Manifests
+      of the packages to merge.
+    - They're downloaded concurrently into `DISTDIR`, spread across the
+      (ranked) Gentoo `mirrors` and falling back to the next mirrors and to
+      the upstream URIs. Each file is verified before being moved in place,
+      so `emerge` never sees partial or corrupted files.
+    - Meant to run in the background (`async`) while something else builds.
+author:
+    - "Alessandro Molari"
+'''
+
+EXAMPLES = '''
+- name: Prefetch distfiles
+  prefetch_distfiles:
+    packages:    ["@system", "@world"]
+    emerge_opts: --update --newuse --deep
+    mirrors:     "{{ mirror_urls }}"
+    chroot:      /mnt/gentoo
+  async: 7200
+  poll:  0
+  register: _prefetch
+
+# ... Build something else ...
+
+- name: Wait for the distfiles
+  async_status:
+    jid: "{{ _prefetch.ansible_job_id }}"
+  register: _output
+  until: _output.finished
+  retries: 720
+  delay: 10
+'''
+
+# ------------------------------------------------------------------------------
+# COMMONS (copy&paste) ---------------------------------------------------------
+
+class BaseObject(object):
+    import syslog, os
+
+    '''Base class for all classes that use AnsibleModule.
+    Dependencies:
+    - `chrooted` function.
+    '''
+    def __init__(self, module, params=None):
+        syslog.openlog('ansible-{module}-{name}'.format(
+            module=os.path.basename(__file__), name=self.__class__.__name__))
+        self.work_dir = None
+        self.chroot = None
+        self._module = module
+        self._command_prefix = None
+        if params:
+            self._parse_params(params)
+
+    @property
+    def command_prefix(self):
+        return self._command_prefix
+
+    @command_prefix.setter
+    def command_prefix(self, value):
+        self._command_prefix = value
+
+    def run_command(self, command=None, **kwargs):
+        if not 'check_rc' in kwargs:
+            kwargs['check_rc'] = True
+        if command is None and self.command_prefix is None:
+            self.fail('Invalid command')
+        if self.command_prefix:
+            command = '{prefix} {command}'.format(
+                prefix=self.command_prefix, command=command or '')
+        if self.work_dir and not self.chroot:
+            command = 'cd {work_dir}; {command}'.format(
+                work_dir=self.work_dir, command=command)
+        if self.chroot:
+            command = chrooted(command, self.chroot, work_dir=self.work_dir)
+        self.log('Performing command `{}`'.format(command))
+        rc, out, err = self._module.run_command(command, **kwargs)
+        if rc != 0:
+            self.log('Command `{}` returned invalid status code: `{}`'.format(
+                command, rc), level=syslog.LOG_WARNING)
+        return {'rc': rc,
+                'out': out,
+                'out_lines': [line for line in out.split('\n') if line],
+                'err': err,
+                'err_lines': [line for line in out.split('\n') if line]}
+
+    def log(self, msg, level=syslog.LOG_DEBUG):
+        '''Log to the system logging facility of the target system.'''
+        if os.name == 'posix': # syslog is unsupported on Windows.
+            syslog.syslog(level, str(msg))
+
+    def fail(self, msg):
+        self._module.fail_json(msg=msg)
+
+    def exit(self, changed=True, msg='', result=None):
+        self._module.exit_json(changed=changed, msg=msg, result=result)
+
+    def _parse_params(self, params):
+        for param in params:
+            if param in self._module.params:
+                value = self._module.params[param]
+                t = self._module.argument_spec[param].get('type')
+                if t == 'str' and value in ['None', 'none']:
+                    value = None
+                setattr(self, param, value)
+            else:
+                setattr(self, param, None)
+
+def chrooted(command, path, profile='/etc/profile', work_dir=None):
+    prefix = "chroot {path} bash -c 'source {profile}; ".format(
+        path=path, profile=profile)
+    if work_dir:
+        prefix += 'cd {work_dir}; '.format(work_dir=work_dir)
+    prefix += command
+    prefix += "'"
+    return prefix
+
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+# Packages to merge in `emerge --pretend --verbose` (with their repository).
+MERGE_REGEXP = re.compile(
+    r'^\[ebuild[^\]]*\]\s+(?P<cpv>[^\s:]+)(?:::(?P<repo>\S+))?')
+
+URI_REGEXP = re.compile(r'^(https?|ftp)://\S+(\s+(https?|ftp)://\S+)*$')
+
+CPV_REGEXP = re.compile(r'^(?P<cp>.+?)-\d[^-]*(?:-r\d+)?$')
+
+# Hashes verified (when in the Manifest), strongest first.
+HASHES = [('BLAKE2B', 'blake2b'), ('SHA512', 'sha512'), ('SHA256', 'sha256')]
+
+CHUNK_SIZE = 1024 * 1024
+
+TIMEOUT = 60
+
+# ------------------------------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
+
+def parse_manifest(path):
+    '''`DIST` entries of the Manifest at `path`, as
+    `{name: {'size': size, 'hashes': {hash name: value}}}`.
+    '''
+    entries = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3 and fields[0] == 'DIST':
+                    entries[fields[1]] = {
+                        'size':   int(fields[2]),
+                        'hashes': dict(zip(fields[3::2], fields[4::2]))}
+    except (IOError, OSError):
+        pass
+    return entries
+
+def hashlib_algorithms():
+    return getattr(hashlib, 'algorithms_available',
+                   getattr(hashlib, 'algorithms', ()))
+
+def mirror_uris(mirror, name):
+    '''URIs of `name` on the Gentoo `mirror`: in the hashed layout (see
+    `layout.conf`, `filename-hash BLAKE2B 8`), then in the flat one.
+    '''
+    base = '{}/distfiles'.format(mirror.rstrip('/'))
+    uris = []
+    if hasattr(hashlib, 'blake2b'):
+        uris.append('{}/{}/{}'.format(
+            base, hashlib.blake2b(name.encode('utf-8')).hexdigest()[:2], name))
+    uris.append('{}/{}'.format(base, name))
+    return uris
+
+# ------------------------------------------------------------------------------
+# LOGIC ------------------------------------------------------------------------
+
+class DistfilesPrefetcher(BaseObject):
+    '''Download the distfiles of `packages` into `DISTDIR`.'''
+    def __init__(self, module):
+        super(DistfilesPrefetcher, self).__init__(module,
+            params=['packages', 'emerge_opts', 'mirrors', 'upstream',
+                    'concurrency', 'distdir', 'chroot'])
+        self.root_dir = self.chroot or '/'
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def path(self, path):
+        '''`path` (inside the chroot) as seen from the host.'''
+        return os.path.join(self.root_dir, path.lstrip('/'))
+
+    def emerge(self, opts):
+        return self.run_command('emerge --pretend --color=n {} {} {}'.format(
+            opts, self.emerge_opts or '', ' '.join(self.packages)))['out_lines']
+
+    def manifests(self):
+        '''`DIST` entries of the Manifests of the packages to merge.'''
+        repos = self.run_command('portageq get_repos /')['out'].split()
+        paths = self.run_command('portageq get_repo_path / {}'.format(
+            ' '.join(repos)))['out_lines']
+        locations = dict(zip(repos, paths))
+        entries = {}
+        for line in self.emerge('--verbose'):
+            md = MERGE_REGEXP.match(line)
+            cp = md and CPV_REGEXP.match(md.group('cpv'))
+            if not cp:
+                continue
+            repo_locations = ([locations[md.group('repo')]]
+                              if md.group('repo') in locations
+                              else locations.values())
+            for location in repo_locations:
+                manifest = self.path(os.path.join(location, cp.group('cp'),
+                                                  'Manifest'))
+                if os.path.exists(manifest):
+                    entries.update(parse_manifest(manifest))
+                    break
+        return entries
+
+    def fetch_list(self, manifests):
+        '''Files to fetch, as `[(name, Manifest entry, upstream URIs)]`.'''
+        files = {}
+        for line in self.emerge('--fetchonly'):
+            if not URI_REGEXP.match(line.strip()):
+                continue
+            uris = line.split()
+            names = [uri.rstrip('/').rsplit('/', 1)[-1] for uri in uris]
+            name = next((name for name in names if name in manifests),
+                        names[0])
+            upstream = [uri for uri in uris if not any(
+                uri.startswith(mirror.rstrip('/') + '/')
+                for mirror in self.mirrors)]
+            files[name] = (manifests.get(name), upstream)
+        # Largest first, so they don't end the prefetch alone.
+        return sorted(((name, entry, upstream)
+                       for name, (entry, upstream) in files.items()),
+                      key=lambda f: -(f[1] or {'size': 0})['size'])
+
+    def download(self, uri, name, entry, distdir):
+        '''Download `uri` as `name` and verify it against `entry`.
+        Return the downloaded bytes, or raise `IOError`.
+        '''
+        hashes = [(manifest_name, hashlib.new(algorithm))
+                  for manifest_name, algorithm in HASHES
+                  if entry and manifest_name in entry['hashes'] and
+                     algorithm in hashlib_algorithms()][:1]
+        tmp_path = os.path.join(distdir, '.{}.prefetch'.format(name))
+        size = 0
+        try:
+            response = url_open(uri, timeout=TIMEOUT)
+            try:
+                with open(tmp_path, 'wb') as f:
+                    while True:
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        size += len(chunk)
+                        for _, digest in hashes:
+                            digest.update(chunk)
+            finally:
+                response.close()
+            if entry and size != entry['size']:
+                raise IOError('size {} != {}'.format(size, entry['size']))
+            for manifest_name, digest in hashes:
+                if digest.hexdigest() != entry['hashes'][manifest_name]:
+                    raise IOError('{} mismatch'.format(manifest_name))
+            os.rename(tmp_path, os.path.join(distdir, name))
+        except Exception as err:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise IOError(str(err))
+        return size
+
+    def fetch(self, idx, name, entry, upstream, distdir):
+        '''Fetch `name`, starting from the `idx`-th mirror (to spread the
+        files across the mirrors). Return the error if it can't be fetched.
+        '''
+        mirrors = list(self.mirrors)
+        if mirrors:
+            idx %= len(mirrors)
+            mirrors = mirrors[idx:] + mirrors[:idx]
+        sources = [(mirror, uri) for mirror in mirrors
+                   for uri in mirror_uris(mirror, name)]
+        if self.upstream:
+            sources += [('upstream', uri) for uri in upstream]
+        errors = []
+        for source, uri in sources:
+            start = time.time()
+            try:
+                size = self.download(uri, name, entry, distdir)
+            except IOError as err:
+                errors.append('{}: {}'.format(uri, err))
+                continue
+            with self._lock:
+                stats = self._stats.setdefault(source, {'files': 0,
+                                                        'bytes': 0,
+                                                        'seconds': 0})
+                stats['files'] += 1
+                stats['bytes'] += size
+                stats['seconds'] = round(stats['seconds'] +
+                                         time.time() - start, 1)
+            return None
+        return '; '.join(errors) or 'no source'
+
+    def run(self):
+        distdir = self.path(self.distdir or
+                            self.run_command('portageq distdir')['out'].strip())
+        if not os.path.isdir(distdir):
+            os.makedirs(distdir)
+        files = self.fetch_list(self.manifests())
+
+        queue = Queue()
+        skipped = []
+        for idx, (name, entry, upstream) in enumerate(files):
+            path = os.path.join(distdir, name)
+            if os.path.exists(path) and \
+               (not entry or os.path.getsize(path) == entry['size']):
+                skipped.append(name)
+            else:
+                queue.put((idx, name, entry, upstream))
+        failed = {}
+        unverified = [name for name, entry, _ in files if not entry]
+
+        def worker():
+            while True:
+                try:
+                    item = queue.get_nowait()
+                except Empty:
+                    return
+                error = self.fetch(item[0], *item[1:], distdir=distdir)
+                if error:
+                    with self._lock:
+                        failed[item[1]] = error
+
+        start = time.time()
+        threads = [threading.Thread(target=worker)
+                   for _ in range(max(1, self.concurrency))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = round(time.time() - start, 1)
+
+        downloaded = sum(stats['bytes'] for stats in self._stats.values())
+        return {'distdir':    distdir,
+                'files':      len(files),
+                'skipped':    len(skipped),
+                'downloaded': sum(stats['files']
+                                  for stats in self._stats.values()),
+                'bytes':      downloaded,
+                'seconds':    seconds,
+                'throughput': int(downloaded / seconds) if seconds else None,
+                'sources':    self._stats,
+                'unverified': unverified,
+                'failed':     failed}
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    module = AnsibleModule(argument_spec={
+        'packages':    {'type': 'list', 'required': False,
+                        'default': ['@world']},
+        'emerge_opts': {'type': 'str', 'required': False,
+                        'default': '--update --newuse --deep'},
+        # Gentoo mirrors (base URLs), best first.
+        'mirrors':     {'type': 'list', 'required': False, 'default': []},
+        # Fall back to the upstream URIs.
+        'upstream':    {'type': 'bool', 'required': False, 'default': True},
+        # Parallel downloads.
+        'concurrency': {'type': 'int', 'required': False, 'default': 8},
+        # Default: Portage `DISTDIR`.
+        'distdir':     {'type': 'str', 'required': False, 'default': None},
+        'chroot':      {'type': 'str', 'required': False, 'default': None},
+    })
+
+    prefetcher = DistfilesPrefetcher(module)
+    result = prefetcher.run()
+    module.exit_json(changed=result['downloaded'] > 0,
+                     msg='Distfiles prefetched', result=result)
+
+# ------------------------------------------------------------------------------
+# ENTRY POINT ------------------------------------------------------------------
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
@@ -4,14 +4,15 @@
 # ------------------------------------------------------------------------------
 # IMPORTS ----------------------------------------------------------------------
 
-import copy, json, sys, xml.etree.ElementTree
+import copy, csv, mmap, os, socket, struct, sys, tempfile
+import xml.etree.ElementTree
 
 PY3K = sys.version_info >= (3, 0)
 
 if PY3K:
     from urllib.request import urlopen as url_open
 else:
-    from urllib import urlopen as url_open
+    from urllib2 import urlopen as url_open
 
 # ------------------------------------------------------------------------------
 # MODULE INFORMATIONS ----------------------------------------------------------
@@ -20,12 +21,34 @@ DOCUMENTATION = '''
 ---
 module: select_mirror
 short_description: Select a Gentoo mirror
+description:
+    - When `geo_loc` is enabled, the country of the target is found with an
+      offline GeoIP database (`geoip_db`) and a local table of countries, so
+      no external service is contacted.
+    - The GeoIP database is (re)built from `geoip_csv` when it's missing or
+      older than it. The CSV rows are `<first IP>,<last IP>,<country code>`
+      (IPs can be dotted or integers), as in the free DB-IP / IP2Location
+      "lite" country databases. Only IPv4 ranges are used.
+    - If the target can't be geo-located (e.g. there is no GeoIP database or
+      it's behind NAT and `ip` isn't provided) the mirrors aren't filtered by
+      location and a warning is reported.
 author:
     - "Alessandro Molari"
 '''
 
 EXAMPLES = '''
-TODO
+# Select a mirror near the public IP address of the target.
+- name: Select the Gentoo mirror
+  select_mirror:
+    geo_loc:   true
+    geoip_csv: /root/ip-country.csv
+
+# Same, for a target behind NAT whose public IP address is known.
+- name: Select the Gentoo mirror
+  select_mirror:
+    geo_loc: true
+    ip:      203.0.113.7
+    proto:   https
 '''
 
 # ------------------------------------------------------------------------------
@@ -33,15 +56,369 @@ TODO
 
 MIRRORS_XML = 'http://www.gentoo.org/main/en/mirrors3.xml'
 
+GEOIP_DB = '/var/lib/select_mirror/ip-country.db'
+
+# Seconds to wait for the mirrors list.
+URL_TIMEOUT = 30
+
+# How many borders away from the country mirrors are looked for, before
+# falling back to the whole region.
+MAX_NEIGHBOR_DISTANCE = 2
+
+# Protocols of the mirrors, the preferred first.
+PROTOCOLS = ['https', 'http', 'ftp', 'rsync']
+
+# IPv4 ranges that can't be geo-located.
+PRIVATE_NETWORKS = [('10.0.0.0', 8), ('100.64.0.0', 10), ('127.0.0.0', 8),
+                    ('169.254.0.0', 16), ('172.16.0.0', 12),
+                    ('192.168.0.0', 16)]
+
+# Country code -> (name, region, neighbor country codes).
+# Regions are the ones used by the Gentoo mirrors list.
+COUNTRIES = {
+    # Europe.
+    'AD': ('Andorra', 'Europe', ['ES', 'FR']),
+    'AL': ('Albania', 'Europe', ['GR', 'ME', 'MK', 'XK']),
+    'AT': ('Austria', 'Europe', ['CH', 'CZ', 'DE', 'HU', 'IT', 'LI', 'SI',
+                                 'SK']),
+    'BA': ('Bosnia and Herzegovina', 'Europe', ['HR', 'ME', 'RS']),
+    'BE': ('Belgium', 'Europe', ['DE', 'FR', 'LU', 'NL']),
+    'BG': ('Bulgaria', 'Europe', ['GR', 'MK', 'RO', 'RS', 'TR']),
+    'BY': ('Belarus', 'Europe', ['LT', 'LV', 'PL', 'RU', 'UA']),
+    'CH': ('Switzerland', 'Europe', ['AT', 'DE', 'FR', 'IT', 'LI']),
+    'CY': ('Cyprus', 'Europe', []),
+    'CZ': ('Czech Republic', 'Europe', ['AT', 'DE', 'PL', 'SK']),
+    'DE': ('Germany', 'Europe', ['AT', 'BE', 'CH', 'CZ', 'DK', 'FR', 'LU',
+                                 'NL', 'PL']),
+    'DK': ('Denmark', 'Europe', ['DE']),
+    'EE': ('Estonia', 'Europe', ['LV', 'RU']),
+    'ES': ('Spain', 'Europe', ['AD', 'FR', 'MA', 'PT']),
+    'FI': ('Finland', 'Europe', ['NO', 'RU', 'SE']),
+    'FR': ('France', 'Europe', ['AD', 'BE', 'CH', 'DE', 'ES', 'IT', 'LU',
+                                'MC']),
+    'GB': ('United Kingdom', 'Europe', ['IE']),
+    'GR': ('Greece', 'Europe', ['AL', 'BG', 'MK', 'TR']),
+    'HR': ('Croatia', 'Europe', ['BA', 'HU', 'ME', 'RS', 'SI']),
+    'HU': ('Hungary', 'Europe', ['AT', 'HR', 'RO', 'RS', 'SI', 'SK', 'UA']),
+    'IE': ('Ireland', 'Europe', ['GB']),
+    'IS': ('Iceland', 'Europe', []),
+    'IT': ('Italy', 'Europe', ['AT', 'CH', 'FR', 'SI', 'SM', 'VA']),
+    'LI': ('Liechtenstein', 'Europe', ['AT', 'CH']),
+    'LT': ('Lithuania', 'Europe', ['BY', 'LV', 'PL', 'RU']),
+    'LU': ('Luxembourg', 'Europe', ['BE', 'DE', 'FR']),
+    'LV': ('Latvia', 'Europe', ['BY', 'EE', 'LT', 'RU']),
+    'MC': ('Monaco', 'Europe', ['FR']),
+    'MD': ('Moldova', 'Europe', ['RO', 'UA']),
+    'ME': ('Montenegro', 'Europe', ['AL', 'BA', 'HR', 'RS', 'XK']),
+    'MK': ('North Macedonia', 'Europe', ['AL', 'BG', 'GR', 'RS', 'XK']),
+    'MT': ('Malta', 'Europe', []),
+    'NL': ('Netherlands', 'Europe', ['BE', 'DE']),
+    'NO': ('Norway', 'Europe', ['FI', 'RU', 'SE']),
+    'PL': ('Poland', 'Europe', ['BY', 'CZ', 'DE', 'LT', 'RU', 'SK', 'UA']),
+    'PT': ('Portugal', 'Europe', ['ES']),
+    'RO': ('Romania', 'Europe', ['BG', 'HU', 'MD', 'RS', 'UA']),
+    'RS': ('Serbia', 'Europe', ['BA', 'BG', 'HR', 'HU', 'ME', 'MK', 'RO',
+                                'XK']),
+    'RU': ('Russia', 'Europe', ['AZ', 'BY', 'CN', 'EE', 'FI', 'GE', 'KP', 'KZ',
+                                'LT', 'LV', 'MN', 'NO', 'PL', 'UA']),
+    'SE': ('Sweden', 'Europe', ['FI', 'NO']),
+    'SI': ('Slovenia', 'Europe', ['AT', 'HR', 'HU', 'IT']),
+    'SK': ('Slovakia', 'Europe', ['AT', 'CZ', 'HU', 'PL', 'UA']),
+    'SM': ('San Marino', 'Europe', ['IT']),
+    'TR': ('Turkey', 'Europe', ['AM', 'AZ', 'BG', 'GE', 'GR', 'IQ', 'IR',
+                                'SY']),
+    'UA': ('Ukraine', 'Europe', ['BY', 'HU', 'MD', 'PL', 'RO', 'RU', 'SK']),
+    'VA': ('Vatican City', 'Europe', ['IT']),
+    'XK': ('Kosovo', 'Europe', ['AL', 'ME', 'MK', 'RS']),
+    # North America.
+    'BZ': ('Belize', 'North America', ['GT', 'MX']),
+    'CA': ('Canada', 'North America', ['US']),
+    'CR': ('Costa Rica', 'North America', ['NI', 'PA']),
+    'GT': ('Guatemala', 'North America', ['BZ', 'HN', 'MX', 'SV']),
+    'HN': ('Honduras', 'North America', ['GT', 'NI', 'SV']),
+    'MX': ('Mexico', 'North America', ['BZ', 'GT', 'US']),
+    'NI': ('Nicaragua', 'North America', ['CR', 'HN']),
+    'PA': ('Panama', 'North America', ['CO', 'CR']),
+    'SV': ('El Salvador', 'North America', ['GT', 'HN']),
+    'US': ('United States', 'North America', ['CA', 'MX']),
+    # South America.
+    'AR': ('Argentina', 'South America', ['BO', 'BR', 'CL', 'PY', 'UY']),
+    'BO': ('Bolivia', 'South America', ['AR', 'BR', 'CL', 'PE', 'PY']),
+    'BR': ('Brazil', 'South America', ['AR', 'BO', 'CO', 'GF', 'GY', 'PE',
+                                       'PY', 'SR', 'UY', 'VE']),
+    'CL': ('Chile', 'South America', ['AR', 'BO', 'PE']),
+    'CO': ('Colombia', 'South America', ['BR', 'EC', 'PA', 'PE', 'VE']),
+    'EC': ('Ecuador', 'South America', ['CO', 'PE']),
+    'GF': ('French Guiana', 'South America', ['BR', 'SR']),
+    'GY': ('Guyana', 'South America', ['BR', 'SR', 'VE']),
+    'PE': ('Peru', 'South America', ['BO', 'BR', 'CL', 'CO', 'EC']),
+    'PY': ('Paraguay', 'South America', ['AR', 'BO', 'BR']),
+    'SR': ('Suriname', 'South America', ['BR', 'GF', 'GY']),
+    'UY': ('Uruguay', 'South America', ['AR', 'BR']),
+    'VE': ('Venezuela', 'South America', ['BR', 'CO', 'GY']),
+    # Asia.
+    'AF': ('Afghanistan', 'Asia', ['CN', 'IR', 'PK', 'TJ', 'TM', 'UZ']),
+    'AM': ('Armenia', 'Asia', ['AZ', 'GE', 'IR', 'TR']),
+    'AZ': ('Azerbaijan', 'Asia', ['AM', 'GE', 'IR', 'RU', 'TR']),
+    'BD': ('Bangladesh', 'Asia', ['IN', 'MM']),
+    'BN': ('Brunei', 'Asia', ['MY']),
+    'BT': ('Bhutan', 'Asia', ['CN', 'IN']),
+    'CN': ('China', 'Asia', ['AF', 'BT', 'HK', 'IN', 'KG', 'KP', 'KZ', 'LA',
+                             'MM', 'MN', 'MO', 'NP', 'PK', 'RU', 'TJ', 'VN']),
+    'GE': ('Georgia', 'Asia', ['AM', 'AZ', 'RU', 'TR']),
+    'HK': ('Hong Kong', 'Asia', ['CN']),
+    'ID': ('Indonesia', 'Asia', ['MY', 'PG', 'TL']),
+    'IN': ('India', 'Asia', ['BD', 'BT', 'CN', 'MM', 'NP', 'PK']),
+    'JP': ('Japan', 'Asia', []),
+    'KG': ('Kyrgyzstan', 'Asia', ['CN', 'KZ', 'TJ', 'UZ']),
+    'KH': ('Cambodia', 'Asia', ['LA', 'TH', 'VN']),
+    'KP': ('North Korea', 'Asia', ['CN', 'KR', 'RU']),
+    'KR': ('South Korea', 'Asia', ['KP']),
+    'KZ': ('Kazakhstan', 'Asia', ['CN', 'KG', 'RU', 'TM', 'UZ']),
+    'LA': ('Laos', 'Asia', ['CN', 'KH', 'MM', 'TH', 'VN']),
+    'LK': ('Sri Lanka', 'Asia', []),
+    'MM': ('Myanmar', 'Asia', ['BD', 'CN', 'IN', 'LA', 'TH']),
+    'MN': ('Mongolia', 'Asia', ['CN', 'RU']),
+    'MO': ('Macao', 'Asia', ['CN']),
+    'MY': ('Malaysia', 'Asia', ['BN', 'ID', 'TH']),
+    'NP': ('Nepal', 'Asia', ['CN', 'IN']),
+    'PH': ('Philippines', 'Asia', []),
+    'PK': ('Pakistan', 'Asia', ['AF', 'CN', 'IN', 'IR']),
+    'SG': ('Singapore', 'Asia', []),
+    'TH': ('Thailand', 'Asia', ['KH', 'LA', 'MM', 'MY']),
+    'TJ': ('Tajikistan', 'Asia', ['AF', 'CN', 'KG', 'UZ']),
+    'TL': ('Timor-Leste', 'Asia', ['ID']),
+    'TM': ('Turkmenistan', 'Asia', ['AF', 'IR', 'KZ', 'UZ']),
+    'TW': ('Taiwan', 'Asia', []),
+    'UZ': ('Uzbekistan', 'Asia', ['AF', 'KG', 'KZ', 'TJ', 'TM']),
+    'VN': ('Vietnam', 'Asia', ['CN', 'KH', 'LA']),
+    # Middle East.
+    'AE': ('United Arab Emirates', 'Middle East', ['OM', 'SA']),
+    'IL': ('Israel', 'Middle East', ['EG', 'JO', 'LB', 'PS', 'SY']),
+    'IQ': ('Iraq', 'Middle East', ['IR', 'JO', 'KW', 'SA', 'SY', 'TR']),
+    'IR': ('Iran', 'Middle East', ['AF', 'AM', 'AZ', 'IQ', 'PK', 'TM', 'TR']),
+    'JO': ('Jordan', 'Middle East', ['IL', 'IQ', 'PS', 'SA', 'SY']),
+    'KW': ('Kuwait', 'Middle East', ['IQ', 'SA']),
+    'LB': ('Lebanon', 'Middle East', ['IL', 'SY']),
+    'OM': ('Oman', 'Middle East', ['AE', 'SA', 'YE']),
+    'PS': ('Palestine', 'Middle East', ['EG', 'IL', 'JO']),
+    'QA': ('Qatar', 'Middle East', ['SA']),
+    'SA': ('Saudi Arabia', 'Middle East', ['AE', 'IQ', 'JO', 'KW', 'OM', 'QA',
+                                           'YE']),
+    'SY': ('Syria', 'Middle East', ['IL', 'IQ', 'JO', 'LB', 'TR']),
+    'YE': ('Yemen', 'Middle East', ['OM', 'SA']),
+    # Australia.
+    'AU': ('Australia', 'Australia', []),
+    'NC': ('New Caledonia', 'Australia', []),
+    'NZ': ('New Zealand', 'Australia', []),
+    'PG': ('Papua New Guinea', 'Australia', ['ID']),
+    # Africa.
+    'BJ': ('Benin', 'Africa', ['NE', 'NG']),
+    'BW': ('Botswana', 'Africa', ['NA', 'ZA', 'ZW']),
+    'CM': ('Cameroon', 'Africa', ['NG', 'TD']),
+    'DZ': ('Algeria', 'Africa', ['EH', 'LY', 'MA', 'ML', 'MR', 'NE', 'TN']),
+    'EG': ('Egypt', 'Africa', ['IL', 'LY', 'PS', 'SD']),
+    'EH': ('Western Sahara', 'Africa', ['DZ', 'MA', 'MR']),
+    'ET': ('Ethiopia', 'Africa', ['KE', 'SD', 'SO', 'SS']),
+    'KE': ('Kenya', 'Africa', ['ET', 'SO', 'SS', 'TZ', 'UG']),
+    'LS': ('Lesotho', 'Africa', ['ZA']),
+    'LY': ('Libya', 'Africa', ['DZ', 'EG', 'NE', 'SD', 'TD', 'TN']),
+    'MA': ('Morocco', 'Africa', ['DZ', 'EH', 'ES']),
+    'ML': ('Mali', 'Africa', ['DZ', 'MR', 'NE']),
+    'MR': ('Mauritania', 'Africa', ['DZ', 'EH', 'ML']),
+    'MZ': ('Mozambique', 'Africa', ['SZ', 'TZ', 'ZA', 'ZW']),
+    'NA': ('Namibia', 'Africa', ['BW', 'ZA']),
+    'NE': ('Niger', 'Africa', ['BJ', 'DZ', 'LY', 'ML', 'NG', 'TD']),
+    'NG': ('Nigeria', 'Africa', ['BJ', 'CM', 'NE', 'TD']),
+    'SD': ('Sudan', 'Africa', ['EG', 'ET', 'LY', 'SS', 'TD']),
+    'SO': ('Somalia', 'Africa', ['ET', 'KE']),
+    'SS': ('South Sudan', 'Africa', ['ET', 'KE', 'SD', 'UG']),
+    'SZ': ('Eswatini', 'Africa', ['MZ', 'ZA']),
+    'TD': ('Chad', 'Africa', ['CM', 'LY', 'NE', 'NG', 'SD']),
+    'TN': ('Tunisia', 'Africa', ['DZ', 'LY']),
+    'TZ': ('Tanzania', 'Africa', ['KE', 'MZ', 'UG']),
+    'UG': ('Uganda', 'Africa', ['KE', 'SS', 'TZ']),
+    'ZA': ('South Africa', 'Africa', ['BW', 'LS', 'MZ', 'NA', 'SZ', 'ZW']),
+    'ZW': ('Zimbabwe', 'Africa', ['BW', 'MZ', 'ZA']),
+}
+
 # ------------------------------------------------------------------------------
-# MIRROR INFORMATIONS ----------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
+
+def ip_to_int(ip):
+    '''Convert a dotted (or integer) IPv4 address to an integer.
+    Return `None` for anything else (e.g. IPv6 addresses).
+    '''
+    ip = str(ip).strip()
+    if ip.isdigit():
+        return int(ip) if int(ip) < 2 ** 32 else None
+    if ip.count('.') != 3:
+        return None
+    try:
+        return struct.unpack('>I', socket.inet_aton(ip))[0]
+    except socket.error:
+        return None
+
+def is_private(ip):
+    value = ip_to_int(ip)
+    for network, prefix in PRIVATE_NETWORKS:
+        if value >> (32 - prefix) == ip_to_int(network) >> (32 - prefix):
+            return True
+    return False
+
+def neighbor_distances(code, max_distance=MAX_NEIGHBOR_DISTANCE):
+    '''Borders away from the country `code` of the countries up to
+    `max_distance` borders away (breadth-first visit of the neighbors).
+    '''
+    distances = {code: 0}
+    frontier = [code]
+    for distance in range(1, max_distance + 1):
+        next_frontier = []
+        for country in frontier:
+            for neighbor in COUNTRIES.get(country, (None, None, []))[2]:
+                if neighbor not in distances:
+                    distances[neighbor] = distance
+                    next_frontier.append(neighbor)
+        frontier = next_frontier
+    return distances
+
+def own_ip():
+    '''IP address used by this host to reach the Internet (the controller,
+    when resolved by the `select_mirror` action plugin).
+    Connecting an UDP socket only selects the route: no packet is sent.
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(('192.0.2.1', 53))
+        return sock.getsockname()[0]
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+
+# ------------------------------------------------------------------------------
+# GEOIP DATABASE ---------------------------------------------------------------
+
+class GeoIPDatabase(object):
+    '''Map IPv4 addresses to country codes.
+    The database file is a sorted array of non-overlapping fixed-size
+    `(first IP, last IP, country code)` records, memory-mapped and searched
+    with a binary search: it's never loaded entirely.
+    '''
+    MAGIC = b'GEOIP4\x00\x01'
+    HEADER = struct.Struct('>8sI')
+    RECORD = struct.Struct('>II2s')
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            magic, self._count = self.HEADER.unpack_from(self._map, 0)
+        except (ValueError, struct.error, mmap.error):
+            self._file.close()
+            raise ValueError('Invalid GeoIP database `{}`'.format(path))
+        expected = self.HEADER.size + self._count * self.RECORD.size
+        if magic != self.MAGIC or len(self._map) != expected:
+            self.close()
+            raise ValueError('Invalid GeoIP database `{}`'.format(path))
+
+    def __len__(self):
+        return self._count
+
+    def _record(self, idx):
+        return self.RECORD.unpack_from(
+            self._map, self.HEADER.size + idx * self.RECORD.size)
+
+    def lookup(self, ip):
+        '''Return the country code of `ip`, `None` if it's unknown.'''
+        value = ip_to_int(ip)
+        if value is None:
+            return None
+        # Find the last record starting before (or at) `value`.
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            if self._record(mid)[0] <= value:
+                low = mid + 1
+            else:
+                high = mid
+        if low == 0:
+            return None
+        first, last, code = self._record(low - 1)
+        return code.decode('ascii') if first <= value <= last else None
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    @classmethod
+    def build(cls, csv_path, path):
+        '''Build the database at `path` from a CSV file of IP ranges.
+        Return the number of records.
+        '''
+        ranges = []
+        with open(csv_path) as f:
+            for row in csv.reader(f):
+                if len(row) < 3 or row[0].startswith('#'):
+                    continue
+                first, last = ip_to_int(row[0]), ip_to_int(row[1])
+                code = row[2].strip().upper()
+                if first is None or last is None or len(code) != 2 or \
+                   first > last:
+                    continue
+                ranges.append((first, last, code))
+        ranges.sort()
+
+        # Merge adjacent ranges of the same country, drop overlaps.
+        records = []
+        for first, last, code in ranges:
+            if records and first <= records[-1][1]:
+                first = records[-1][1] + 1
+                if first > last:
+                    continue
+            if records and records[-1][2] == code and \
+               records[-1][1] + 1 == first:
+                records[-1][1] = last
+            else:
+                records.append([first, last, code])
+
+        dir_path = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path,
+                                        prefix='.{}.'.format(
+                                            os.path.basename(path)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(cls.HEADER.pack(cls.MAGIC, len(records)))
+                for first, last, code in records:
+                    f.write(cls.RECORD.pack(first, last,
+                                            code.encode('ascii')))
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return len(records)
+
+# ------------------------------------------------------------------------------
+# COUNTRY INFORMATIONS ---------------------------------------------------------
 
 class CountryInfo(object):
-    def __init__(self, name, region, neighbors):
+    def __init__(self, code, name, region, neighbors):
+        self._code = code
         self._name = name
         self._region = region
         self._neighbors = neighbors
 
+    @property
+    def code(self):
+        return self._code
+
     @property
     def name(self):
         return self._name
@@ -55,30 +432,25 @@ class CountryInfo(object):
         return self._neighbors
 
     @classmethod
-    def from_ip(cls, fail_handler, ip=None):
+    def from_ip(cls, ip, geoip_db, fail_handler, countries=COUNTRIES):
         '''Get the country informations using provided IP address.'''
-        url = 'http://ip-api.com/json'
-        if ip is not None:
-            url += '/{ip}'.format(ip=ip)
-
-        try:
-            info = json.loads(url_open(url).read())
-        except:
-            fail_handler(msg='Failed to parse country from IP')
-
-        return cls.from_code(info['countryCode'], fail_handler)
+        if ip_to_int(ip) is None or is_private(ip):
+            fail_handler(msg='Cannot geo-locate the IP address `{}`: provide '
+                             'the public one with `ip`'.format(ip))
+        code = geoip_db.lookup(ip)
+        if code is None:
+            fail_handler(msg='Cannot find the country of `{}`'.format(ip))
+        return cls.from_code(code, fail_handler, countries)
 
     @classmethod
-    def from_code(cls, code, fail_handler):
-        '''Get the country informations using provided country code.'''
-        url = 'https://restcountries.eu/rest/v1/alpha/{code}'.format(code=code)
-
-        try:
-            info = json.loads(url_open(url).read())
-        except:
-            fail_handler(msg='Failed to parse read informations')
-
-        return cls(info['name'], info['region'], info['borders'])
+    def from_code(cls, code, fail_handler, countries=COUNTRIES):
+        '''Get the country informations using provided country code.
+        Countries missing from `countries` are only known by their code (the
+        mirrors are matched by country code alone).
+        '''
+        code = code.upper()
+        name, region, neighbors = countries.get(code, (code, None, []))
+        return cls(code, name, region, neighbors)
 
 # ------------------------------------------------------------------------------
 # MIRROR INFORMATIONS ----------------------------------------------------------
@@ -92,7 +464,7 @@ class MirrorInfo(object):
 
     @classmethod
     def parse_from_url(cls, url):
-        return cls.parse(url_open(url).read())
+        return cls.parse(url_open(url, timeout=URL_TIMEOUT).read())
 
     @classmethod
     def parse(cls, text):
@@ -108,6 +480,7 @@ class MirrorInfo(object):
                         info[uri] = {
                             "name": name,
                             "country": mirror_group.get("countryname"),
+                            "country_code": mirror_group.get("country"),
                             "region": mirror_group.get("region"),
                             "ipv4": e.get("ipv4"),
                             "ipv6": e.get("ipv6"),
@@ -124,6 +497,11 @@ class MirrorInfo(object):
     def urls(self):
         return [url for url, args in list(self._info.items())]
 
+    def ranked_urls(self, rank_fn):
+        '''URLs sorted by `rank_fn(args)` (the lowest first), then by URL.'''
+        return sorted(self._info,
+                      key=lambda url: (rank_fn(self._info[url]), url))
+
     def filter_by_name(self, expected):
         match_fn = lambda name: name.lower().startswith(expected.lower())
         info = self._filter_by('name', match_fn)
@@ -139,6 +517,11 @@ class MirrorInfo(object):
         info = self._filter_by('country', match_fn)
         return MirrorInfo(info)
 
+    def filter_by_country_code(self, expected):
+        match_fn = lambda code: (code or '').upper() == expected.upper()
+        info = self._filter_by('country_code', match_fn)
+        return MirrorInfo(info)
+
     def filter_by_region(self, expected):
         match_fn = lambda region: region.lower() == expected.lower()
         info = self._filter_by('region', match_fn)
@@ -157,7 +540,7 @@ class MirrorInfo(object):
 class FillMechanisms(object):
     def __init__(self, mirrors, fail_handler):
         self._mirrors = mirrors
-        self._sel_mirrors = []
+        self._sel_mirrors = MirrorInfo({})
         self._fail_handler = fail_handler
 
     @property
@@ -185,63 +568,176 @@ class FillMechanisms(object):
             elif len(self._sel_mirrors) > 1:
                 self._sel_mirrors = self._sel_mirrors.filter_by_region(region)
 
-    def fill_with_geo_loc(self):
-        # If there isn't a matching mirror, try to find the best available.
+    def fill_with_all(self):
+        if len(self._sel_mirrors) == 0:
+            self._sel_mirrors = self._mirrors
+
+    def fill_with_geo_loc(self, country_info):
+        # If there isn't a matching mirror, try to find the best available:
+        # in the country, then in the nearest neighbors, then in the region.
         if len(self._sel_mirrors) == 0:
-            country_info = CountryInfo.from_ip(self._fail_handler)
             self._fill_with_neighbors(country_info)
+        if len(self._sel_mirrors) == 0:
+            self.fill_with_region(country_info.region)
 
         # If the mirror isn't uniquely identified, try to narrow.
         if len(self._sel_mirrors) > 1:
-            country_info = CountryInfo.from_ip(self._fail_handler)
             self.fill_with_region(country_info.region)
 
     def _fill_with_neighbors(self, country_info):
-        self.fill_with_country(country_info.name)
-        if len(self._sel_mirrors) == 0:
-            for neighbor in country_info.neighbors:
-                neigh_info = CountryInfo.from_code(neighbor, self._fail_handler)
-                self._fill_with_neighbors(neigh_info)
-                if len(self._sel_mirrors) != 0:
-                    return
+        '''Select the mirrors of the nearest countries (up to
+        `MAX_NEIGHBOR_DISTANCE` borders away) having some.
+        '''
+        distances = neighbor_distances(country_info.code)
+        for distance in range(MAX_NEIGHBOR_DISTANCE + 1):
+            info = {}
+            for code in distances:
+                if distances[code] == distance:
+                    info.update(
+                        self._mirrors.filter_by_country_code(code).info)
+            if info:
+                self._sel_mirrors = MirrorInfo(info)
+                return
 
 # ------------------------------------------------------------------------------
-# MAIN FUNCTION ----------------------------------------------------------------
-
-def main():
-    module = AnsibleModule(argument_spec=dict(
-        geo_loc=dict(type='bool', default=False),
-        mirrors=dict(type='str', default=MIRRORS_XML),
-        name=dict(type='str', default=None),
-        proto=dict(type='str', default=None),
-        region=dict(type='str', default=None),
-        country=dict(type='str', default=None)))
-
-    mirrors = MirrorInfo.parse_from_url(module.params['mirrors'])
+# RESOLUTION -------------------------------------------------------------------
+
+class GeoLocError(Exception):
+    pass
+
+def raise_geo_loc_error(msg):
+    raise GeoLocError(msg)
+
+def geo_locate(params):
+    '''Country informations of the target, from the offline GeoIP database.
+    Raise `GeoLocError` if it can't be geo-located.
+    '''
+    ip = params['ip'] or own_ip()
+    if ip is None:
+        raise GeoLocError('the target has no route to the Internet')
+    try:
+        db = GeoIPDatabase(params['geoip_db'])
+    except (IOError, OSError, ValueError) as err:
+        raise GeoLocError('cannot open the GeoIP database ({}): build it '
+                          'with `geoip_csv`'.format(err))
+    try:
+        return ip, CountryInfo.from_ip(ip, db, raise_geo_loc_error)
+    finally:
+        db.close()
+
+def mirror_rank(params, country_info):
+    '''Rank function of the mirrors: matching the `name`, then the `country`,
+    then the nearest to the geo-located country, then in the `region` (or in
+    the geo-located one), then the preferred protocol.
+    '''
+    matches = lambda value, expected: \
+        expected is not None and (value or '').lower() == expected.lower()
+    distances = {}
+    region = params['region']
+    if country_info is not None:
+        distances = neighbor_distances(country_info.code)
+        region = region or country_info.region
+
+    def rank(args):
+        name = params['name']
+        code = (args['country_code'] or '').upper()
+        proto = (args['proto'] or '').lower()
+        return (not (name is not None and
+                     (args['name'] or '').lower().startswith(name.lower())),
+                not matches(args['country'], params['country']),
+                distances.get(code, MAX_NEIGHBOR_DISTANCE + 1),
+                not matches(args['region'], region),
+                PROTOCOLS.index(proto) if proto in PROTOCOLS
+                                       else len(PROTOCOLS))
+    return rank
+
+ARGUMENT_SPEC = dict(
+    geo_loc=dict(type='bool', default=False),
+    geoip_db=dict(type='str', default=GEOIP_DB),
+    geoip_csv=dict(type='str', default=None),
+    ip=dict(type='str', default=None),
+    mirrors=dict(type='str', default=MIRRORS_XML),
+    name=dict(type='str', default=None),
+    proto=dict(type='str', default=None),
+    region=dict(type='str', default=None),
+    country=dict(type='str', default=None))
+
+def load_mirrors(params):
+    '''(Re)build the GeoIP database when needed and download the mirrors list.
+    Return whether the database has been built and the mirrors.
+    '''
+    changed = False
+    geoip_db = params['geoip_db']
+    geoip_csv = params['geoip_csv']
+    if geoip_csv is not None and (
+            not os.path.exists(geoip_db) or
+            os.path.getmtime(geoip_csv) > os.path.getmtime(geoip_db)):
+        GeoIPDatabase.build(geoip_csv, geoip_db)
+        changed = True
+    return changed, MirrorInfo.parse_from_url(params['mirrors'])
+
+def resolve(params, fail_handler, loaded=None):
+    '''Select the mirror: return the module result (without `msg`).
+    It's also used by the `select_mirror` action plugin, which passes the
+    mirrors `loaded` once on the controller (see `load_mirrors`).
+    '''
+    geo_info = None
+    country_info = None
+    warnings = []
+
+    changed, mirrors = loaded or load_mirrors(params)
 
     # (If provided) enforce a particular protocol.
-    if module.params['proto'] is not None:
-        mirrors = mirrors.filter_by_proto(module.params['proto'])
+    if params['proto'] is not None:
+        mirrors = mirrors.filter_by_proto(params['proto'])
 
-    fill_mechanisms = FillMechanisms(mirrors, module.fail_json)
+    fill_mechanisms = FillMechanisms(mirrors, fail_handler)
 
     # Priority order: 'name' -> 'country' -> 'region'.
-    fill_mechanisms.fill_with_name(module.params['name'])
-    fill_mechanisms.fill_with_country(module.params['country'])
-    fill_mechanisms.fill_with_region(module.params['region'])
+    fill_mechanisms.fill_with_name(params['name'])
+    fill_mechanisms.fill_with_country(params['country'])
+    fill_mechanisms.fill_with_region(params['region'])
 
-    if module.params['geo_loc']:
-        fill_mechanisms.fill_with_geo_loc()
-
-    mirrors_urls = fill_mechanisms.selected_mirrors.urls()
+    if params['geo_loc']:
+        try:
+            ip, country_info = geo_locate(params)
+        except GeoLocError as err:
+            # Not worth failing the installation: any mirror works.
+            warnings.append('Mirrors not geo-located: {}'.format(err))
+        else:
+            fill_mechanisms.fill_with_geo_loc(country_info)
+            geo_info = {'ip':      ip,
+                        'country': country_info.code,
+                        'name':    country_info.name,
+                        'region':  country_info.region}
+            if len(fill_mechanisms.selected_mirrors) == 0:
+                warnings.append('No mirrors near `{}`'.format(
+                    country_info.name))
+        if len(fill_mechanisms.selected_mirrors) == 0:
+            fill_mechanisms.fill_with_all()
+
+    mirrors_urls = fill_mechanisms.selected_mirrors.ranked_urls(
+        mirror_rank(params, country_info))
 
     if len(mirrors_urls) == 0:
-        module.fail_json(msg='There are no matching mirrors')
+        fail_handler(msg='There are no matching mirrors')
 
-    mirror = mirrors_urls[0]
+    result = {'changed': changed,
+              'result':  mirrors_urls[0],
+              'mirrors': mirrors_urls,
+              'geo_loc': geo_info}
+    if warnings:
+        result['warnings'] = warnings
+    return result
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    module = AnsibleModule(argument_spec=ARGUMENT_SPEC)
 
-    module.exit_json(changed=True, msg='A Gentoo mirror has been selected.',
-                     result=mirror)
+    result = resolve(module.params, module.fail_json)
+    module.exit_json(msg='A Gentoo mirror has been selected.', **result)
 
 # ------------------------------------------------------------------------------
 # ENTRY POINT ------------------------------------------------------------------
@@ -11,7 +11,7 @@ PY3K = sys.version_info >= (3, 0)
 if PY3K:
     from urllib.request import urlopen as url_open
 else:
-    from urllib import urlopen as url_open
+    from urllib2 import urlopen as url_open
 
 # ------------------------------------------------------------------------------
 # MODULE INFORMATIONS ----------------------------------------------------------
@@ -28,6 +28,12 @@ EXAMPLES = '''
 TODO
 '''
 
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+# Seconds to wait for the list of the latest Stages.
+URL_TIMEOUT = 30
+
 # ------------------------------------------------------------------------------
 # UTILITIES --------------------------------------------------------------------
 
@@ -57,35 +63,49 @@ def build_regexp(params):
     return regexp
 
 # ------------------------------------------------------------------------------
-# MAIN FUNCTION ----------------------------------------------------------------
-
-def main():
-    module = AnsibleModule(argument_spec=dict(
-        arch=dict(choices=['alpha', 'amd64', 'arm', 'hppa', 'ia64', 'mips',
-                           'ppc', 's390', 'sh', 'sparc', 'x86'],
-                  required=True),
-        hardened=dict(type='bool', required=True),
-        multilib=dict(type='bool', required=True)))
-
+# RESOLUTION -------------------------------------------------------------------
+
+ARGUMENT_SPEC = dict(
+    arch=dict(choices=['alpha', 'amd64', 'arm', 'hppa', 'ia64', 'mips',
+                       'ppc', 's390', 'sh', 'sparc', 'x86'],
+              required=True),
+    hardened=dict(type='bool', required=True),
+    multilib=dict(type='bool', required=True))
+
+def resolve(params, fail_handler):
+    '''Select the Stage: return the module result (without `msg`).
+    It's also used by the `select_stage` action plugin, to resolve the Stage
+    once on the controller.
+    '''
     url = ('http://distfiles.gentoo.org/releases/' +
-           '{arch}/'.format(arch=module.params['arch']) +
+           '{arch}/'.format(arch=params['arch']) +
            'autobuilds/latest-stage3.txt')
 
-    regexp = build_regexp(module.params)
+    regexp = build_regexp(params)
 
-    paths = [line.split(' ')[0] for line in url_open(url).read().splitlines()
+    text = url_open(url, timeout=URL_TIMEOUT).read()
+    if PY3K:
+        text = text.decode('utf-8')
+    paths = [line.split(' ')[0] for line in text.splitlines()
              if line and not line.startswith('#')]
 
     # Find a Stage path matching with provided parameters.
     stage_paths = [path for path in paths if re.match(regexp, path)]
 
     if len(stage_paths) != 1:
-        module.fail_json(msg='Cannot find a matching Stage')
+        fail_handler(msg='Cannot find a matching Stage')
+
+    return {'changed': True,
+            'result':  stage_paths[0]}
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
 
-    stage_path = stage_paths[0]
+def main():
+    module = AnsibleModule(argument_spec=ARGUMENT_SPEC)
 
-    module.exit_json(changed=True, msg='A Stage archive has been selected.',
-                     result=stage_path)
+    result = resolve(module.params, module.fail_json)
+    module.exit_json(msg='A Stage archive has been selected.', **result)
 
 # ------------------------------------------------------------------------------
 # ENTRY POINT ------------------------------------------------------------------
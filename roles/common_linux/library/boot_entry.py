@@ -7,7 +7,7 @@
 import glob
 import os
 import re
-import io
+import tempfile
 
 # ------------------------------------------------------------------------------
 # MODULE INFORMATIONS ----------------------------------------------------------
@@ -21,7 +21,33 @@ author:
 '''
 
 EXAMPLES = '''
-TODO
+# Add the default entry, booting the newest kernel installed in `/boot` from
+# the root device of `/mnt/gentoo`.
+- name: Configure Gentoo boot entry
+  boot_entry:
+    name:     gentoo
+    default:  true
+    base_dir: /boot
+    chroot:   /mnt/gentoo
+
+# Write several entries (and `loader.conf`) at once. LUKS options are shared by
+# all the entries.
+- name: Configure Gentoo boot entries
+  boot_entry:
+    entries:
+      - name:    gentoo
+        default: true
+      - name:    gentoo-fallback
+        title:   Gentoo (fallback initramfs)
+        initrd:  initrd-fallback
+      - name:    gentoo-lts
+        kernel:  4.4.6-gentoo
+        options:
+          - quiet
+    enc_name: primary
+    enc_opts: discard
+    base_dir: /boot
+    chroot:   /mnt/gentoo
 '''
 
 # ------------------------------------------------------------------------------
@@ -107,109 +133,381 @@ def chrooted(command, path, profile='/etc/profile', work_dir=None):
     prefix += "'"
     return prefix
 
-def find_replace(path, regexp, substitution, append_fallback=False):
-    import fileinput, io, os
-
-    found = False
-
-    if os.path.isfile(path):
-        for line in fileinput.input(path, inplace=True):
-            if re.match(regexp, line):
-                found = True
-                print(substitution)
+class MountInfo(object):
+    '''Mount table of the current process, read from `/proc/self/mountinfo`
+    (see `proc(5)`).
+    Each mount is a dict holding its `id` and the `parent` mount id, so the
+    real mount tree (including stacked, bind and shared mounts) can be built.
+    '''
+    PATH = '/proc/self/mountinfo'
+
+    def __init__(self, path=None):
+        with open(path or self.PATH) as f:
+            self.mounts = [self.parse_line(line) for line in f if line.strip()]
+        self.by_id = dict((mount['id'], mount) for mount in self.mounts)
+
+    @staticmethod
+    def unescape(value):
+        '''Decode octal escapes (e.g. `\\040` for spaces).'''
+        return re.sub(r'\\([0-7]{3})',
+                      lambda md: chr(int(md.group(1), 8)), value)
+
+    @classmethod
+    def parse_line(cls, line):
+        fields = line.split()
+        # Optional fields (propagation) are terminated by a single hyphen.
+        sep = fields.index('-', 6)
+        return {'id':          int(fields[0]),
+                'parent':      int(fields[1]),
+                'device':      fields[2],
+                'root':        cls.unescape(fields[3]),
+                'path':        cls.unescape(fields[4]),
+                'opts':        fields[5],
+                'propagation': fields[6:sep],
+                'fs':          fields[sep + 1],
+                'source':      cls.unescape(fields[sep + 2]),
+                'super_opts':  fields[sep + 3] if len(fields) > sep + 3 else ''}
+
+    def under(self, root):
+        '''Mounts at or below the path `root`.'''
+        root = root.rstrip('/') or '/'
+        prefix = root if root == '/' else root + '/'
+        return [mount for mount in self.mounts
+                if mount['path'] == root or mount['path'].startswith(prefix)]
+
+    def find(self, path):
+        '''The mount visible at `path` (i.e. the last one mounted there).'''
+        found = None
+        for mount in self.mounts:
+            if mount['path'] == path:
+                found = mount
+        return found
+
+def _replace_file(tmp_path, path):
+    '''Move the (already synced) `tmp_path` over `path`, keeping its mode.'''
+    if os.path.exists(path):
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    else:
+        os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+
+def atomic_write(path, content):
+    '''Replace the file at `path` with `content`, without leaving it truncated
+    or half-written if something goes wrong.
+    Nothing is written if the file already has that content.
+    Return `True` if the file has been written.
+    '''
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        _replace_file(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+class ConfigEditor(object):
+    '''Edit a line-based configuration file with many rules at once.
+    Each rule is `(regexp, replacement, append_if_missing, template)`: lines
+    matching `regexp` are replaced by `replacement` (`None` removes them),
+    taken literally unless `template` is set (then it's a `re` template). The
+    first matching rule wins. If no line matches a rule with
+    `append_if_missing`, its replacement is appended to the file.
+    The file is read and rewritten in a single streaming pass and replaced
+    atomically, only if its content changes (a missing file is created only
+    if there's something to write).
+    '''
+    def __init__(self, path, rules=None):
+        self.path = path
+        self.rules = []
+        for rule in rules or []:
+            self.rule(*rule)
+
+    def rule(self, regexp, replacement, append_if_missing=False,
+             template=False):
+        self.rules.append((re.compile(regexp), replacement, append_if_missing,
+                           template))
+        return self
+
+    @staticmethod
+    def terminated(line):
+        '''`line` ending with a newline (e.g. the last line of a file).'''
+        if line is None or line.endswith('\n'):
+            return line
+        return line + '\n'
+
+    def edit(self, lines):
+        '''Yield `(old line, new line)` pairs (`None` for missing lines).
+        New lines always end with a newline.
+        '''
+        matched = [False] * len(self.rules)
+        for line in lines:
+            new_line = self.terminated(line)
+            for idx, (regexp, replacement, _, template) in \
+                    enumerate(self.rules):
+                md = regexp.match(line.rstrip('\n'))
+                if md:
+                    matched[idx] = True
+                    if replacement is None:
+                        new_line = None
+                    elif template:
+                        new_line = md.expand(replacement) + '\n'
+                    else:
+                        new_line = replacement + '\n'
+                    break
+            yield line, new_line
+        for idx, (_, replacement, append_if_missing, _) in \
+                enumerate(self.rules):
+            if append_if_missing and not matched[idx] and replacement:
+                yield None, replacement + '\n'
+
+    def apply(self):
+        '''Apply the rules. Return `True` if the file has been changed.'''
+        try:
+            src = open(self.path)
+        except (IOError, OSError):
+            src = None
+        changed = False
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            prefix='.{}.'.format(os.path.basename(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as dst:
+                for old_line, new_line in self.edit(src or []):
+                    # A missing final newline alone isn't a change.
+                    if new_line != self.terminated(old_line):
+                        changed = True
+                    if new_line is not None:
+                        dst.write(new_line)
+                if changed:
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            if changed:
+                _replace_file(tmp_path, self.path)
             else:
-                print(line)
-
-    if not found and append_fallback:
-        with io.open(self.loader_conf, 'ab') as f:
-            f.write(substitution)
+                os.remove(tmp_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            if src is not None:
+                src.close()
+        return changed
 
 # ------------------------------------------------------------------------------
-# BOOT ENTRIES -----------------------------------------------------------------
-
-class BootEntry(BaseObject):
-    def __init__(self, module):
-        super(BootEntry, self).__init__(module,
-            params=['name', 'title', 'kind', 'default', 'base_dir', 'chroot',
-                    'vmlinuz', 'initrd', 'root_dev', 'enc_name'])
+# GLOBALS ----------------------------------------------------------------------
 
-        uname = self.run_command('uname -r')['out_lines'][0]
+HEADER = '# Generated by Ansible: manual changes will be overwritten.\n'
 
-        if self.vmlinuz is None:
-            self.vmlinuz = r'vmlinuz-{uname}'.format(uname=uname)
+DISK_DIR = '/dev/disk'
 
-        if self.initrd is None:
-            self.initrd = r'initrd-{uname}'.format(uname=uname)
+# Kinds of persistent names indexed by `DeviceIndex`.
+IDENTITY_KINDS = ['uuid', 'partuuid', 'partlabel', 'label']
 
-        if not self.title:
-            self.title = self.vmlinuz
-
-        self.entry_conf = os.path.join(self.base_dir, 'loader', 'entries',
-                                       '{name}.conf'.format(name=self.name))
+# ------------------------------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
 
-        self.loader_conf = os.path.join(self.base_dir, 'loader', 'loader.conf')
+def version_key(version):
+    '''Sort key for kernel versions (e.g. `4.4.6-gentoo-r1`).'''
+    return [(0, int(part)) if part.isdigit() else (1, part)
+            for part in re.split(r'[.-]', version)]
 
-        if self.root_dev is None:
+# ------------------------------------------------------------------------------
+# DEVICES ----------------------------------------------------------------------
 
-            devices = filter(lambda line: re.match(r'.+on / type', line),
-                             self.run_command('mount')['out_lines'])
-            if len(devices) != 1:
-                self.fail('Internal error in `boot_entry`')
-            self.root_dev = devices[0].split(' ')[0]
+class DeviceIndex(object):
+    '''Persistent identities (UUID, PARTUUID, PARTLABEL, LABEL) of the block
+    devices, read once from the `/dev/disk/by-*` symlinks maintained by udev.
+    '''
+    def __init__(self, disk_dir=DISK_DIR):
+        self.identities = {} # Device path -> {kind: value}.
+        self.devices = {}    # Kind -> {value: device path}.
+        for kind in IDENTITY_KINDS:
+            self.devices[kind] = {}
+            kind_dir = os.path.join(disk_dir, 'by-{}'.format(kind))
+            try:
+                names = os.listdir(kind_dir)
+            except OSError:
+                continue
+            for name in names:
+                device = os.path.realpath(os.path.join(kind_dir, name))
+                value = self.unescape(name)
+                self.devices[kind][value] = device
+                self.identities.setdefault(device, {})[kind] = value
+
+    @staticmethod
+    def unescape(name):
+        '''Decode udev escapes (e.g. `\\x20` for spaces).'''
+        return re.sub(r'\\x([0-9a-fA-F]{2})',
+                      lambda md: chr(int(md.group(1), 16)), name)
+
+    def find(self, kind, value):
+        return self.devices.get(kind, {}).get(value)
+
+    def identity(self, device, kind):
+        return self.identities.get(os.path.realpath(device), {}).get(kind)
 
-        if (self.enc_name and
-            self.run_command('blkid -t UUID={}'.format(self.enc_name),
-                             check_rc=False)['rc'] != 0):
-            cmd = 'blkid -t PARTLABEL={} -s UUID -o value'.format(self.enc_name)
-            self.enc_name = self.run_command(cmd)['out_lines'][0]
+# ------------------------------------------------------------------------------
+# BOOT ENTRIES -----------------------------------------------------------------
 
-        self.options = []
-        if self.enc_name:
-            self.options.append('rd.luks.uuid={}'.format(self.enc_name))
-        self.options.append('init=/usr/lib/systemd/systemd')
-        self.options.append('root={device}'.format(device=self.root_dev))
-        self.options.append('rw')
+class BootLoader(BaseObject):
+    '''Write the systemd-boot entries and `loader.conf` in one pass.
+    Devices and the kernel version are resolved once, without running any
+    command, and shared by all the entries.
+    '''
+    def __init__(self, module):
+        super(BootLoader, self).__init__(module,
+            params=['name', 'title', 'kind', 'default', 'base_dir', 'chroot',
+                    'vmlinuz', 'initrd', 'root_dev', 'enc_name', 'enc_opts',
+                    'entries'])
+        self.root_dir = self.chroot or '/'
+        self.index = DeviceIndex()
+        self.version = self.kernel_version()
+        self.root = self.root_device()
+        self.luks_uuid = self.luks_device()
+
+        if not self.entries: # Single entry, from the module parameters.
+            self.entries = [{'name':    self.name,
+                             'title':   self.title,
+                             'vmlinuz': self.vmlinuz,
+                             'initrd':  self.initrd,
+                             'default': self.default}]
+        if not all(entry.get('name') for entry in self.entries):
+            self.fail('Every boot entry needs a name')
+
+        self.loader_conf = self.path(os.path.join('loader', 'loader.conf'))
+
+    def path(self, relative_path):
+        '''Path of a file in the boot directory, outside the chroot.'''
+        return os.path.join(self.root_dir, self.base_dir.lstrip('/'),
+                            relative_path)
+
+    def kernel_version(self):
+        '''Newest kernel installed in the boot directory, or the running one.
+        Backups (e.g. `vmlinuz-<version>.old`) and kernels without modules
+        aren't considered.
+        '''
+        versions = [os.path.basename(path)[len('vmlinuz-'):]
+                    for path in glob.glob(self.path('vmlinuz-*'))]
+        versions = [version for version in versions
+                    if not version.endswith('.old') and os.path.isdir(
+                        os.path.join(self.root_dir, 'lib', 'modules',
+                                     version))]
+        if versions:
+            return sorted(versions, key=version_key)[-1]
+        return os.uname()[2]
+
+    def root_device(self):
+        '''The device mounted as the root of the (chrooted) system.'''
+        if self.root_dev:
+            return self.root_dev
+        mount = MountInfo().find(os.path.realpath(self.root_dir))
+        if mount is None:
+            self.fail('Cannot find the root device of `{}`'.format(
+                self.root_dir))
+        uuid = self.index.identity(mount['source'], 'uuid')
+        return 'UUID={}'.format(uuid) if uuid else mount['source']
+
+    def luks_device(self):
+        '''The UUID of the LUKS device `enc_name` (a UUID or a partition
+        label).
+        '''
+        if not self.enc_name:
+            return None
+        if self.index.find('uuid', self.enc_name):
+            return self.enc_name
+        device = self.index.find('partlabel', self.enc_name)
+        uuid = self.index.identity(device, 'uuid') if device else None
+        if uuid is None:
+            self.fail('Unknown encrypted device `{}`'.format(self.enc_name))
+        return uuid
+
+    def options(self, entry):
+        options = []
+        if self.luks_uuid:
+            options.append('rd.luks.uuid={}'.format(self.luks_uuid))
+            if self.enc_opts:
+                # Same dm-crypt flags as in `crypttab`.
+                options.append('rd.luks.options={}={}'.format(
+                    self.luks_uuid, self.enc_opts))
+        options.append('init=/usr/lib/systemd/systemd')
+        options.append('root={device}'.format(device=self.root))
+        options.append('rw')
+        options += entry.get('options') or []
+        return options
+
+    def render_entry(self, entry):
+        version = entry.get('kernel') or self.version
+        vmlinuz = entry.get('vmlinuz') or 'vmlinuz-{}'.format(version)
+        initrd = entry.get('initrd') or 'initrd-{}'.format(version)
+        return '\n'.join([
+            'title   {}'.format(entry.get('title') or vmlinuz),
+            'linux   {}'.format(os.path.join('/', vmlinuz)),
+            'initrd  {}'.format(os.path.join('/', initrd)),
+            'options {}'.format(' '.join(self.options(entry))),
+            ]) + '\n'
 
     def run(self):
-        if not os.path.isdir(os.path.dirname(self.entry_conf)):
-            self.run_command('mkdir -p {}'.format(
-                os.path.dirname(self.entry_conf)))
-
-        with io.open(self.chroot + self.entry_conf, 'wb') as f:
-            f.write('\n'.join([
-                'title   {}'.format(self.title),
-                'linux   {}'.format(os.path.join('/', self.vmlinuz)),
-                'initrd  {}'.format(os.path.join('/', self.initrd)),
-                'options {}'.format(' '.join(self.options)),
-                ]) + '\n')
-
-        if self.default:
-            find_replace(self.chroot + self.loader_conf,
-                         r'default\s+(\S+)',
-                         'default {name}'.format(name=self.name),
-                         append_fallback=True)
+        changed = False
+        result = []
+        default = None
+        for entry in self.entries:
+            path = self.path(os.path.join('loader', 'entries',
+                                          '{}.conf'.format(entry['name'])))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            content = self.render_entry(entry)
+            changed = atomic_write(path, content) or changed
+            if entry.get('default'):
+                default = entry['name']
+            result.append({'name': entry['name'], 'path': path,
+                           'content': content})
+        if default is not None:
+            # Only the default entry is managed, the rest is left as it is.
+            loader_conf = ConfigEditor(self.loader_conf, [
+                (r'default\s+(\S+)', 'default {}'.format(default), True)])
+            changed = loader_conf.apply() or changed
+        return changed, {'entries': result, 'default': default,
+                         'kernel': self.version, 'root': self.root}
 
 # ------------------------------------------------------------------------------
 # MAIN FUNCTION ----------------------------------------------------------------
 
 def main():
     module = AnsibleModule(argument_spec={
-        'name':     {'type': 'str',  'required': True},
+        'name':     {'type': 'str',  'required': False, 'default': None},
         'title':    {'type': 'str',  'required': False, 'default': None},
         'vmlinuz':  {'type': 'str',  'required': False, 'default': None},
         'initrd':   {'type': 'str',  'required': False, 'default': None},
+        'entries':  {'type': 'list', 'required': False, 'default': None},
         'enc_name': {'type': 'str',  'required': False, 'default': None},
+        'enc_opts': {'type': 'str',  'required': False, 'default': None},
         'root_dev': {'type': 'str',  'required': False, 'default': None},
         'default':  {'type': 'bool', 'required': False, 'default': False},
         'base_dir': {'type': 'str',  'required': True},
         'chroot':   {'type': 'str',  'required': False, 'default': None},
         })
 
-    boot_entry = BootEntry(module)
+    boot_loader = BootLoader(module)
 
-    boot_entry.run()
+    changed, result = boot_loader.run()
 
-    module.exit_json(changed=True, msg='Boot entry successfully added')
+    module.exit_json(changed=changed, msg='Boot entries successfully written',
+                     result=result)
 
 # ------------------------------------------------------------------------------
 # ENTRY POINT ------------------------------------------------------------------
@@ -32,6 +32,16 @@ EXAMPLES = '''
     flags:
       - boot
 
+# Create an encrypted partition, without tuning dm-crypt for the disk.
+- name: Create the root partition
+  create_partition:
+    name: root
+    disk: /dev/nvme0n1
+    fs: ext4
+    end: 100%
+    encryption: secret
+    crypt_tuning: false
+
 # Create partitions defined in the variable `partitions` and
 # define the fact `partitions` shadowing that variable and adding some
 # informations.
@@ -58,12 +68,143 @@ def log(msg, level=syslog.LOG_DEBUG):
     if os.name == 'posix': # syslog is unsupported on Windows.
         syslog.syslog(level, msg)
 
+# ------------------------------------------------------------------------------
+# COMMONS (copy&paste) ---------------------------------------------------------
+
+class BlockDevice(object):
+    '''Topology of a block device, as exposed by sysfs.
+    Partitions don't have a request queue: queue attributes are read from the
+    disk holding them.
+    '''
+    SYSFS_DIR = '/sys/class/block'
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(os.path.realpath(path))
+        self.sysfs_dir = os.path.realpath(os.path.join(self.SYSFS_DIR,
+                                                       self.name))
+
+    @property
+    def exists(self):
+        return os.path.isdir(self.sysfs_dir)
+
+    @property
+    def is_partition(self):
+        return os.path.isfile(os.path.join(self.sysfs_dir, 'partition'))
+
+    @property
+    def disk(self):
+        '''The whole disk (itself, unless it's a partition).'''
+        if self.is_partition:
+            return BlockDevice(os.path.join(
+                '/dev', os.path.basename(os.path.dirname(self.sysfs_dir))))
+        return self
+
+    def read(self, attr, default=None):
+        try:
+            with open(os.path.join(self.sysfs_dir, attr)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return default
+
+    def read_int(self, attr, default=0):
+        try:
+            return int(self.read(attr))
+        except (TypeError, ValueError):
+            return default
+
+    def queue(self, attr, default=0):
+        return self.disk.read_int(os.path.join('queue', attr), default)
+
+    @property
+    def size(self):
+        '''Size in bytes (sysfs always counts 512-byte sectors).'''
+        return self.read_int('size') * 512
+
+    @property
+    def logical_block_size(self):
+        return self.queue('logical_block_size', 512)
+
+    @property
+    def physical_block_size(self):
+        return self.queue('physical_block_size', 512)
+
+    @property
+    def minimum_io_size(self):
+        return self.queue('minimum_io_size', 0)
+
+    @property
+    def optimal_io_size(self):
+        return self.queue('optimal_io_size', 0)
+
+    @property
+    def rotational(self):
+        return self.queue('rotational', 1) == 1
+
+    @property
+    def discard(self):
+        return self.queue('discard_max_bytes', 0) > 0
+
+    @property
+    def is_nvme(self):
+        if self.disk.name.startswith('nvme'):
+            return True
+        # Stacked devices (dm, md) are NVMe-backed if all their slaves are.
+        slaves = self.disk.slaves
+        return len(slaves) > 0 and all(slave.is_nvme for slave in slaves)
+
+    @property
+    def partitions(self):
+        try:
+            names = sorted(os.listdir(self.sysfs_dir))
+        except OSError:
+            names = []
+        return [BlockDevice(os.path.join('/dev', name)) for name in names
+                if os.path.isfile(os.path.join(self.sysfs_dir, name,
+                                               'partition'))]
+
+    @property
+    def slaves(self):
+        return self._related('slaves')
+
+    @property
+    def holders(self):
+        return self._related('holders')
+
+    @property
+    def dm_name(self):
+        return self.read('dm/name')
+
+    @property
+    def dm_uuid(self):
+        return self.read('dm/uuid')
+
+    def _related(self, kind):
+        try:
+            names = sorted(os.listdir(os.path.join(self.sysfs_dir, kind)))
+        except OSError:
+            names = []
+        return [BlockDevice(os.path.join('/dev', name)) for name in names]
+
+    def to_dict(self):
+        return {'name':                self.name,
+                'size':                self.size,
+                'logical_block_size':  self.logical_block_size,
+                'physical_block_size': self.physical_block_size,
+                'minimum_io_size':     self.minimum_io_size,
+                'optimal_io_size':     self.optimal_io_size,
+                'rotational':          self.rotational,
+                'discard':             self.discard,
+                'nvme':                self.is_nvme}
+
 # ------------------------------------------------------------------------------
 # GLOBALS ----------------------------------------------------------------------
 
 AVAILABLE_UNITS = ['s', 'B', 'kB', 'MB', 'GB', 'TB', 'compact', 'cyl', 'chs',
                    '%', 'kiB', 'MiB', 'GiB', 'TiB']
 
+CRYPT_SECTOR_SIZES = [512, 1024, 2048, 4096]
+
 # ------------------------------------------------------------------------------
 # UTILITIES --------------------------------------------------------------------
 
@@ -119,7 +260,7 @@ class StorageSize(collections.Mapping):
 # LOGIC ------------------------------------------------------------------------
 
 class PartitionManager(object):
-    def __init__(self, name, disk, fs, end, flags, enc_pwd,
+    def __init__(self, name, disk, fs, end, flags, enc_pwd, crypt_tuning,
                  cmd_runner, fail_handler):
         # Init fields from provided arguments.
         self._name = name
@@ -128,6 +269,8 @@ class PartitionManager(object):
         self._end = StorageSize.from_str(end, fail_handler)
         self._flags = flags
         self._enc_pwd = enc_pwd
+        self._crypt_tuning = crypt_tuning
+        self._crypt = None
         self._cmd_runner = cmd_runner
         self._fail_handler = fail_handler
         # Init other fields.
@@ -182,17 +325,73 @@ class PartitionManager(object):
 
             log('Encrypting device `{}` with name `{}`..'.format(
                 self._raw_device, enc_name))
-            self._run_crypt_cmd('luksFormat --use-urandom {device} {key_file}'.format(
-                                device=self._raw_device, key_file=pwd_file.name))
-            self._run_crypt_cmd('luksOpen {device} {name} --key-file {key_file}'.format(
-                                device=self._raw_device, name=enc_name,
+            self._crypt = self.crypt_settings()
+            format_args = ''
+            open_args = ''
+            if self._crypt:
+                format_args += ' --type luks2 --sector-size {}'.format(
+                    self._crypt['sector_size'])
+                if self._crypt['discard']:
+                    open_args += ' --allow-discards'
+                if self._crypt['no_read_workqueue']:
+                    open_args += ' --perf-no_read_workqueue'
+                if self._crypt['no_write_workqueue']:
+                    open_args += ' --perf-no_write_workqueue'
+                if open_args:
+                    # Store the flags in the LUKS2 header, so that they are
+                    # also used when the device is opened at boot.
+                    open_args += ' --persistent'
+            self._run_crypt_cmd('luksFormat --use-urandom{args} {device} {key_file}'.format(
+                                args=format_args, device=self._raw_device,
                                 key_file=pwd_file.name))
+            self._run_crypt_cmd('luksOpen {device} {name} --key-file {key_file}{args}'.format(
+                                device=self._raw_device, name=enc_name,
+                                key_file=pwd_file.name, args=open_args))
             self._name   = enc_name
             self._device = "/dev/mapper/{}".format(self._name)
 
             os.unlink(pwd_file.name)
             log('Encrypt operation completed')
 
+    def crypt_settings(self):
+        '''Compute the dm-crypt settings matching the backing disk.
+        - The crypt sector size follows the physical block size, so that each
+          encrypted sector maps onto whole device blocks.
+        - NVMe devices have deep hardware queues: the dm-crypt workqueues only
+          add latency, so they are bypassed.
+        - Discards are passed down to non-rotational devices supporting them.
+        Return `None` if tuning is disabled (plain `cryptsetup` defaults).
+        '''
+        if not self._crypt_tuning:
+            return None
+        # The partition node may not be there yet, but the queue belongs to
+        # the disk anyway.
+        device = BlockDevice(self._disk)
+        sector_size = device.physical_block_size
+        if not sector_size in CRYPT_SECTOR_SIZES:
+            sector_size = CRYPT_SECTOR_SIZES[0]
+        sector_size = max(sector_size, device.logical_block_size)
+        return dict(
+            sector_size=sector_size,
+            discard=not device.rotational and device.discard,
+            no_read_workqueue=device.is_nvme,
+            no_write_workqueue=device.is_nvme)
+
+    def crypt_opts(self):
+        '''The `crypttab` options (also valid for `rd.luks.options`) matching
+        the computed dm-crypt settings.
+        '''
+        if not self._crypt:
+            return None
+        opts = []
+        if self._crypt['discard']:
+            opts.append('discard')
+        if self._crypt['no_read_workqueue']:
+            opts.append('no-read-workqueue')
+        if self._crypt['no_write_workqueue']:
+            opts.append('no-write-workqueue')
+        return ','.join(opts) or None
+
     def _run_crypt_cmd(self, cmd):
         cmd = 'cryptsetup -q {cmd}'.format(cmd=cmd)
         log('Performing command `{}`'.format(cmd))
@@ -207,7 +406,7 @@ class PartitionManager(object):
                                 check_rc=True)
 
     def to_dict(self):
-        return dict(
+        result = dict(
             raw_name=self._raw_name,
             name=self._name,
             fs=self._fs,
@@ -219,6 +418,10 @@ class PartitionManager(object):
             device=self._device,
             flags=self._flags,
             encryption=self._enc_pwd)
+        if self._enc_pwd:
+            result['crypt'] = self._crypt
+            result['crypt_opts'] = self.crypt_opts()
+        return result
 
 # ------------------------------------------------------------------------------
 # MAIN FUNCTION ----------------------------------------------------------------
@@ -236,7 +439,8 @@ def main():
                  required=True),
         end=dict(type='str', required=True),
         flags=dict(type='list', default=[]),
-        encryption=dict(type='str', default=None)))
+        encryption=dict(type='str', default=None),
+        crypt_tuning=dict(type='bool', default=True)))
 
     fail_handler = lambda msg: module.fail_json(msg=msg)
     cmd_runner   = lambda *args, **kwargs: module.run_command(*args, **kwargs)
@@ -244,6 +448,7 @@ def main():
     pm = PartitionManager(module.params['name'], module.params['disk'],
                           module.params['fs'], module.params['end'],
                           module.params['flags'], module.params['encryption'],
+                          module.params['crypt_tuning'],
                           cmd_runner, fail_handler)
     pm.create()
 
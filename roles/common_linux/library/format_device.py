@@ -0,0 +1,415 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import os
+import re
+
+# ------------------------------------------------------------------------------
+# MODULE INFORMATIONS ----------------------------------------------------------
+
+DOCUMENTATION = '''
+---
+module: format_device
+short_description: Create a filesystem tuned to the device topology
+author:
+    - "Alessandro Molari"
+'''
+
+EXAMPLES = '''
+# Format a (maybe striped) Logical Volume.
+- name: Format the data volume
+  format_device:
+    dev: /dev/vg-data/lv-data
+    fs:  xfs
+
+# Format the partitions and record the chosen parameters into `partitions`.
+- name: Format partitions
+  format_device:
+    dev: "{{ item.device }}"
+    fs:  "{{ item.fs     }}"
+  with_items: "{{ partitions }}"
+  register: _output
+- set_fact:
+    partitions: "{{ _output.results |
+                    map(attribute='result') |
+                    select('defined') |
+                    map_merge(partitions, 'match_key', 'device') }}"
+
+# Give the stripe geometry explicitly (e.g. the one of a RAID array): the
+# stripe unit in bytes and the number of data disks.
+- name: Format the RAID array
+  format_device:
+    dev:         /dev/md/md-data
+    fs:          ext4
+    stripe_unit: 524288
+    stripes:     2
+'''
+
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+# Flag forcing `mkfs` to overwrite an existing filesystem.
+FORCE_FLAGS = {'ext2': '-F', 'ext3': '-F', 'ext4': '-F',
+               'xfs': '-f', 'btrfs': '-f'}
+
+# ------------------------------------------------------------------------------
+# COMMONS (copy&paste) ---------------------------------------------------------
+
+class BaseObject(object):
+    import syslog, os
+
+    '''Base class for all classes that use AnsibleModule.
+    Dependencies:
+    - `chrooted` function.
+    '''
+    def __init__(self, module, params=None):
+        syslog.openlog('ansible-{module}-{name}'.format(
+            module=os.path.basename(__file__), name=self.__class__.__name__))
+        self.work_dir = None
+        self.chroot = None
+        self._module = module
+        self._command_prefix = None
+        if params:
+            self._parse_params(params)
+
+    @property
+    def command_prefix(self):
+        return self._command_prefix
+
+    @command_prefix.setter
+    def command_prefix(self, value):
+        self._command_prefix = value
+
+    def run_command(self, command=None, **kwargs):
+        if not 'check_rc' in kwargs:
+            kwargs['check_rc'] = True
+        if command is None and self.command_prefix is None:
+            self.fail('Invalid command')
+        if self.command_prefix:
+            command = '{prefix} {command}'.format(
+                prefix=self.command_prefix, command=command or '')
+        if self.work_dir and not self.chroot:
+            command = 'cd {work_dir}; {command}'.format(
+                work_dir=self.work_dir, command=command)
+        if self.chroot:
+            command = chrooted(command, self.chroot, work_dir=self.work_dir)
+        self.log('Performing command `{}`'.format(command))
+        rc, out, err = self._module.run_command(command, **kwargs)
+        if rc != 0:
+            self.log('Command `{}` returned invalid status code: `{}`'.format(
+                command, rc), level=syslog.LOG_WARNING)
+        return {'rc': rc,
+                'out': out,
+                'out_lines': [line for line in out.split('\n') if line],
+                'err': err,
+                'err_lines': [line for line in out.split('\n') if line]}
+
+    def log(self, msg, level=syslog.LOG_DEBUG):
+        '''Log to the system logging facility of the target system.'''
+        if os.name == 'posix': # syslog is unsupported on Windows.
+            syslog.syslog(level, str(msg))
+
+    def fail(self, msg):
+        self._module.fail_json(msg=msg)
+
+    def exit(self, changed=True, msg='', result=None):
+        self._module.exit_json(changed=changed, msg=msg, result=result)
+
+    def _parse_params(self, params):
+        for param in params:
+            if param in self._module.params:
+                value = self._module.params[param]
+                t = self._module.argument_spec[param].get('type')
+                if t == 'str' and value in ['None', 'none']:
+                    value = None
+                setattr(self, param, value)
+            else:
+                setattr(self, param, None)
+
+def chrooted(command, path, profile='/etc/profile', work_dir=None):
+    prefix = "chroot {path} bash -c 'source {profile}; ".format(
+        path=path, profile=profile)
+    if work_dir:
+        prefix += 'cd {work_dir}; '.format(work_dir=work_dir)
+    prefix += command
+    prefix += "'"
+    return prefix
+
+class BlockDevice(object):
+    '''Topology of a block device, as exposed by sysfs.
+    Partitions don't have a request queue: queue attributes are read from the
+    disk holding them.
+    '''
+    SYSFS_DIR = '/sys/class/block'
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(os.path.realpath(path))
+        self.sysfs_dir = os.path.realpath(os.path.join(self.SYSFS_DIR,
+                                                       self.name))
+
+    @property
+    def exists(self):
+        return os.path.isdir(self.sysfs_dir)
+
+    @property
+    def is_partition(self):
+        return os.path.isfile(os.path.join(self.sysfs_dir, 'partition'))
+
+    @property
+    def disk(self):
+        '''The whole disk (itself, unless it's a partition).'''
+        if self.is_partition:
+            return BlockDevice(os.path.join(
+                '/dev', os.path.basename(os.path.dirname(self.sysfs_dir))))
+        return self
+
+    def read(self, attr, default=None):
+        try:
+            with open(os.path.join(self.sysfs_dir, attr)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return default
+
+    def read_int(self, attr, default=0):
+        try:
+            return int(self.read(attr))
+        except (TypeError, ValueError):
+            return default
+
+    def queue(self, attr, default=0):
+        return self.disk.read_int(os.path.join('queue', attr), default)
+
+    @property
+    def size(self):
+        '''Size in bytes (sysfs always counts 512-byte sectors).'''
+        return self.read_int('size') * 512
+
+    @property
+    def logical_block_size(self):
+        return self.queue('logical_block_size', 512)
+
+    @property
+    def physical_block_size(self):
+        return self.queue('physical_block_size', 512)
+
+    @property
+    def minimum_io_size(self):
+        return self.queue('minimum_io_size', 0)
+
+    @property
+    def optimal_io_size(self):
+        return self.queue('optimal_io_size', 0)
+
+    @property
+    def rotational(self):
+        return self.queue('rotational', 1) == 1
+
+    @property
+    def discard(self):
+        return self.queue('discard_max_bytes', 0) > 0
+
+    @property
+    def is_nvme(self):
+        if self.disk.name.startswith('nvme'):
+            return True
+        # Stacked devices (dm, md) are NVMe-backed if all their slaves are.
+        slaves = self.disk.slaves
+        return len(slaves) > 0 and all(slave.is_nvme for slave in slaves)
+
+    @property
+    def partitions(self):
+        try:
+            names = sorted(os.listdir(self.sysfs_dir))
+        except OSError:
+            names = []
+        return [BlockDevice(os.path.join('/dev', name)) for name in names
+                if os.path.isfile(os.path.join(self.sysfs_dir, name,
+                                               'partition'))]
+
+    @property
+    def slaves(self):
+        return self._related('slaves')
+
+    @property
+    def holders(self):
+        return self._related('holders')
+
+    @property
+    def dm_name(self):
+        return self.read('dm/name')
+
+    @property
+    def dm_uuid(self):
+        return self.read('dm/uuid')
+
+    def _related(self, kind):
+        try:
+            names = sorted(os.listdir(os.path.join(self.sysfs_dir, kind)))
+        except OSError:
+            names = []
+        return [BlockDevice(os.path.join('/dev', name)) for name in names]
+
+    def to_dict(self):
+        return {'name':                self.name,
+                'size':                self.size,
+                'logical_block_size':  self.logical_block_size,
+                'physical_block_size': self.physical_block_size,
+                'minimum_io_size':     self.minimum_io_size,
+                'optimal_io_size':     self.optimal_io_size,
+                'rotational':          self.rotational,
+                'discard':             self.discard,
+                'nvme':                self.is_nvme}
+
+# ------------------------------------------------------------------------------
+# FORMATTER --------------------------------------------------------------------
+
+class DeviceFormatter(BaseObject):
+    '''Format a device with `mkfs`, deriving the filesystem geometry from the
+    device topology (stripe unit/width, block sizes, rotational, discard).
+    '''
+    def __init__(self, module):
+        super(DeviceFormatter, self).__init__(module,
+            params=['dev', 'fs', 'force', 'opts', 'stripe_unit', 'stripes'])
+        self.device = BlockDevice(self.dev)
+
+    def topology(self):
+        '''Read the device topology.
+        Stacked devices (md, dm) advertise their stripe geometry through the
+        I/O sizes hints: `minimum_io_size` is the stripe unit (chunk) and
+        `optimal_io_size` the full stripe width. Device-mapper tables are
+        inspected when the hints are missing.
+        A geometry given by the `stripe_unit` and `stripes` parameters takes
+        precedence.
+        '''
+        topology = self.device.to_dict()
+        stripe_unit = self.device.minimum_io_size
+        stripe_width = self.device.optimal_io_size
+        if (stripe_unit > self.device.physical_block_size and
+            stripe_width > stripe_unit and stripe_width % stripe_unit == 0):
+            topology['stripe_unit'] = stripe_unit
+            topology['stripes'] = stripe_width // stripe_unit
+        else:
+            topology['stripe_unit'], topology['stripes'] = self._dm_stripes()
+        if self.stripe_unit and self.stripes:
+            topology['stripe_unit'] = self.stripe_unit
+            topology['stripes'] = self.stripes
+        return topology
+
+    def mkfs_options(self, topology):
+        '''Compute the `mkfs` options for the filesystem `fs`.'''
+        options = []
+        stripe_unit = topology['stripe_unit']
+        stripes = topology['stripes']
+        if self.fs in ['ext2', 'ext3', 'ext4']:
+            block_size = 4096
+            extended = []
+            if stripe_unit and stripe_unit % block_size == 0:
+                stride = stripe_unit // block_size
+                extended.append('stride={}'.format(stride))
+                extended.append('stripe_width={}'.format(stride * stripes))
+            if not topology['discard']:
+                extended.append('nodiscard')
+            options.append('-b {}'.format(block_size))
+            if extended:
+                options.append('-E {}'.format(','.join(extended)))
+        elif self.fs == 'xfs':
+            if stripe_unit:
+                options.append('-d su={},sw={}'.format(stripe_unit, stripes))
+            if topology['logical_block_size'] > 512:
+                options.append('-s size={}'.format(
+                    topology['logical_block_size']))
+            if not topology['discard']:
+                options.append('-K')
+        elif self.fs == 'btrfs':
+            # On a single device the only choice is between `single` and
+            # `dup`: duplicating metadata is only worth on rotational disks
+            # (SSD controllers may deduplicate or co-locate the copies).
+            options.append('-d single')
+            options.append('-m {}'.format(
+                'dup' if topology['rotational'] else 'single'))
+            if not topology['discard']:
+                options.append('-K')
+        if self.opts:
+            options.append(self.opts)
+        return options
+
+    def current_fs(self):
+        out_lines = self.run_command(
+            'blkid -c /dev/null -o value -s TYPE {}'.format(self.dev),
+            check_rc=False)['out_lines']
+        return out_lines[0] if out_lines else None
+
+    def run(self):
+        topology = self.topology()
+        options = self.mkfs_options(topology)
+        result = {'device': self.dev,
+                  'topology': topology,
+                  'mkfs': {'fs': self.fs,
+                           'options': options,
+                           'stripe_unit': topology['stripe_unit'],
+                           'stripes': topology['stripes']}}
+
+        current_fs = self.current_fs()
+        if current_fs and not self.force:
+            if current_fs != self.fs:
+                self.fail('Device `{}` already contains a `{}` filesystem'.format(
+                    self.dev, current_fs))
+            return False, result
+
+        command = 'mkfs.{fs} {options} {dev}'.format(
+            fs=self.fs, dev=self.dev,
+            options=' '.join(([FORCE_FLAGS[self.fs]]
+                              if self.fs in FORCE_FLAGS else []) + options))
+        self.run_command(command)
+        return True, result
+
+    def _dm_stripes(self):
+        '''Get the stripe geometry from a (single target) `striped`
+        device-mapper table, as `(stripe unit in bytes, stripes)`.
+        '''
+        if not self.device.dm_name:
+            return None, None
+        out_lines = self.run_command('dmsetup table {}'.format(
+            self.device.dm_name), check_rc=False)['out_lines']
+        if len(out_lines) != 1:
+            return None, None
+        # <start> <length> striped <stripes> <chunk sectors> <dev> <offset> ..
+        md = re.match(r'\d+\s+\d+\s+striped\s+(\d+)\s+(\d+)\s', out_lines[0])
+        if not md or int(md.group(1)) < 2:
+            return None, None
+        return int(md.group(2)) * 512, int(md.group(1))
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    module = AnsibleModule(argument_spec={
+        'dev':   {'type': 'str',  'required': True},
+        'fs':    {'type': 'str',  'required': True},
+        'force': {'type': 'bool', 'required': False, 'default': False},
+        'opts':  {'type': 'str',  'required': False, 'default': None},
+        'stripe_unit': {'type': 'int', 'required': False, 'default': None},
+        'stripes':     {'type': 'int', 'required': False, 'default': None},
+        })
+
+    formatter = DeviceFormatter(module)
+
+    changed, result = formatter.run()
+
+    module.exit_json(changed=changed, msg='Device successfully formatted',
+                     result=result)
+
+# ------------------------------------------------------------------------------
+# ENTRY POINT ------------------------------------------------------------------
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
@@ -0,0 +1,406 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import glob, hashlib, json, os, re, tempfile, time
+
+# ------------------------------------------------------------------------------
+# MODULE INFORMATIONS ----------------------------------------------------------
+
+DOCUMENTATION = '''
+---
+module: initramfs
+short_description: Generate the initramfs image with dracut
+description:
+    - The image is generated for the installed kernel (not the running one),
+      in hostonly mode and compressed with multi-threaded zstd.
+    - A fingerprint of the kernel version, its modules, the dracut
+      configuration and the storage layout (crypttab, mdadm.conf, fstab, LVM
+      configuration) is kept: the image is generated again only when it
+      changes.
+author:
+    - "Alessandro Molari"
+'''
+
+EXAMPLES = '''
+- name: Generate initramfs
+  initramfs:
+    base_dir: /boot
+    chroot:   /mnt/gentoo
+  register: _initramfs
+
+- name: Configure Gentoo boot entry
+  boot_entry:
+    name:     gentoo
+    initrd:   "{{ _initramfs.result.image }}"
+    base_dir: /boot
+    chroot:   /mnt/gentoo
+'''
+
+# ------------------------------------------------------------------------------
+# COMMONS (copy&paste) ---------------------------------------------------------
+
+class BaseObject(object):
+    import syslog, os
+
+    '''Base class for all classes that use AnsibleModule.
+    Dependencies:
+    - `chrooted` function.
+    '''
+    def __init__(self, module, params=None):
+        syslog.openlog('ansible-{module}-{name}'.format(
+            module=os.path.basename(__file__), name=self.__class__.__name__))
+        self.work_dir = None
+        self.chroot = None
+        self._module = module
+        self._command_prefix = None
+        if params:
+            self._parse_params(params)
+
+    @property
+    def command_prefix(self):
+        return self._command_prefix
+
+    @command_prefix.setter
+    def command_prefix(self, value):
+        self._command_prefix = value
+
+    def run_command(self, command=None, **kwargs):
+        if not 'check_rc' in kwargs:
+            kwargs['check_rc'] = True
+        if command is None and self.command_prefix is None:
+            self.fail('Invalid command')
+        if self.command_prefix:
+            command = '{prefix} {command}'.format(
+                prefix=self.command_prefix, command=command or '')
+        if self.work_dir and not self.chroot:
+            command = 'cd {work_dir}; {command}'.format(
+                work_dir=self.work_dir, command=command)
+        if self.chroot:
+            command = chrooted(command, self.chroot, work_dir=self.work_dir)
+        self.log('Performing command `{}`'.format(command))
+        rc, out, err = self._module.run_command(command, **kwargs)
+        if rc != 0:
+            self.log('Command `{}` returned invalid status code: `{}`'.format(
+                command, rc), level=syslog.LOG_WARNING)
+        return {'rc': rc,
+                'out': out,
+                'out_lines': [line for line in out.split('\n') if line],
+                'err': err,
+                'err_lines': [line for line in out.split('\n') if line]}
+
+    def log(self, msg, level=syslog.LOG_DEBUG):
+        '''Log to the system logging facility of the target system.'''
+        if os.name == 'posix': # syslog is unsupported on Windows.
+            syslog.syslog(level, str(msg))
+
+    def fail(self, msg):
+        self._module.fail_json(msg=msg)
+
+    def exit(self, changed=True, msg='', result=None):
+        self._module.exit_json(changed=changed, msg=msg, result=result)
+
+    def _parse_params(self, params):
+        for param in params:
+            if param in self._module.params:
+                value = self._module.params[param]
+                t = self._module.argument_spec[param].get('type')
+                if t == 'str' and value in ['None', 'none']:
+                    value = None
+                setattr(self, param, value)
+            else:
+                setattr(self, param, None)
+
+def chrooted(command, path, profile='/etc/profile', work_dir=None):
+    prefix = "chroot {path} bash -c 'source {profile}; ".format(
+        path=path, profile=profile)
+    if work_dir:
+        prefix += 'cd {work_dir}; '.format(work_dir=work_dir)
+    prefix += command
+    prefix += "'"
+    return prefix
+
+def _replace_file(tmp_path, path):
+    '''Move the (already synced) `tmp_path` over `path`, keeping its mode.'''
+    if os.path.exists(path):
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    else:
+        os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+
+def atomic_write(path, content):
+    '''Replace the file at `path` with `content`, without leaving it truncated
+    or half-written if something goes wrong.
+    Nothing is written if the file already has that content.
+    Return `True` if the file has been written.
+    '''
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        _replace_file(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+class ConfigEditor(object):
+    '''Edit a line-based configuration file with many rules at once.
+    Each rule is `(regexp, replacement, append_if_missing, template)`: lines
+    matching `regexp` are replaced by `replacement` (`None` removes them),
+    taken literally unless `template` is set (then it's a `re` template). The
+    first matching rule wins. If no line matches a rule with
+    `append_if_missing`, its replacement is appended to the file.
+    The file is read and rewritten in a single streaming pass and replaced
+    atomically, only if its content changes (a missing file is created only
+    if there's something to write).
+    '''
+    def __init__(self, path, rules=None):
+        self.path = path
+        self.rules = []
+        for rule in rules or []:
+            self.rule(*rule)
+
+    def rule(self, regexp, replacement, append_if_missing=False,
+             template=False):
+        self.rules.append((re.compile(regexp), replacement, append_if_missing,
+                           template))
+        return self
+
+    @staticmethod
+    def terminated(line):
+        '''`line` ending with a newline (e.g. the last line of a file).'''
+        if line is None or line.endswith('\n'):
+            return line
+        return line + '\n'
+
+    def edit(self, lines):
+        '''Yield `(old line, new line)` pairs (`None` for missing lines).
+        New lines always end with a newline.
+        '''
+        matched = [False] * len(self.rules)
+        for line in lines:
+            new_line = self.terminated(line)
+            for idx, (regexp, replacement, _, template) in \
+                    enumerate(self.rules):
+                md = regexp.match(line.rstrip('\n'))
+                if md:
+                    matched[idx] = True
+                    if replacement is None:
+                        new_line = None
+                    elif template:
+                        new_line = md.expand(replacement) + '\n'
+                    else:
+                        new_line = replacement + '\n'
+                    break
+            yield line, new_line
+        for idx, (_, replacement, append_if_missing, _) in \
+                enumerate(self.rules):
+            if append_if_missing and not matched[idx] and replacement:
+                yield None, replacement + '\n'
+
+    def apply(self):
+        '''Apply the rules. Return `True` if the file has been changed.'''
+        try:
+            src = open(self.path)
+        except (IOError, OSError):
+            src = None
+        changed = False
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            prefix='.{}.'.format(os.path.basename(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as dst:
+                for old_line, new_line in self.edit(src or []):
+                    # A missing final newline alone isn't a change.
+                    if new_line != self.terminated(old_line):
+                        changed = True
+                    if new_line is not None:
+                        dst.write(new_line)
+                if changed:
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            if changed:
+                _replace_file(tmp_path, self.path)
+            else:
+                os.remove(tmp_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            if src is not None:
+                src.close()
+        return changed
+
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+# Files (inside the chroot) the image depends on, besides the modules.
+DEPENDENCIES = ['/etc/dracut.conf', '/etc/dracut.conf.d/*.conf',
+                '/etc/crypttab', '/etc/mdadm.conf', '/etc/mdadm/mdadm.conf',
+                '/etc/fstab', '/etc/lvm/lvm.conf']
+
+# Files of `/lib/modules/<version>` describing the module set.
+MODULES_FILES = ['modules.dep', 'modules.builtin', 'modules.order']
+
+FINGERPRINTS_DIR = '/var/lib/initramfs'
+
+# ------------------------------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
+
+def version_key(version):
+    '''Sort key for kernel versions (e.g. `4.4.6-gentoo-r1`).'''
+    return [(0, int(part)) if part.isdigit() else (1, part)
+            for part in re.split(r'[.-]', version)]
+
+# ------------------------------------------------------------------------------
+# LOGIC ------------------------------------------------------------------------
+
+class Initramfs(BaseObject):
+    '''Generate (when needed) the initramfs image of a kernel with dracut.'''
+    def __init__(self, module):
+        super(Initramfs, self).__init__(module,
+            params=['kernel_version', 'base_dir', 'image', 'hostonly',
+                    'compress', 'add', 'force', 'chroot'])
+        self.root_dir = self.chroot or '/'
+
+    def path(self, path):
+        '''`path` (inside the chroot) as seen from the host.'''
+        return os.path.join(self.root_dir, path.lstrip('/'))
+
+    def installed_version(self):
+        '''Newest kernel installed in the boot directory (or, failing that,
+        with modules in `/lib/modules`).
+        Backups (e.g. `vmlinuz-<version>.old`) and kernels without modules
+        aren't considered.
+        '''
+        versions = [os.path.basename(path)[len('vmlinuz-'):]
+                    for path in glob.glob(self.path(os.path.join(
+                        self.base_dir, 'vmlinuz-*')))]
+        versions = [version for version in versions
+                    if not version.endswith('.old') and os.path.isdir(
+                        self.path(os.path.join('/lib/modules', version)))]
+        if not versions:
+            versions = [os.path.basename(path) for path in
+                        glob.glob(self.path('/lib/modules/*'))]
+        if not versions:
+            self.fail('Cannot find any installed kernel')
+        return sorted(versions, key=version_key)[-1]
+
+    def fingerprint(self, version):
+        '''Digest of everything the image is made from.'''
+        digest = hashlib.sha256()
+        options = {'version': version, 'hostonly': self.hostonly,
+                   'compress': self.compress, 'add': sorted(self.add or [])}
+        digest.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+        modules_dir = self.path(os.path.join('/lib/modules', version))
+        paths = [os.path.join(modules_dir, name) for name in MODULES_FILES]
+        for pattern in DEPENDENCIES:
+            paths += sorted(glob.glob(self.path(pattern)))
+        for path in paths:
+            digest.update(b'\0' + path.encode('utf-8') + b'\0')
+            try:
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(65536), b''):
+                        digest.update(chunk)
+            except (IOError, OSError):
+                digest.update(b'(missing)')
+        return digest.hexdigest()
+
+    def dracut(self, version, image_path):
+        args = ['--force', '--kver', version]
+        if self.hostonly:
+            args.append('--hostonly')
+        if self.compress:
+            args += ['--compress', '"{}"'.format(self.compress)]
+        if self.add:
+            args += ['--add', '"{}"'.format(' '.join(self.add))]
+        args.append(image_path)
+        self.run_command('dracut {}'.format(' '.join(args)))
+
+    def run(self):
+        version = self.kernel_version or self.installed_version()
+        if not os.path.isdir(self.path(os.path.join('/lib/modules', version))):
+            self.fail('Missing modules of kernel `{}`'.format(version))
+        image = (self.image or 'initrd-{version}').format(version=version)
+        image_path = os.path.join(self.base_dir, image)
+        fingerprint = self.fingerprint(version)
+        fingerprint_path = self.path(os.path.join(
+            FINGERPRINTS_DIR, '{}.sha256'.format(image)))
+
+        try:
+            with open(fingerprint_path) as f:
+                previous = f.read().strip()
+        except (IOError, OSError):
+            previous = None
+        skip = (not self.force and previous == fingerprint and
+                os.path.exists(self.path(image_path)))
+
+        seconds = None
+        if not skip:
+            start = time.time()
+            self.dracut(version, image_path)
+            seconds = round(time.time() - start, 1)
+            if not os.path.isdir(os.path.dirname(fingerprint_path)):
+                os.makedirs(os.path.dirname(fingerprint_path))
+            atomic_write(fingerprint_path, fingerprint + '\n')
+
+        return not skip, {'version':     version,
+                          'image':       image,
+                          'path':        image_path,
+                          'size':        os.path.getsize(self.path(image_path)),
+                          'fingerprint': fingerprint,
+                          'seconds':     seconds,
+                          'skipped':     skip}
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    module = AnsibleModule(argument_spec={
+        # Kernel version (default: the newest installed).
+        'kernel_version': {'type': 'str', 'required': False, 'default': None},
+        'base_dir':       {'type': 'str', 'required': False,
+                           'default': '/boot'},
+        # Image file name, `{version}` is replaced by the kernel version.
+        'image':          {'type': 'str', 'required': False,
+                           'default': 'initrd-{version}'},
+        'hostonly':       {'type': 'bool', 'required': False, 'default': True},
+        'compress':       {'type': 'str', 'required': False,
+                           'default': 'zstd -T0'},
+        # Additional dracut modules.
+        'add':            {'type': 'list', 'required': False, 'default': []},
+        'force':          {'type': 'bool', 'required': False, 'default': False},
+        'chroot':         {'type': 'str', 'required': False, 'default': None},
+    })
+
+    initramfs = Initramfs(module)
+    changed, result = initramfs.run()
+    module.exit_json(changed=changed, msg='Initramfs generated',
+                     result=result)
+
+# ------------------------------------------------------------------------------
+# ENTRY POINT ------------------------------------------------------------------
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
@@ -0,0 +1,648 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import multiprocessing, os, re, select, shutil, signal, subprocess, tempfile
+import time
+
+# ------------------------------------------------------------------------------
+# MODULE INFORMATIONS ----------------------------------------------------------
+
+DOCUMENTATION = '''
+---
+module: kernel_build
+short_description: Build and install the Linux kernel out-of-tree
+description:
+    - The kernel is built with `O=` in a tmpfs sized from the available
+      memory, so the intermediate objects never hit the (possibly slow or
+      encrypted) target disk. Only the installed artifacts (image, modules)
+      and `.config`, `System.map`, `Module.symvers` are written back.
+    - The sources are then prepared for building external modules (with
+      `modules_prepare`) and `/lib/modules/<version>/build` points to them,
+      instead of the build directory.
+    - When there isn't enough memory, the build directory is on disk.
+    - With `pressure` bounds, the compilation jobs are supervised (the
+      `jobs` value being the maximum), as done by the `make` module.
+author:
+    - "Alessandro Molari"
+'''
+
+EXAMPLES = '''
+- name: Build kernel
+  kernel_build:
+    src_dir:      /usr/src/linux
+    install_path: /boot
+    jobs:         8
+    chroot:       /mnt/gentoo
+
+# Lower the jobs when the memory or IO pressure is too high.
+- name: Build kernel
+  kernel_build:
+    src_dir:      /usr/src/linux
+    install_path: /boot
+    jobs:         8
+    pressure:
+      memory: 10
+      io:     60
+    chroot:       /mnt/gentoo
+'''
+
+# ------------------------------------------------------------------------------
+# COMMONS (copy&paste) ---------------------------------------------------------
+
+class BaseObject(object):
+    import syslog, os
+
+    '''Base class for all classes that use AnsibleModule.
+    Dependencies:
+    - `chrooted` function.
+    '''
+    def __init__(self, module, params=None):
+        syslog.openlog('ansible-{module}-{name}'.format(
+            module=os.path.basename(__file__), name=self.__class__.__name__))
+        self.work_dir = None
+        self.chroot = None
+        self._module = module
+        self._command_prefix = None
+        if params:
+            self._parse_params(params)
+
+    @property
+    def command_prefix(self):
+        return self._command_prefix
+
+    @command_prefix.setter
+    def command_prefix(self, value):
+        self._command_prefix = value
+
+    def run_command(self, command=None, **kwargs):
+        if not 'check_rc' in kwargs:
+            kwargs['check_rc'] = True
+        if command is None and self.command_prefix is None:
+            self.fail('Invalid command')
+        if self.command_prefix:
+            command = '{prefix} {command}'.format(
+                prefix=self.command_prefix, command=command or '')
+        if self.work_dir and not self.chroot:
+            command = 'cd {work_dir}; {command}'.format(
+                work_dir=self.work_dir, command=command)
+        if self.chroot:
+            command = chrooted(command, self.chroot, work_dir=self.work_dir)
+        self.log('Performing command `{}`'.format(command))
+        rc, out, err = self._module.run_command(command, **kwargs)
+        if rc != 0:
+            self.log('Command `{}` returned invalid status code: `{}`'.format(
+                command, rc), level=syslog.LOG_WARNING)
+        return {'rc': rc,
+                'out': out,
+                'out_lines': [line for line in out.split('\n') if line],
+                'err': err,
+                'err_lines': [line for line in out.split('\n') if line]}
+
+    def log(self, msg, level=syslog.LOG_DEBUG):
+        '''Log to the system logging facility of the target system.'''
+        if os.name == 'posix': # syslog is unsupported on Windows.
+            syslog.syslog(level, str(msg))
+
+    def fail(self, msg):
+        self._module.fail_json(msg=msg)
+
+    def exit(self, changed=True, msg='', result=None):
+        self._module.exit_json(changed=changed, msg=msg, result=result)
+
+    def _parse_params(self, params):
+        for param in params:
+            if param in self._module.params:
+                value = self._module.params[param]
+                t = self._module.argument_spec[param].get('type')
+                if t == 'str' and value in ['None', 'none']:
+                    value = None
+                setattr(self, param, value)
+            else:
+                setattr(self, param, None)
+
+def chrooted(command, path, profile='/etc/profile', work_dir=None):
+    prefix = "chroot {path} bash -c 'source {profile}; ".format(
+        path=path, profile=profile)
+    if work_dir:
+        prefix += 'cd {work_dir}; '.format(work_dir=work_dir)
+    prefix += command
+    prefix += "'"
+    return prefix
+
+PRESSURE_DIR = '/proc/pressure'
+
+PRESSURE_RESOURCES = ['cpu', 'memory', 'io']
+
+def read_pressure(resource):
+    '''Share of time (%, averaged over 10 seconds) some tasks have been stalled
+    on `resource` (`cpu`, `memory` or `io`), from the pressure stall
+    information of the kernel.
+    '''
+    with open(os.path.join(PRESSURE_DIR, resource)) as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] == 'some':
+                return float(dict(field.split('=')
+                                  for field in fields[1:])['avg10'])
+    return 0.0
+
+def process_tree(root):
+    '''Descendants of the process `root`, as
+    `{pid: (start time, state, children)}`.
+    '''
+    processes = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                stat = f.read()
+        except (IOError, OSError): # Exited meanwhile.
+            continue
+        # The command name (2nd field) can contain spaces and parenthesis.
+        fields = stat[stat.rindex(')') + 2:].split()
+        processes[int(name)] = (int(fields[1]), int(fields[19]), fields[0])
+    children = {}
+    for pid, (ppid, _, _) in processes.items():
+        children.setdefault(ppid, []).append(pid)
+    tree = {}
+    queue = [root]
+    while queue:
+        pid = queue.pop()
+        for child in children.get(pid, []):
+            tree[child] = processes[child][1:] + (children.get(child, []),)
+            queue.append(child)
+    return tree
+
+class BuildSupervisor(object):
+    '''Run a build keeping the pressure of the system within `bounds` (the
+    maximum `some` pressure of each resource, e.g. `{'memory': 10}`), by
+    changing the number of parallel jobs between `min_jobs` and `max_jobs`.
+    With `jobserver`, the supervisor is the `make` jobserver of the build
+    (through `MAKEFLAGS`) and holds back tokens. Otherwise the most recent
+    running leaf processes of the build (e.g. `cc1plus`) are paused
+    (`SIGSTOP`) and resumed (`SIGCONT`) later.
+    Every `interval` seconds, the jobs are lowered by one if a resource is
+    over its bound, and raised by one if all the resources are under
+    `hysteresis` times their bounds.
+    '''
+    POLL_INTERVAL = 1
+
+    def __init__(self, bounds, max_jobs, min_jobs=1, interval=10,
+                 hysteresis=0.5, jobserver=False):
+        self.bounds = self.check_bounds(bounds)
+        self.max_jobs = max(1, max_jobs)
+        self.min_jobs = max(1, min(min_jobs, self.max_jobs))
+        self.interval = interval
+        self.hysteresis = hysteresis
+        self.jobserver = jobserver
+        self.jobs = self.max_jobs
+        self.timeline = []
+        self.decisions = []
+        self._start = None
+        self._token_fds = None
+        self._withheld = 0
+        self._paused = {}
+
+    @staticmethod
+    def check_bounds(bounds):
+        '''Return the pressure `bounds` as numbers.
+        Raise `ValueError` if they aren't valid.
+        '''
+        unknown = sorted(set(bounds) - set(PRESSURE_RESOURCES))
+        if unknown:
+            raise ValueError('Unknown pressure resources: {} (expected: '
+                             '{})'.format(', '.join(unknown),
+                                          ', '.join(PRESSURE_RESOURCES)))
+        try:
+            return dict((resource, float(bound))
+                        for resource, bound in bounds.items())
+        except (TypeError, ValueError):
+            raise ValueError('Pressure bounds must be numbers')
+
+    @staticmethod
+    def supported():
+        return all(os.path.exists(os.path.join(PRESSURE_DIR, resource))
+                   for resource in PRESSURE_RESOURCES)
+
+    def run(self, command, env=None):
+        '''Run the shell `command` under supervision.
+        Return its status code, standard output and standard error.
+        '''
+        env = dict(env or os.environ)
+        if self.jobserver:
+            env['MAKEFLAGS'] = '{} -j{} --jobserver-auth={},{}'.format(
+                env.get('MAKEFLAGS', ''), self.max_jobs,
+                *self._open_jobserver()).strip()
+        out, err = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+        self._start = time.time()
+        try:
+            process = subprocess.Popen(command, shell=True, env=env,
+                                       stdout=out, stderr=err,
+                                       close_fds=not self.jobserver)
+            next_check = self._start + self.interval
+            while process.poll() is None:
+                self._enforce(process.pid)
+                if time.time() >= next_check:
+                    self._check()
+                    next_check += self.interval
+        finally:
+            self._release()
+        out.seek(0)
+        err.seek(0)
+        return (process.returncode, out.read().decode('utf-8', 'replace'),
+                err.read().decode('utf-8', 'replace'))
+
+    def report(self):
+        return {'bounds':    self.bounds,
+                'mode':      'jobserver' if self.jobserver else 'pause',
+                'jobs':      {'min': self.min_jobs, 'max': self.max_jobs,
+                              'final': self.jobs},
+                'timeline':  self.timeline,
+                'decisions': self.decisions}
+
+    def _check(self):
+        '''Sample the pressure and decide the number of jobs.'''
+        now = round(time.time() - self._start, 1)
+        pressure = dict((resource, read_pressure(resource))
+                        for resource in PRESSURE_RESOURCES)
+        self.timeline.append(dict(pressure, time=now, jobs=self.jobs))
+        over = sorted(resource for resource, bound in self.bounds.items()
+                      if pressure[resource] > bound)
+        if over and self.jobs > self.min_jobs:
+            self.jobs -= 1
+            reason = ', '.join('{} {} > {}'.format(
+                resource, pressure[resource], self.bounds[resource])
+                for resource in over)
+        elif not over and self.jobs < self.max_jobs and \
+             all(pressure[resource] < bound * self.hysteresis
+                 for resource, bound in self.bounds.items()):
+            self.jobs += 1
+            reason = 'pressure under {:.0%} of the bounds'.format(
+                self.hysteresis)
+        else:
+            return
+        self.decisions.append({'time': now, 'jobs': self.jobs,
+                               'reason': reason})
+
+    def _open_jobserver(self):
+        read_fd, write_fd = os.pipe()
+        for fd in [read_fd, write_fd]:
+            if hasattr(os, 'set_inheritable'): # Python 3.
+                os.set_inheritable(fd, True)
+        # Non-blocking reads from a separate open file description, so `make`
+        # keeps blocking on the shared one.
+        reader = os.open('/proc/self/fd/{}'.format(read_fd),
+                         os.O_RDONLY | os.O_NONBLOCK)
+        # `make` itself holds an implicit token.
+        os.write(write_fd, b'+' * (self.max_jobs - 1))
+        self._token_fds = (read_fd, write_fd, reader)
+        return read_fd, write_fd
+
+    def _enforce(self, pid):
+        '''Make the build run `self.jobs` jobs, for `POLL_INTERVAL` seconds.'''
+        if self.jobserver:
+            self._withhold_tokens(time.time() + self.POLL_INTERVAL)
+        else:
+            time.sleep(self.POLL_INTERVAL)
+            self._pause_jobs(pid)
+
+    def _withhold_tokens(self, deadline):
+        withhold = self.max_jobs - self.jobs
+        if self._withheld > withhold:
+            os.write(self._token_fds[1], b'+' * (self._withheld - withhold))
+            self._withheld = withhold
+        # Tokens in use are taken back when `make` returns them, competing
+        # with `make` for them: wait for them instead of polling.
+        now = time.time()
+        while now < deadline:
+            if self._withheld < withhold and \
+               select.select([self._token_fds[2]], [], [], deadline - now)[0]:
+                try:
+                    self._withheld += len(os.read(self._token_fds[2],
+                                                  withhold - self._withheld))
+                except OSError: # Taken by `make`.
+                    pass
+            elif self._withheld >= withhold:
+                time.sleep(deadline - now)
+            now = time.time()
+
+    def _pause_jobs(self, pid):
+        tree = process_tree(pid)
+        self._paused = dict((leaf, start)
+                            for leaf, start in self._paused.items()
+                            if tree.get(leaf, (None,))[0] == start)
+        # Idle leaves (e.g. waiting on a pipe) aren't jobs.
+        running = sorted((start, leaf)
+                         for leaf, (start, state, children) in tree.items()
+                         if not children and state in 'RD' and
+                            leaf not in self._paused)
+        if len(running) > self.jobs:
+            for start, leaf in running[self.jobs:]: # The most recent ones.
+                self._signal(leaf, signal.SIGSTOP)
+                self._paused[leaf] = start
+        else:
+            for leaf, start in sorted(self._paused.items(),
+                                      key=lambda item: item[1]
+                                      )[:self.jobs - len(running)]:
+                self._signal(leaf, signal.SIGCONT)
+                del self._paused[leaf]
+
+    def _signal(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError: # Exited meanwhile.
+            pass
+
+    def _release(self):
+        '''Resume the paused processes and close the jobserver.'''
+        for pid in self._paused:
+            self._signal(pid, signal.SIGCONT)
+        self._paused = {}
+        if self._token_fds:
+            for fd in self._token_fds:
+                os.close(fd)
+            self._token_fds = None
+
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+# Files copied back to the sources directory after the build.
+KEPT_FILES = ['.config', 'System.map', 'Module.symvers']
+
+# Leftovers making Kbuild refuse out-of-tree builds.
+UNCLEAN_PATHS = ['.config', 'include/config', 'arch/{arch}/include/generated']
+
+SIZE_SUFFIXES = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+SECTOR_SIZE = 512
+
+# ------------------------------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
+
+def parse_size(size):
+    md = re.match(r'^\s*(\d+)\s*([kmg]?)i?b?\s*$', str(size).lower())
+    if not md:
+        raise ValueError('Invalid size `{}`'.format(size))
+    return int(md.group(1)) * SIZE_SUFFIXES[md.group(2)]
+
+def mem_available():
+    '''Available memory (bytes), from `/proc/meminfo`.'''
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def block_device_name(path):
+    '''Name of the block device holding `path` (as in `/proc/diskstats`).'''
+    st_dev = os.stat(path).st_dev
+    sys_path = '/sys/dev/block/{}:{}'.format(os.major(st_dev),
+                                             os.minor(st_dev))
+    if os.path.exists(sys_path):
+        return os.path.basename(os.path.realpath(sys_path))
+    return None
+
+def disk_stats(name):
+    '''Sectors written and milliseconds spent writing by the device `name`.'''
+    with open('/proc/diskstats') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 10 and fields[2] == name:
+                return {'sectors_written': int(fields[9]),
+                        'write_ms':        int(fields[10])}
+    return None
+
+def used_bytes(path):
+    stat = os.statvfs(path)
+    return (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+
+# ------------------------------------------------------------------------------
+# LOGIC ------------------------------------------------------------------------
+
+class KernelBuild(BaseObject):
+    '''Build the kernel of `src_dir` in `build_dir` (with `O=`), mounting a
+    tmpfs on it when there is enough memory.
+    '''
+    def __init__(self, module):
+        super(KernelBuild, self).__init__(module,
+            params=['src_dir', 'build_dir', 'install_path', 'jobs', 'opts',
+                    'modules', 'min_size', 'mem_ratio', 'tmpfs', 'pressure',
+                    'min_jobs', 'interval', 'chroot'])
+        self.root_dir = self.chroot or '/'
+        try:
+            self.pressure = BuildSupervisor.check_bounds(self.pressure or {})
+        except ValueError as err:
+            self.fail(str(err))
+        self.supervision = None
+        self.mounted = False # Whether the tmpfs has been mounted by this run.
+
+    def path(self, path):
+        '''`path` (inside the chroot) as seen from the host.'''
+        return os.path.join(self.root_dir, path.lstrip('/'))
+
+    def host_command(self, args):
+        '''Run a command on the host (not in the chroot).'''
+        rc, out, err = self._module.run_command(args)
+        if rc != 0:
+            self.fail('Command `{}` failed: {}'.format(' '.join(args), err))
+
+    def make(self, task=None, opts=None, supervised=False, in_tree=False):
+        '''Run `make` on the kernel (`in_tree`: in the sources directory, not
+        in the build one). When `supervised` (and there are `pressure`
+        bounds), the jobs are supervised with a jobserver.
+        '''
+        supervised = supervised and bool(self.pressure) and \
+                     BuildSupervisor.supported()
+        args = ['-C', self.src_dir]
+        if not in_tree:
+            args.append('O={}'.format(self.build_dir))
+        if self.jobs and not supervised:
+            args.append('-j{}'.format(self.jobs))
+        if task:
+            args.append(task)
+        for name, value in sorted(dict(self.opts or {}, **(opts or {}))
+                                  .items()):
+            value = str(value)
+            if len(value.split()) > 1:
+                value = '"{}"'.format(value)
+            args.append('{}={}'.format(name, value))
+        command = 'make {}'.format(' '.join(args))
+        if not supervised:
+            self.run_command(command)
+            return
+
+        supervisor = BuildSupervisor(
+            self.pressure, self.jobs or multiprocessing.cpu_count(),
+            min_jobs=self.min_jobs, interval=self.interval, jobserver=True)
+        if self.chroot:
+            command = chrooted(command, self.chroot)
+        self.log('Performing supervised command `{}`'.format(command))
+        rc, out, err = supervisor.run(command)
+        self.supervision = supervisor.report()
+        if rc != 0:
+            self._module.fail_json(msg='Command `{}` failed'.format(command),
+                                   rc=rc, stdout=out, stderr=err,
+                                   result=self.supervision)
+
+    def setup_build_dir(self):
+        '''Create the build directory, on a tmpfs if possible.
+        Return the tmpfs size (`None` when building on disk) and why the tmpfs
+        hasn't been used.
+        An existing mount point is used as it is (and never unmounted).
+        '''
+        build_dir = self.path(self.build_dir)
+        if not os.path.isdir(build_dir):
+            os.makedirs(build_dir)
+        if not self.tmpfs:
+            return None, 'disabled'
+        if os.path.ismount(build_dir):
+            return None, 'already a mount point'
+        size = int(mem_available() * self.mem_ratio)
+        if size < parse_size(self.min_size):
+            return None, 'not enough memory ({} MiB available for the ' \
+                         'build)'.format(size // 1024 ** 2)
+        rc, _, err = self._module.run_command(
+            ['mount', '-t', 'tmpfs', '-o',
+             'size={},mode=0755'.format(size), 'tmpfs', build_dir])
+        if rc != 0:
+            return None, 'cannot mount tmpfs: {}'.format(err.strip())
+        self.mounted = True
+        return size, None
+
+    def clean_sources(self):
+        '''Move `.config` to the build directory and make sure the sources are
+        clean, as required by out-of-tree builds.
+        '''
+        src_config = self.path(os.path.join(self.src_dir, '.config'))
+        if not os.path.exists(src_config):
+            self.fail('Missing kernel configuration `{}`'.format(src_config))
+        shutil.copy2(src_config, self.path(os.path.join(self.build_dir,
+                                                        '.config')))
+        os.remove(src_config)
+        arch = os.uname()[4]
+        arch = 'x86' if re.match(r'(i.86|x86_64)$', arch) else arch
+        unclean = [path for path in UNCLEAN_PATHS
+                   if os.path.exists(self.path(os.path.join(
+                       self.src_dir, path.format(arch=arch))))]
+        if unclean:
+            self.run_command('make -C {} mrproper'.format(self.src_dir))
+
+    def copy_back(self):
+        copied = 0
+        for name in KEPT_FILES:
+            src = self.path(os.path.join(self.build_dir, name))
+            if os.path.exists(src):
+                shutil.copy2(src, self.path(os.path.join(self.src_dir, name)))
+                copied += os.path.getsize(src)
+        return copied
+
+    def kernel_release(self):
+        with open(self.path(os.path.join(self.build_dir, 'include', 'config',
+                                         'kernel.release'))) as f:
+            return f.read().strip()
+
+    def prepare_sources(self, release):
+        '''Make the sources usable to build external modules: the build
+        directory they were linked to is gone.
+        '''
+        self.make('modules_prepare', in_tree=True)
+        link = self.path(os.path.join('/lib/modules', release, 'build'))
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(self.src_dir, link)
+
+    def run(self):
+        disk = block_device_name(self.path(self.src_dir))
+        disk_before = disk_stats(disk) if disk else None
+
+        tmpfs_size, fallback_reason = self.setup_build_dir()
+        start = time.time()
+        try:
+            self.clean_sources()
+            self.make('olddefconfig')
+            self.make(supervised=True)
+            if self.modules:
+                self.make('modules_install')
+            self.make('install', {'INSTALL_PATH': self.install_path})
+            build_bytes = used_bytes(self.path(self.build_dir))
+            release = self.kernel_release()
+        finally:
+            # Even when the build fails: `.config` lives only in the build
+            # directory now.
+            copied_bytes = self.copy_back()
+            if self.mounted:
+                self.host_command(['umount', self.path(self.build_dir)])
+        if self.modules:
+            self.prepare_sources(release)
+        seconds = round(time.time() - start, 1)
+
+        result = {'build_dir':       self.build_dir,
+                  'tmpfs':           tmpfs_size is not None,
+                  'tmpfs_size':      tmpfs_size,
+                  'fallback_reason': fallback_reason,
+                  'seconds':         seconds,
+                  'supervision':     self.supervision,
+                  'bytes_kept_off_disk': (build_bytes - copied_bytes
+                                          if tmpfs_size is not None else 0)}
+        if disk_before:
+            disk_after = disk_stats(disk)
+            result['disk'] = {
+                'device':          disk,
+                'sectors_written': disk_after['sectors_written'] -
+                                   disk_before['sectors_written'],
+                'write_ms':        disk_after['write_ms'] -
+                                   disk_before['write_ms']}
+            # Time the kept off bytes would have taken to be written, at the
+            # average write throughput of the device.
+            if disk_after['sectors_written']:
+                ms_per_byte = float(disk_after['write_ms']) / \
+                              (disk_after['sectors_written'] * SECTOR_SIZE)
+                result['estimated_io_seconds_saved'] = round(
+                    result['bytes_kept_off_disk'] * ms_per_byte / 1000, 1)
+        return result
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    module = AnsibleModule(argument_spec={
+        'src_dir':      {'type': 'str', 'required': False,
+                         'default': '/usr/src/linux'},
+        'build_dir':    {'type': 'str', 'required': False,
+                         'default': '/var/tmp/kernel-build'},
+        'install_path': {'type': 'str', 'required': False,
+                         'default': '/boot'},
+        'jobs':         {'type': 'int', 'required': False, 'default': None},
+        'opts':         {'type': 'dict', 'required': False, 'default': {}},
+        'modules':      {'type': 'bool', 'required': False, 'default': True},
+        # Minimum tmpfs size to build in memory.
+        'min_size':     {'type': 'str', 'required': False, 'default': '4G'},
+        # Share of the available memory the tmpfs can use.
+        'mem_ratio':    {'type': 'float', 'required': False, 'default': 0.6},
+        'tmpfs':        {'type': 'bool', 'required': False, 'default': True},
+        # Maximum `some` pressure (%) by resource (`cpu`, `memory`, `io`).
+        'pressure':     {'type': 'dict', 'required': False, 'default': {}},
+        'min_jobs':     {'type': 'int', 'required': False, 'default': 1},
+        # Seconds between the pressure checks.
+        'interval':     {'type': 'int', 'required': False, 'default': 10},
+        'chroot':       {'type': 'str', 'required': False, 'default': None},
+    })
+
+    kernel_build = KernelBuild(module)
+    result = kernel_build.run()
+    module.exit_json(changed=True, msg='Kernel built', result=result)
+
+# ------------------------------------------------------------------------------
+# ENTRY POINT ------------------------------------------------------------------
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
@@ -0,0 +1,289 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import json
+
+# ------------------------------------------------------------------------------
+# MODULE INFORMATIONS ----------------------------------------------------------
+
+DOCUMENTATION = '''
+---
+module: lvm_cache
+short_description: Attach a SSD cache to a LVM Logical Volume
+author:
+    - "Alessandro Molari"
+'''
+
+EXAMPLES = '''
+# Cache the (HDD-backed) Logical Volume `vg-data/lv-data` with a 20GiB
+# dm-cache pool on `/dev/nvme0n1p3` (added to the Volume Group if needed).
+- name: Create LVM caches
+  lvm_cache:
+    name:       lv-data-cache
+    vg:         vg-data
+    lv:         lv-data
+    pvs:        /dev/nvme0n1p3
+    size:       20g
+    type:       cache
+    mode:       writethrough
+    chunk_size: 256k
+
+# Use dm-writecache instead: only writes are cached.
+- name: Create LVM caches
+  lvm_cache:
+    name: lv-data-cache
+    vg:   vg-data
+    lv:   lv-data
+    pvs:  /dev/nvme0n1p3
+    size: 20g
+    type: writecache
+'''
+
+# ------------------------------------------------------------------------------
+# COMMONS (copy&paste) ---------------------------------------------------------
+
+class BaseObject(object):
+    import syslog, os
+
+    '''Base class for all classes that use AnsibleModule.
+    Dependencies:
+    - `chrooted` function.
+    '''
+    def __init__(self, module, params=None):
+        syslog.openlog('ansible-{module}-{name}'.format(
+            module=os.path.basename(__file__), name=self.__class__.__name__))
+        self.work_dir = None
+        self.chroot = None
+        self._module = module
+        self._command_prefix = None
+        if params:
+            self._parse_params(params)
+
+    @property
+    def command_prefix(self):
+        return self._command_prefix
+
+    @command_prefix.setter
+    def command_prefix(self, value):
+        self._command_prefix = value
+
+    def run_command(self, command=None, **kwargs):
+        if not 'check_rc' in kwargs:
+            kwargs['check_rc'] = True
+        if command is None and self.command_prefix is None:
+            self.fail('Invalid command')
+        if self.command_prefix:
+            command = '{prefix} {command}'.format(
+                prefix=self.command_prefix, command=command or '')
+        if self.work_dir and not self.chroot:
+            command = 'cd {work_dir}; {command}'.format(
+                work_dir=self.work_dir, command=command)
+        if self.chroot:
+            command = chrooted(command, self.chroot, work_dir=self.work_dir)
+        self.log('Performing command `{}`'.format(command))
+        rc, out, err = self._module.run_command(command, **kwargs)
+        if rc != 0:
+            self.log('Command `{}` returned invalid status code: `{}`'.format(
+                command, rc), level=syslog.LOG_WARNING)
+        return {'rc': rc,
+                'out': out,
+                'out_lines': [line for line in out.split('\n') if line],
+                'err': err,
+                'err_lines': [line for line in out.split('\n') if line]}
+
+    def log(self, msg, level=syslog.LOG_DEBUG):
+        '''Log to the system logging facility of the target system.'''
+        if os.name == 'posix': # syslog is unsupported on Windows.
+            syslog.syslog(level, str(msg))
+
+    def fail(self, msg):
+        self._module.fail_json(msg=msg)
+
+    def exit(self, changed=True, msg='', result=None):
+        self._module.exit_json(changed=changed, msg=msg, result=result)
+
+    def _parse_params(self, params):
+        for param in params:
+            if param in self._module.params:
+                value = self._module.params[param]
+                t = self._module.argument_spec[param].get('type')
+                if t == 'str' and value in ['None', 'none']:
+                    value = None
+                setattr(self, param, value)
+            else:
+                setattr(self, param, None)
+
+def chrooted(command, path, profile='/etc/profile', work_dir=None):
+    prefix = "chroot {path} bash -c 'source {profile}; ".format(
+        path=path, profile=profile)
+    if work_dir:
+        prefix += 'cd {work_dir}; '.format(work_dir=work_dir)
+    prefix += command
+    prefix += "'"
+    return prefix
+
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+# Statistics reported by `lvs` for each kind of cache.
+STATS_FIELDS = {
+    'cache':      ['cache_total_blocks', 'cache_used_blocks',
+                   'cache_dirty_blocks', 'cache_read_hits',
+                   'cache_read_misses', 'cache_write_hits',
+                   'cache_write_misses'],
+    'writecache': ['writecache_total_blocks', 'writecache_free_blocks',
+                   'writecache_writeback_blocks', 'writecache_error'],
+}
+
+# ------------------------------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+# ------------------------------------------------------------------------------
+# LOGIC ------------------------------------------------------------------------
+
+class LvmCache(BaseObject):
+    '''Cache a Logical Volume (the origin) with a faster device.
+    - `cache` (dm-cache): hot blocks are promoted to a cache pool; reads and
+      (in `writeback` mode) writes are served by it.
+    - `writecache` (dm-writecache): writes are buffered in a cache volume and
+      written back to the origin later.
+    '''
+    def __init__(self, module):
+        super(LvmCache, self).__init__(module, params=[
+            'name', 'vg', 'lv', 'pvs', 'size', 'type', 'mode', 'chunk_size'])
+
+    @property
+    def origin(self):
+        return '{}/{}'.format(self.vg, self.lv)
+
+    def lvs(self, fields, lv=None):
+        out = self.run_command(
+            'lvs --reportformat json --units b --nosuffix -o {} {}'.format(
+                ','.join(fields), lv or self.origin))
+        try:
+            return json.loads(out['out'])['report'][0]['lv'][0]
+        except (ValueError, KeyError, IndexError):
+            self.fail('Cannot parse `lvs` output: {}'.format(out['out']))
+
+    def segment_type(self):
+        return self.lvs(['segtype'])['segtype']
+
+    def extend_vg(self):
+        '''Add the cache Physical Volumes to the origin Volume Group.'''
+        out = self.run_command('pvs --noheadings -o pv_name,vg_name',
+                               check_rc=False)
+        vgs = dict((fields[0], fields[1] if len(fields) > 1 else None)
+                   for fields in (line.split() for line in out['out_lines']))
+        missing = [pv for pv in self.pvs if vgs.get(pv) != self.vg]
+        others = [pv for pv in missing if vgs.get(pv)]
+        if others:
+            self.fail('Physical Volumes already in another Volume Group: '
+                      '{}'.format(', '.join(others)))
+        if missing:
+            self.run_command('vgextend {} {}'.format(self.vg,
+                                                     ' '.join(missing)))
+
+    def create_cache(self):
+        self.run_command(
+            'lvcreate -y --type cache-pool -n {name} -L {size} {vg} '
+            '{pvs}'.format(name=self.name, size=self.size, vg=self.vg,
+                           pvs=' '.join(self.pvs)))
+        args = ['--cachemode {}'.format(self.mode)]
+        if self.chunk_size:
+            args.append('--chunksize {}'.format(self.chunk_size))
+        self.run_command(
+            'lvconvert -y --type cache --cachepool {vg}/{name} {args} '
+            '{origin}'.format(vg=self.vg, name=self.name, args=' '.join(args),
+                              origin=self.origin))
+
+    def create_writecache(self):
+        self.run_command(
+            'lvcreate -y -an -n {name} -L {size} {vg} {pvs}'.format(
+                name=self.name, size=self.size, vg=self.vg,
+                pvs=' '.join(self.pvs)))
+        self.run_command(
+            'lvconvert -y --type writecache --cachevol {name} {origin}'.format(
+                name=self.name, origin=self.origin))
+
+    def stats(self):
+        '''Describe the cache, including its usage and hits statistics.'''
+        fields = ['lv_name', 'vg_name', 'segtype', 'lv_dm_path']
+        if self.type == 'cache':
+            fields += ['cache_mode', 'chunk_size']
+        report = self.lvs(fields + STATS_FIELDS[self.type])
+        stats = dict((field, to_int(report.get(field)))
+                     for field in STATS_FIELDS[self.type])
+        if self.type == 'cache':
+            hits = (stats['cache_read_hits'] or 0) + \
+                   (stats['cache_write_hits'] or 0)
+            misses = (stats['cache_read_misses'] or 0) + \
+                     (stats['cache_write_misses'] or 0)
+            stats['hit_ratio'] = (round(float(hits) / (hits + misses), 4)
+                                  if hits + misses else None)
+        return {'name':   self.name,
+                'origin': self.origin,
+                'device': '/dev/{}'.format(self.origin),
+                'cache':  {'type':       self.type,
+                           'segtype':    report.get('segtype'),
+                           'mode':       report.get('cache_mode',
+                                                    'writeback'),
+                           'chunk_size': to_int(report.get('chunk_size')),
+                           'dm_path':    report.get('lv_dm_path'),
+                           'stats':      stats}}
+
+    def run(self):
+        if self.type == 'cache':
+            self.mode = self.mode or 'writethrough'
+        elif self.mode == 'writethrough':
+            self.fail('`writecache` caches only support `writeback` mode')
+        changed = False
+        if self.segment_type() != self.type: # Not cached yet.
+            self.extend_vg()
+            if self.type == 'cache':
+                self.create_cache()
+            else:
+                self.create_writecache()
+            changed = True
+        return changed, self.stats()
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    module = AnsibleModule(argument_spec={
+        'name':       {'type': 'str', 'required': True},
+        'vg':         {'type': 'str', 'required': True},
+        'lv':         {'type': 'str', 'required': True},
+        'pvs':        {'type': 'list', 'required': True},
+        'size':       {'type': 'str', 'required': True},
+        'type':       {'choices': ['cache', 'writecache'], 'required': False,
+                       'default': 'cache'},
+        'mode':       {'choices': ['writethrough', 'writeback'],
+                       'required': False, 'default': None},
+        'chunk_size': {'type': 'str', 'required': False, 'default': None},
+        })
+
+    lvm_cache = LvmCache(module)
+    changed, result = lvm_cache.run()
+    module.exit_json(changed=changed, msg='Logical Volume cached',
+                     result=result)
+
+# ------------------------------------------------------------------------------
+# ENTRY POINT ------------------------------------------------------------------
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
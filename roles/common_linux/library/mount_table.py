@@ -0,0 +1,496 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import errno
+import os
+import re
+import tempfile
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+# MODULE INFORMATIONS ----------------------------------------------------------
+
+DOCUMENTATION = '''
+---
+module: mount_table
+short_description: Write fstab and crypttab in bulk and mount their entries
+author:
+    - "Alessandro Molari"
+'''
+
+EXAMPLES = '''
+# Write `/etc/fstab` and `/etc/crypttab` at once (each file is rewritten
+# atomically, only when its content changes), then mount the entries in state
+# `mounted` under `/mnt/gentoo`.
+# Entries are usually built by the `mount_spec` and `crypttab_spec` filters.
+- name: Mount partitions
+  mount_table:
+    entries:
+      - name:   root
+        device: /dev/vg/root
+        path:   /
+        fs:     ext4
+        opts:   defaults,relatime,acl
+        backup: 0
+        check:  1
+        state:  mounted
+    crypttab:
+      - name:     luks-lvm
+        device:   /dev/sda2
+        password: none
+        opts:     luks,discard
+    root_dir: /mnt/gentoo
+
+# Entries can be grouped in waves (e.g. by the `mount_levels` filter): the
+# entries of a wave are mounted concurrently, after the previous wave is done.
+# A plain list is mounted one entry at a time.
+- name: Mount partitions
+  mount_table:
+    entries:  "{{ partitions |
+                  selectattr('mount', 'defined') |
+                  map('mount_spec') |
+                  list |
+                  mount_levels('path', 'device', 'opts') }}"
+    root_dir: /mnt/gentoo
+'''
+
+# ------------------------------------------------------------------------------
+# COMMONS (copy&paste) ---------------------------------------------------------
+
+class BaseObject(object):
+    import syslog, os
+
+    '''Base class for all classes that use AnsibleModule.
+    Dependencies:
+    - `chrooted` function.
+    '''
+    def __init__(self, module, params=None):
+        syslog.openlog('ansible-{module}-{name}'.format(
+            module=os.path.basename(__file__), name=self.__class__.__name__))
+        self.work_dir = None
+        self.chroot = None
+        self._module = module
+        self._command_prefix = None
+        if params:
+            self._parse_params(params)
+
+    @property
+    def command_prefix(self):
+        return self._command_prefix
+
+    @command_prefix.setter
+    def command_prefix(self, value):
+        self._command_prefix = value
+
+    def run_command(self, command=None, **kwargs):
+        if not 'check_rc' in kwargs:
+            kwargs['check_rc'] = True
+        if command is None and self.command_prefix is None:
+            self.fail('Invalid command')
+        if self.command_prefix:
+            command = '{prefix} {command}'.format(
+                prefix=self.command_prefix, command=command or '')
+        if self.work_dir and not self.chroot:
+            command = 'cd {work_dir}; {command}'.format(
+                work_dir=self.work_dir, command=command)
+        if self.chroot:
+            command = chrooted(command, self.chroot, work_dir=self.work_dir)
+        self.log('Performing command `{}`'.format(command))
+        rc, out, err = self._module.run_command(command, **kwargs)
+        if rc != 0:
+            self.log('Command `{}` returned invalid status code: `{}`'.format(
+                command, rc), level=syslog.LOG_WARNING)
+        return {'rc': rc,
+                'out': out,
+                'out_lines': [line for line in out.split('\n') if line],
+                'err': err,
+                'err_lines': [line for line in out.split('\n') if line]}
+
+    def log(self, msg, level=syslog.LOG_DEBUG):
+        '''Log to the system logging facility of the target system.'''
+        if os.name == 'posix': # syslog is unsupported on Windows.
+            syslog.syslog(level, str(msg))
+
+    def fail(self, msg):
+        self._module.fail_json(msg=msg)
+
+    def exit(self, changed=True, msg='', result=None):
+        self._module.exit_json(changed=changed, msg=msg, result=result)
+
+    def _parse_params(self, params):
+        for param in params:
+            if param in self._module.params:
+                value = self._module.params[param]
+                t = self._module.argument_spec[param].get('type')
+                if t == 'str' and value in ['None', 'none']:
+                    value = None
+                setattr(self, param, value)
+            else:
+                setattr(self, param, None)
+
+def chrooted(command, path, profile='/etc/profile', work_dir=None):
+    prefix = "chroot {path} bash -c 'source {profile}; ".format(
+        path=path, profile=profile)
+    if work_dir:
+        prefix += 'cd {work_dir}; '.format(work_dir=work_dir)
+    prefix += command
+    prefix += "'"
+    return prefix
+
+class MountInfo(object):
+    '''Mount table of the current process, read from `/proc/self/mountinfo`
+    (see `proc(5)`).
+    Each mount is a dict holding its `id` and the `parent` mount id, so the
+    real mount tree (including stacked, bind and shared mounts) can be built.
+    '''
+    PATH = '/proc/self/mountinfo'
+
+    def __init__(self, path=None):
+        with open(path or self.PATH) as f:
+            self.mounts = [self.parse_line(line) for line in f if line.strip()]
+        self.by_id = dict((mount['id'], mount) for mount in self.mounts)
+
+    @staticmethod
+    def unescape(value):
+        '''Decode octal escapes (e.g. `\\040` for spaces).'''
+        return re.sub(r'\\([0-7]{3})',
+                      lambda md: chr(int(md.group(1), 8)), value)
+
+    @classmethod
+    def parse_line(cls, line):
+        fields = line.split()
+        # Optional fields (propagation) are terminated by a single hyphen.
+        sep = fields.index('-', 6)
+        return {'id':          int(fields[0]),
+                'parent':      int(fields[1]),
+                'device':      fields[2],
+                'root':        cls.unescape(fields[3]),
+                'path':        cls.unescape(fields[4]),
+                'opts':        fields[5],
+                'propagation': fields[6:sep],
+                'fs':          fields[sep + 1],
+                'source':      cls.unescape(fields[sep + 2]),
+                'super_opts':  fields[sep + 3] if len(fields) > sep + 3 else ''}
+
+    def under(self, root):
+        '''Mounts at or below the path `root`.'''
+        root = root.rstrip('/') or '/'
+        prefix = root if root == '/' else root + '/'
+        return [mount for mount in self.mounts
+                if mount['path'] == root or mount['path'].startswith(prefix)]
+
+    def find(self, path):
+        '''The mount visible at `path` (i.e. the last one mounted there).'''
+        found = None
+        for mount in self.mounts:
+            if mount['path'] == path:
+                found = mount
+        return found
+
+def _replace_file(tmp_path, path):
+    '''Move the (already synced) `tmp_path` over `path`, keeping its mode.'''
+    if os.path.exists(path):
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    else:
+        os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+
+def atomic_write(path, content):
+    '''Replace the file at `path` with `content`, without leaving it truncated
+    or half-written if something goes wrong.
+    Nothing is written if the file already has that content.
+    Return `True` if the file has been written.
+    '''
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        _replace_file(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+class ConfigEditor(object):
+    '''Edit a line-based configuration file with many rules at once.
+    Each rule is `(regexp, replacement, append_if_missing, template)`: lines
+    matching `regexp` are replaced by `replacement` (`None` removes them),
+    taken literally unless `template` is set (then it's a `re` template). The
+    first matching rule wins. If no line matches a rule with
+    `append_if_missing`, its replacement is appended to the file.
+    The file is read and rewritten in a single streaming pass and replaced
+    atomically, only if its content changes (a missing file is created only
+    if there's something to write).
+    '''
+    def __init__(self, path, rules=None):
+        self.path = path
+        self.rules = []
+        for rule in rules or []:
+            self.rule(*rule)
+
+    def rule(self, regexp, replacement, append_if_missing=False,
+             template=False):
+        self.rules.append((re.compile(regexp), replacement, append_if_missing,
+                           template))
+        return self
+
+    @staticmethod
+    def terminated(line):
+        '''`line` ending with a newline (e.g. the last line of a file).'''
+        if line is None or line.endswith('\n'):
+            return line
+        return line + '\n'
+
+    def edit(self, lines):
+        '''Yield `(old line, new line)` pairs (`None` for missing lines).
+        New lines always end with a newline.
+        '''
+        matched = [False] * len(self.rules)
+        for line in lines:
+            new_line = self.terminated(line)
+            for idx, (regexp, replacement, _, template) in \
+                    enumerate(self.rules):
+                md = regexp.match(line.rstrip('\n'))
+                if md:
+                    matched[idx] = True
+                    if replacement is None:
+                        new_line = None
+                    elif template:
+                        new_line = md.expand(replacement) + '\n'
+                    else:
+                        new_line = replacement + '\n'
+                    break
+            yield line, new_line
+        for idx, (_, replacement, append_if_missing, _) in \
+                enumerate(self.rules):
+            if append_if_missing and not matched[idx] and replacement:
+                yield None, replacement + '\n'
+
+    def apply(self):
+        '''Apply the rules. Return `True` if the file has been changed.'''
+        try:
+            src = open(self.path)
+        except (IOError, OSError):
+            src = None
+        changed = False
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            prefix='.{}.'.format(os.path.basename(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as dst:
+                for old_line, new_line in self.edit(src or []):
+                    # A missing final newline alone isn't a change.
+                    if new_line != self.terminated(old_line):
+                        changed = True
+                    if new_line is not None:
+                        dst.write(new_line)
+                if changed:
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            if changed:
+                _replace_file(tmp_path, self.path)
+            else:
+                os.remove(tmp_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            if src is not None:
+                src.close()
+        return changed
+
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+HEADER = '# Generated by Ansible: manual changes will be overwritten.\n'
+
+# ------------------------------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
+
+def run_concurrently(fn, items):
+    '''Call `fn` on each item in its own thread, returning the results.'''
+    results = [None] * len(items)
+    def run(idx):
+        results[idx] = fn(items[idx])
+    threads = [threading.Thread(target=run, args=(idx,))
+               for idx in range(len(items))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def render_table(rows):
+    '''Render `rows` (lists of strings) as aligned columns.
+    Rows given as strings are comments: they're rendered as they are.
+    '''
+    columns = [row for row in rows if isinstance(row, list)]
+    if not columns:
+        return ''.join('# {}\n'.format(row) for row in rows)
+    widths = [max(len(row[idx]) for row in columns)
+              for idx in range(len(columns[0]))]
+    return ''.join('# {}\n'.format(row) if not isinstance(row, list) else
+                   ' '.join(value.ljust(width)
+                            for value, width in zip(row, widths)).rstrip() + '\n'
+                   for row in rows)
+
+# ------------------------------------------------------------------------------
+# LOGIC ------------------------------------------------------------------------
+
+class MountTable(BaseObject):
+    '''Write the whole mount table (`fstab`, `crypttab`) in one go, instead of
+    editing the files once per entry, and mount the entries.
+    '''
+    def __init__(self, module):
+        super(MountTable, self).__init__(module, params=[
+            'entries', 'crypttab', 'fstab_path', 'crypttab_path', 'root_dir'])
+        if any(isinstance(entry, list) for entry in self.entries):
+            self.waves = [entry if isinstance(entry, list) else [entry]
+                          for entry in self.entries]
+        else:
+            self.waves = [[entry] for entry in self.entries]
+        self.entries = [entry for wave in self.waves for entry in wave]
+        self.changed = False
+        self.mounted = []
+        self.waves_seconds = []
+
+    def render_fstab(self):
+        rows = []
+        for entry in self.entries:
+            if entry.get('state') == 'absent':
+                continue
+            if entry.get('profile'):
+                rows.append('{}: profile {}{}'.format(
+                    entry.get('name'), entry['profile'],
+                    ', lazy' if entry.get('lazy') else ''))
+            rows.append([str(entry[key]) for key in
+                         ['device', 'path', 'fs', 'opts', 'backup', 'check']])
+        return HEADER + render_table(rows)
+
+    def render_crypttab(self):
+        rows = [[entry['name'], entry['device'],
+                 entry.get('password') or 'none', entry.get('opts') or 'luks']
+                for entry in self.crypttab]
+        return HEADER + render_table(rows)
+
+    def write(self):
+        if atomic_write(self.fstab_path, self.render_fstab()):
+            self.changed = True
+        if self.crypttab is not None:
+            if atomic_write(self.crypttab_path, self.render_crypttab()):
+                self.changed = True
+
+    def target(self, entry):
+        return os.path.join(self.root_dir, entry['path'].lstrip('/')).rstrip('/')
+
+    def source(self, entry):
+        '''The device to mount: bind mounts sources are paths in the target
+        system too.
+        '''
+        opts = entry['opts'].split(',')
+        if 'bind' in opts or 'rbind' in opts:
+            return self.target({'path': entry['device']})
+        return entry['device']
+
+    def mount_entry(self, entry):
+        '''Mount a single entry, returning the error message (if any).
+        Called concurrently: failures are reported, not raised.
+        '''
+        target = self.target(entry)
+        try:
+            os.makedirs(target)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return 'Cannot create `{}`: {}'.format(target, e)
+        out = self.run_command(
+            'mount -t {fs} -o {opts} {device} {target}'.format(
+                fs=entry['fs'], opts=entry['opts'], device=self.source(entry),
+                target=target), check_rc=False)
+        if out['rc'] != 0:
+            return 'Cannot mount `{}`: {}'.format(target, out['err'].strip())
+        return None
+
+    def mount(self):
+        if not self.root_dir:
+            return
+        mount_info = MountInfo()
+        for wave in self.waves:
+            pending = [entry for entry in wave
+                       if entry.get('state') == 'mounted' and
+                          entry['fs'] != 'swap' and
+                          not mount_info.find(self.target(entry))]
+            if not pending:
+                continue
+            start = time.time()
+            errors = run_concurrently(self.mount_entry, pending)
+            self.waves_seconds.append(round(time.time() - start, 3))
+            for entry, error in zip(pending, errors):
+                if error is None:
+                    self.mounted.append(self.target(entry))
+                    self.changed = True
+            errors = [error for error in errors if error]
+            if errors:
+                # Next waves would be mounted over the missing mounts.
+                self.fail('; '.join(errors))
+
+    def run(self):
+        for entry in self.entries:
+            missing = [key for key in ['device', 'path', 'fs', 'opts']
+                       if not entry.get(key)]
+            if missing:
+                self.fail('Invalid entry `{}`: missing {}'.format(
+                    entry.get('name'), ', '.join(missing)))
+        self.write()
+        self.mount()
+        return {'fstab': self.fstab_path,
+                'crypttab': self.crypttab_path if self.crypttab is not None
+                            else None,
+                'mounted': self.mounted,
+                'waves_seconds': self.waves_seconds}
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    module = AnsibleModule(argument_spec={
+        'entries':       {'type': 'list', 'required': True},
+        'crypttab':      {'type': 'list', 'required': False, 'default': None},
+        'fstab_path':    {'type': 'str', 'required': False,
+                          'default': '/etc/fstab'},
+        'crypttab_path': {'type': 'str', 'required': False,
+                          'default': '/etc/crypttab'},
+        'root_dir':      {'type': 'str', 'required': False, 'default': None},
+        })
+
+    mount_table = MountTable(module)
+    result = mount_table.run()
+    module.exit_json(changed=mount_table.changed, msg='Mount table updated',
+                     result=result)
+
+# ------------------------------------------------------------------------------
+# ENTRY POINT ------------------------------------------------------------------
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
@@ -0,0 +1,593 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import os
+import re
+import tempfile
+
+# ------------------------------------------------------------------------------
+# MODULE INFORMATIONS ----------------------------------------------------------
+
+DOCUMENTATION = '''
+---
+module: raid
+short_description: Create software RAID arrays and register them
+author:
+    - "Alessandro Molari"
+'''
+
+EXAMPLES = '''
+# Stripe two partitions (RAID0). The chunk size is chosen from the members
+# (smaller on SSDs) unless given (in KiB).
+- name: Create RAID arrays
+  raid:
+    name:    md-data
+    level:   0
+    devices:
+      - /dev/sda3
+      - /dev/sdb3
+
+# Mirror two partitions (RAID1).
+- name: Create RAID arrays
+  raid:
+    name:    md-root
+    level:   1
+    devices:
+      - /dev/sda2
+      - /dev/sdb2
+
+# Register the arrays (names or devices) into the installed system:
+# `mdadm.conf` ARRAY lines and dracut configuration (so the initramfs
+# assembles them).
+- name: Register RAID arrays
+  raid:
+    action:   register
+    arrays:
+      - md-data
+      - md-root
+    root_dir: /mnt/gentoo
+
+# Loop devices can be used as members, e.g. to try a layout:
+#   $ truncate -s 1G /tmp/a.img /tmp/b.img
+#   $ losetup -f --show /tmp/a.img; losetup -f --show /tmp/b.img
+- name: Create RAID arrays
+  raid:
+    name:    md-test
+    level:   0
+    devices:
+      - /dev/loop0
+      - /dev/loop1
+'''
+
+# ------------------------------------------------------------------------------
+# COMMONS (copy&paste) ---------------------------------------------------------
+
+class BaseObject(object):
+    import syslog, os
+
+    '''Base class for all classes that use AnsibleModule.
+    Dependencies:
+    - `chrooted` function.
+    '''
+    def __init__(self, module, params=None):
+        syslog.openlog('ansible-{module}-{name}'.format(
+            module=os.path.basename(__file__), name=self.__class__.__name__))
+        self.work_dir = None
+        self.chroot = None
+        self._module = module
+        self._command_prefix = None
+        if params:
+            self._parse_params(params)
+
+    @property
+    def command_prefix(self):
+        return self._command_prefix
+
+    @command_prefix.setter
+    def command_prefix(self, value):
+        self._command_prefix = value
+
+    def run_command(self, command=None, **kwargs):
+        if not 'check_rc' in kwargs:
+            kwargs['check_rc'] = True
+        if command is None and self.command_prefix is None:
+            self.fail('Invalid command')
+        if self.command_prefix:
+            command = '{prefix} {command}'.format(
+                prefix=self.command_prefix, command=command or '')
+        if self.work_dir and not self.chroot:
+            command = 'cd {work_dir}; {command}'.format(
+                work_dir=self.work_dir, command=command)
+        if self.chroot:
+            command = chrooted(command, self.chroot, work_dir=self.work_dir)
+        self.log('Performing command `{}`'.format(command))
+        rc, out, err = self._module.run_command(command, **kwargs)
+        if rc != 0:
+            self.log('Command `{}` returned invalid status code: `{}`'.format(
+                command, rc), level=syslog.LOG_WARNING)
+        return {'rc': rc,
+                'out': out,
+                'out_lines': [line for line in out.split('\n') if line],
+                'err': err,
+                'err_lines': [line for line in out.split('\n') if line]}
+
+    def log(self, msg, level=syslog.LOG_DEBUG):
+        '''Log to the system logging facility of the target system.'''
+        if os.name == 'posix': # syslog is unsupported on Windows.
+            syslog.syslog(level, str(msg))
+
+    def fail(self, msg):
+        self._module.fail_json(msg=msg)
+
+    def exit(self, changed=True, msg='', result=None):
+        self._module.exit_json(changed=changed, msg=msg, result=result)
+
+    def _parse_params(self, params):
+        for param in params:
+            if param in self._module.params:
+                value = self._module.params[param]
+                t = self._module.argument_spec[param].get('type')
+                if t == 'str' and value in ['None', 'none']:
+                    value = None
+                setattr(self, param, value)
+            else:
+                setattr(self, param, None)
+
+def chrooted(command, path, profile='/etc/profile', work_dir=None):
+    prefix = "chroot {path} bash -c 'source {profile}; ".format(
+        path=path, profile=profile)
+    if work_dir:
+        prefix += 'cd {work_dir}; '.format(work_dir=work_dir)
+    prefix += command
+    prefix += "'"
+    return prefix
+
+class BlockDevice(object):
+    '''Topology of a block device, as exposed by sysfs.
+    Partitions don't have a request queue: queue attributes are read from the
+    disk holding them.
+    '''
+    SYSFS_DIR = '/sys/class/block'
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(os.path.realpath(path))
+        self.sysfs_dir = os.path.realpath(os.path.join(self.SYSFS_DIR,
+                                                       self.name))
+
+    @property
+    def exists(self):
+        return os.path.isdir(self.sysfs_dir)
+
+    @property
+    def is_partition(self):
+        return os.path.isfile(os.path.join(self.sysfs_dir, 'partition'))
+
+    @property
+    def disk(self):
+        '''The whole disk (itself, unless it's a partition).'''
+        if self.is_partition:
+            return BlockDevice(os.path.join(
+                '/dev', os.path.basename(os.path.dirname(self.sysfs_dir))))
+        return self
+
+    def read(self, attr, default=None):
+        try:
+            with open(os.path.join(self.sysfs_dir, attr)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return default
+
+    def read_int(self, attr, default=0):
+        try:
+            return int(self.read(attr))
+        except (TypeError, ValueError):
+            return default
+
+    def queue(self, attr, default=0):
+        return self.disk.read_int(os.path.join('queue', attr), default)
+
+    @property
+    def size(self):
+        '''Size in bytes (sysfs always counts 512-byte sectors).'''
+        return self.read_int('size') * 512
+
+    @property
+    def logical_block_size(self):
+        return self.queue('logical_block_size', 512)
+
+    @property
+    def physical_block_size(self):
+        return self.queue('physical_block_size', 512)
+
+    @property
+    def minimum_io_size(self):
+        return self.queue('minimum_io_size', 0)
+
+    @property
+    def optimal_io_size(self):
+        return self.queue('optimal_io_size', 0)
+
+    @property
+    def rotational(self):
+        return self.queue('rotational', 1) == 1
+
+    @property
+    def discard(self):
+        return self.queue('discard_max_bytes', 0) > 0
+
+    @property
+    def is_nvme(self):
+        if self.disk.name.startswith('nvme'):
+            return True
+        # Stacked devices (dm, md) are NVMe-backed if all their slaves are.
+        slaves = self.disk.slaves
+        return len(slaves) > 0 and all(slave.is_nvme for slave in slaves)
+
+    @property
+    def partitions(self):
+        try:
+            names = sorted(os.listdir(self.sysfs_dir))
+        except OSError:
+            names = []
+        return [BlockDevice(os.path.join('/dev', name)) for name in names
+                if os.path.isfile(os.path.join(self.sysfs_dir, name,
+                                               'partition'))]
+
+    @property
+    def slaves(self):
+        return self._related('slaves')
+
+    @property
+    def holders(self):
+        return self._related('holders')
+
+    @property
+    def dm_name(self):
+        return self.read('dm/name')
+
+    @property
+    def dm_uuid(self):
+        return self.read('dm/uuid')
+
+    def _related(self, kind):
+        try:
+            names = sorted(os.listdir(os.path.join(self.sysfs_dir, kind)))
+        except OSError:
+            names = []
+        return [BlockDevice(os.path.join('/dev', name)) for name in names]
+
+    def to_dict(self):
+        return {'name':                self.name,
+                'size':                self.size,
+                'logical_block_size':  self.logical_block_size,
+                'physical_block_size': self.physical_block_size,
+                'minimum_io_size':     self.minimum_io_size,
+                'optimal_io_size':     self.optimal_io_size,
+                'rotational':          self.rotational,
+                'discard':             self.discard,
+                'nvme':                self.is_nvme}
+
+def _replace_file(tmp_path, path):
+    '''Move the (already synced) `tmp_path` over `path`, keeping its mode.'''
+    if os.path.exists(path):
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    else:
+        os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+
+def atomic_write(path, content):
+    '''Replace the file at `path` with `content`, without leaving it truncated
+    or half-written if something goes wrong.
+    Nothing is written if the file already has that content.
+    Return `True` if the file has been written.
+    '''
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        _replace_file(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+class ConfigEditor(object):
+    '''Edit a line-based configuration file with many rules at once.
+    Each rule is `(regexp, replacement, append_if_missing, template)`: lines
+    matching `regexp` are replaced by `replacement` (`None` removes them),
+    taken literally unless `template` is set (then it's a `re` template). The
+    first matching rule wins. If no line matches a rule with
+    `append_if_missing`, its replacement is appended to the file.
+    The file is read and rewritten in a single streaming pass and replaced
+    atomically, only if its content changes (a missing file is created only
+    if there's something to write).
+    '''
+    def __init__(self, path, rules=None):
+        self.path = path
+        self.rules = []
+        for rule in rules or []:
+            self.rule(*rule)
+
+    def rule(self, regexp, replacement, append_if_missing=False,
+             template=False):
+        self.rules.append((re.compile(regexp), replacement, append_if_missing,
+                           template))
+        return self
+
+    @staticmethod
+    def terminated(line):
+        '''`line` ending with a newline (e.g. the last line of a file).'''
+        if line is None or line.endswith('\n'):
+            return line
+        return line + '\n'
+
+    def edit(self, lines):
+        '''Yield `(old line, new line)` pairs (`None` for missing lines).
+        New lines always end with a newline.
+        '''
+        matched = [False] * len(self.rules)
+        for line in lines:
+            new_line = self.terminated(line)
+            for idx, (regexp, replacement, _, template) in \
+                    enumerate(self.rules):
+                md = regexp.match(line.rstrip('\n'))
+                if md:
+                    matched[idx] = True
+                    if replacement is None:
+                        new_line = None
+                    elif template:
+                        new_line = md.expand(replacement) + '\n'
+                    else:
+                        new_line = replacement + '\n'
+                    break
+            yield line, new_line
+        for idx, (_, replacement, append_if_missing, _) in \
+                enumerate(self.rules):
+            if append_if_missing and not matched[idx] and replacement:
+                yield None, replacement + '\n'
+
+    def apply(self):
+        '''Apply the rules. Return `True` if the file has been changed.'''
+        try:
+            src = open(self.path)
+        except (IOError, OSError):
+            src = None
+        changed = False
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            prefix='.{}.'.format(os.path.basename(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as dst:
+                for old_line, new_line in self.edit(src or []):
+                    # A missing final newline alone isn't a change.
+                    if new_line != self.terminated(old_line):
+                        changed = True
+                    if new_line is not None:
+                        dst.write(new_line)
+                if changed:
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            if changed:
+                _replace_file(tmp_path, self.path)
+            else:
+                os.remove(tmp_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            if src is not None:
+                src.close()
+        return changed
+
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+HEADER = '# Generated by Ansible: manual changes will be overwritten.\n'
+
+ARRAYS_HEADER = '# RAID arrays (generated by Ansible).'
+
+MDADM_CONF = 'etc/mdadm.conf'
+DRACUT_CONF = 'etc/dracut.conf.d/mdraid.conf'
+
+# Default chunk sizes (KiB): large chunks keep each disk streaming on
+# rotational members, SSDs don't pay for seeks and prefer smaller ones.
+ROTATIONAL_CHUNK_SIZE = 512
+SSD_CHUNK_SIZE = 128
+
+# ------------------------------------------------------------------------------
+# LOGIC ------------------------------------------------------------------------
+
+class RaidArray(BaseObject):
+    '''A `mdadm` array (RAID0, RAID1 or RAID10) made of block devices.'''
+    def __init__(self, module):
+        super(RaidArray, self).__init__(module, params=[
+            'name', 'level', 'devices', 'chunk_size'])
+        self.path = '/dev/md/{}'.format(self.name)
+
+    def chunk(self, existing=False):
+        '''The chunk size in KiB (RAID1 has none). For an `existing` array,
+        the one it has been created with.
+        '''
+        if self.level == 1:
+            return None
+        if existing:
+            return BlockDevice(self.path).read_int('md/chunk_size') // 1024 \
+                   or None
+        if self.chunk_size:
+            return int(self.chunk_size)
+        members = [BlockDevice(device) for device in self.devices]
+        if any(member.rotational for member in members):
+            return ROTATIONAL_CHUNK_SIZE
+        return SSD_CHUNK_SIZE
+
+    def data_disks(self):
+        if self.level == 0:
+            return len(self.devices)
+        elif self.level == 10: # Default layout: 2 copies.
+            return len(self.devices) // 2
+        return 1
+
+    def detail(self):
+        '''Array informations from `mdadm --detail --export`.'''
+        out = self.run_command('mdadm --detail --export {}'.format(self.path),
+                               check_rc=False)
+        if out['rc'] != 0:
+            return None
+        return dict(line.split('=', 1) for line in out['out_lines']
+                    if '=' in line)
+
+    def create(self):
+        args = ['--run', '--metadata=1.2',
+                '--level={}'.format(self.level),
+                '--raid-devices={}'.format(len(self.devices)),
+                '--name={}'.format(self.name)]
+        if self.chunk():
+            args.append('--chunk={}'.format(self.chunk()))
+        self.run_command('mdadm --create {path} {args} {devices}'.format(
+            path=self.path, args=' '.join(args),
+            devices=' '.join(self.devices)))
+
+    def run(self):
+        if not self.level in [0, 1, 10]:
+            self.fail('Unsupported RAID level `{}`'.format(self.level))
+        for device in self.devices:
+            if not BlockDevice(device).exists:
+                self.fail('Unknown RAID member `{}`'.format(device))
+        minimum = {0: 2, 1: 2, 10: 4}[self.level]
+        if len(self.devices) < minimum:
+            self.fail('RAID{} needs at least {} devices'.format(self.level,
+                                                                minimum))
+
+        changed = False
+        detail = self.detail()
+        if detail is None:
+            self.create()
+            detail = self.detail() or {}
+            changed = True
+        elif detail.get('MD_LEVEL') != 'raid{}'.format(self.level):
+            self.fail('Array `{}` already exists as `{}`'.format(
+                self.path, detail.get('MD_LEVEL')))
+        else:
+            members = sorted(slave.name
+                             for slave in BlockDevice(self.path).slaves)
+            expected = sorted(BlockDevice(device).name
+                              for device in self.devices)
+            if members != expected:
+                self.fail('Array `{}` already exists with members `{}`'.format(
+                    self.path, ', '.join(members)))
+
+        chunk = self.chunk(existing=not changed)
+        stripe_unit = chunk * 1024 if chunk else None
+        return changed, {
+            'name':   self.name,
+            'device': self.path,
+            'raid':   {'level':        self.level,
+                       'devices':      self.devices,
+                       'md_device':    BlockDevice(self.path).name,
+                       'uuid':         detail.get('MD_UUID'),
+                       'chunk_size':   stripe_unit,
+                       # Stripe geometry, used when formatting the array.
+                       'stripe_unit':  stripe_unit,
+                       'stripes':      self.data_disks() if chunk else None}}
+
+class RaidRegistry(BaseObject):
+    '''Persist the `arrays` (names or devices) into the installed system, so
+    that they're assembled at boot. Other arrays of the host aren't.
+    '''
+    def __init__(self, module):
+        super(RaidRegistry, self).__init__(module,
+                                           params=['arrays', 'root_dir'])
+
+    def path(self, relative_path):
+        return os.path.join(self.root_dir or '/', relative_path)
+
+    def mdadm_conf(self, arrays):
+        '''Replace the ARRAY lines of `mdadm.conf`, keeping the rest.'''
+        try:
+            with open(self.path(MDADM_CONF)) as f:
+                lines = [line for line in f.read().splitlines()
+                         if not re.match(r'\s*ARRAY\s', line) and
+                            line != ARRAYS_HEADER]
+        except (IOError, OSError):
+            lines = []
+        while lines and not lines[-1].strip():
+            lines.pop()
+        return '\n'.join(lines + ([''] if lines else []) +
+                         [ARRAYS_HEADER] + arrays) + '\n'
+
+    def run(self):
+        devices = [array if array.startswith('/')
+                   else '/dev/md/{}'.format(array) for array in self.arrays]
+        out = self.run_command('mdadm --detail --brief {}'.format(
+            ' '.join(devices)))
+        arrays = [line for line in out['out_lines'] if line.startswith('ARRAY')]
+        changed = False
+        for relative_path, content in [
+                (MDADM_CONF, self.mdadm_conf(arrays)),
+                (DRACUT_CONF, HEADER + 'add_dracutmodules+=" mdraid "\n'
+                                       'mdadmconf="yes"\n')]:
+            path = self.path(relative_path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            changed = atomic_write(path, content) or changed
+        return changed, {'arrays': arrays}
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    module = AnsibleModule(argument_spec={
+        'action':     {'choices': ['create', 'register'], 'required': False,
+                       'default': 'create'},
+        'name':       {'type': 'str', 'required': False, 'default': None},
+        'level':      {'type': 'int', 'required': False, 'default': None},
+        'devices':    {'type': 'list', 'required': False, 'default': []},
+        'chunk_size': {'type': 'int', 'required': False, 'default': None},
+        # Arrays to register (names or devices).
+        'arrays':     {'type': 'list', 'required': False, 'default': []},
+        'root_dir':   {'type': 'str', 'required': False, 'default': '/'},
+        })
+
+    if module.params['action'] == 'create':
+        missing = [param for param in ['name', 'level', 'devices']
+                   if module.params[param] in [None, []]]
+        if missing:
+            module.fail_json(msg='Missing parameters: {}'.format(
+                ', '.join(missing)))
+        changed, result = RaidArray(module).run()
+        msg = 'RAID array created'
+    elif not module.params['arrays']:
+        module.fail_json(msg='Missing parameters: arrays')
+    else:
+        changed, result = RaidRegistry(module).run()
+        msg = 'RAID arrays registered'
+
+    module.exit_json(changed=changed, msg=msg, result=result)
+
+# ------------------------------------------------------------------------------
+# ENTRY POINT ------------------------------------------------------------------
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
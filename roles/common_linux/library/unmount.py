@@ -3,7 +3,14 @@
 # ------------------------------------------------------------------------------
 # IMPORTS ----------------------------------------------------------------------
 
+import os
 import re
+import threading
+
+try:
+    from shlex import quote
+except ImportError: # Python 2.
+    from pipes import quote
 
 # ------------------------------------------------------------------------------
 # MODULE INFORMATIONS ----------------------------------------------------------
@@ -22,6 +29,18 @@ EXAMPLES = '''
     basic:      /mnt/gentoo
     encryption: true
     lvm:        true
+
+# Also tear down the mapped devices stacked on some disks, even if they
+# aren't mounted.
+- name: Unmount pre-existing partitions and mapped devices
+  unmount:
+    basic:      /mnt/gentoo
+    encryption: true
+    lvm:        true
+    raid:       true
+    disks:
+      - /dev/sda
+      - /dev/sdb
 '''
 
 # ------------------------------------------------------------------------------
@@ -107,69 +126,518 @@ def chrooted(command, path, profile='/etc/profile', work_dir=None):
     prefix += "'"
     return prefix
 
-# ------------------------------------------------------------------------------
-# UNMOUNT POLICIES -------------------------------------------------------------
+class BlockDevice(object):
+    '''Topology of a block device, as exposed by sysfs.
+    Partitions don't have a request queue: queue attributes are read from the
+    disk holding them.
+    '''
+    SYSFS_DIR = '/sys/class/block'
 
-class BasicUnmounter(BaseObject):
-    ''' Unmount all (mounted) partitions.
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(os.path.realpath(path))
+        self.sysfs_dir = os.path.realpath(os.path.join(self.SYSFS_DIR,
+                                                       self.name))
 
-    Partitions that can't be unmounted are those in use, so the command should
-    work correctly (i.e. unmount only partitions of the current setup).
-    '''
-    def __init__(self, module):
-        super(BasicUnmounter, self).__init__(module, params=['basic'])
+    @property
+    def exists(self):
+        return os.path.isdir(self.sysfs_dir)
+
+    @property
+    def is_partition(self):
+        return os.path.isfile(os.path.join(self.sysfs_dir, 'partition'))
+
+    @property
+    def disk(self):
+        '''The whole disk (itself, unless it's a partition).'''
+        if self.is_partition:
+            return BlockDevice(os.path.join(
+                '/dev', os.path.basename(os.path.dirname(self.sysfs_dir))))
+        return self
+
+    def read(self, attr, default=None):
+        try:
+            with open(os.path.join(self.sysfs_dir, attr)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return default
+
+    def read_int(self, attr, default=0):
+        try:
+            return int(self.read(attr))
+        except (TypeError, ValueError):
+            return default
+
+    def queue(self, attr, default=0):
+        return self.disk.read_int(os.path.join('queue', attr), default)
+
+    @property
+    def size(self):
+        '''Size in bytes (sysfs always counts 512-byte sectors).'''
+        return self.read_int('size') * 512
+
+    @property
+    def logical_block_size(self):
+        return self.queue('logical_block_size', 512)
+
+    @property
+    def physical_block_size(self):
+        return self.queue('physical_block_size', 512)
+
+    @property
+    def minimum_io_size(self):
+        return self.queue('minimum_io_size', 0)
+
+    @property
+    def optimal_io_size(self):
+        return self.queue('optimal_io_size', 0)
+
+    @property
+    def rotational(self):
+        return self.queue('rotational', 1) == 1
 
-    def run(self):
-        result = []
-        mount_points = []
+    @property
+    def discard(self):
+        return self.queue('discard_max_bytes', 0) > 0
 
-        lines = self.run_command('mount')['out_lines']
+    @property
+    def is_nvme(self):
+        if self.disk.name.startswith('nvme'):
+            return True
+        # Stacked devices (dm, md) are NVMe-backed if all their slaves are.
+        slaves = self.disk.slaves
+        return len(slaves) > 0 and all(slave.is_nvme for slave in slaves)
+
+    @property
+    def partitions(self):
+        try:
+            names = sorted(os.listdir(self.sysfs_dir))
+        except OSError:
+            names = []
+        return [BlockDevice(os.path.join('/dev', name)) for name in names
+                if os.path.isfile(os.path.join(self.sysfs_dir, name,
+                                               'partition'))]
 
-        for line in lines:
-            md = re.match(r'.+on\s+(\S+).+', line)
-            if md:
-                mount_point = md.group(1)
-                if self.basic and mount_point.startswith(self.basic):
-                    mount_points.append(mount_point)
+    @property
+    def slaves(self):
+        return self._related('slaves')
 
-        sort_fn = lambda p: len([e for e in p.split('/') if e])
-        mount_points = sorted(mount_points, key=sort_fn, reverse=True)
+    @property
+    def holders(self):
+        return self._related('holders')
 
-        for mount_point in mount_points:
-            command = 'umount {mount_point}'.format(mount_point=mount_point)
-            rc = self.run_command(command, check_rc=False)['rc']
-            if rc == 0:
-                result.append({'type': 'mount point', 'path': mount_point})
+    @property
+    def dm_name(self):
+        return self.read('dm/name')
 
-        return result
+    @property
+    def dm_uuid(self):
+        return self.read('dm/uuid')
+
+    def _related(self, kind):
+        try:
+            names = sorted(os.listdir(os.path.join(self.sysfs_dir, kind)))
+        except OSError:
+            names = []
+        return [BlockDevice(os.path.join('/dev', name)) for name in names]
+
+    def to_dict(self):
+        return {'name':                self.name,
+                'size':                self.size,
+                'logical_block_size':  self.logical_block_size,
+                'physical_block_size': self.physical_block_size,
+                'minimum_io_size':     self.minimum_io_size,
+                'optimal_io_size':     self.optimal_io_size,
+                'rotational':          self.rotational,
+                'discard':             self.discard,
+                'nvme':                self.is_nvme}
+
+class MountInfo(object):
+    '''Mount table of the current process, read from `/proc/self/mountinfo`
+    (see `proc(5)`).
+    Each mount is a dict holding its `id` and the `parent` mount id, so the
+    real mount tree (including stacked, bind and shared mounts) can be built.
+    '''
+    PATH = '/proc/self/mountinfo'
+
+    def __init__(self, path=None):
+        with open(path or self.PATH) as f:
+            self.mounts = [self.parse_line(line) for line in f if line.strip()]
+        self.by_id = dict((mount['id'], mount) for mount in self.mounts)
+
+    @staticmethod
+    def unescape(value):
+        '''Decode octal escapes (e.g. `\\040` for spaces).'''
+        return re.sub(r'\\([0-7]{3})',
+                      lambda md: chr(int(md.group(1), 8)), value)
+
+    @classmethod
+    def parse_line(cls, line):
+        fields = line.split()
+        # Optional fields (propagation) are terminated by a single hyphen.
+        sep = fields.index('-', 6)
+        return {'id':          int(fields[0]),
+                'parent':      int(fields[1]),
+                'device':      fields[2],
+                'root':        cls.unescape(fields[3]),
+                'path':        cls.unescape(fields[4]),
+                'opts':        fields[5],
+                'propagation': fields[6:sep],
+                'fs':          fields[sep + 1],
+                'source':      cls.unescape(fields[sep + 2]),
+                'super_opts':  fields[sep + 3] if len(fields) > sep + 3 else ''}
+
+    def under(self, root):
+        '''Mounts at or below the path `root`.'''
+        root = root.rstrip('/') or '/'
+        prefix = root if root == '/' else root + '/'
+        return [mount for mount in self.mounts
+                if mount['path'] == root or mount['path'].startswith(prefix)]
+
+    def find(self, path):
+        '''The mount visible at `path` (i.e. the last one mounted there).'''
+        found = None
+        for mount in self.mounts:
+            if mount['path'] == path:
+                found = mount
+        return found
 
-class LVMUnmounter(BaseObject):
-    ''' Unmount all LVM Logical Volumes and Volume Groups.
+# ------------------------------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
+
+def run_concurrently(fn, items):
+    '''Call `fn` on each item in its own thread, returning the results.'''
+    results = [None] * len(items)
+    def run(idx):
+        results[idx] = fn(items[idx])
+    threads = [threading.Thread(target=run, args=(idx,))
+               for idx in range(len(items))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def split_lvm_name(dm_name):
+    '''Split the device-mapper name of a Logical Volume into the Volume Group
+    and Logical Volume names (dashes inside names are doubled).
     '''
-    def __init__(self, module):
-        super(LVMUnmounter, self).__init__(module)
+    parts = re.split(r'(?<!-)-(?!-)', dm_name, maxsplit=1)
+    if len(parts) != 2:
+        return None, None
+    return tuple(part.replace('--', '-') for part in parts)
 
-    def run(self):
-        self.run_command('vgchange -a n')
-        return [{'type': 'lvm'}]
+# ------------------------------------------------------------------------------
+# UNMOUNT POLICIES -------------------------------------------------------------
+
+class BasicUnmounter(BaseObject):
+    ''' Unmount all the mount points below a root directory.
 
-class EncryptionUnmounter(BaseObject):
-    ''' Unmount all Luks volumes.
+    The mount tree is read once from `/proc/self/mountinfo` and unmounted
+    bottom-up, in waves: a mount is unmounted after all the mounts on top of
+    it (children, including stacked and bind mounts), and the mounts in the
+    same wave (i.e. independent subtrees) are unmounted concurrently.
+
+    Mounts in use (by an open file, the working or root directory of a
+    process) are detected upfront: they are skipped, with their ancestors.
     '''
     def __init__(self, module):
-        super(EncryptionUnmounter, self).__init__(module)
-
-    def run(self):
-        result = []
+        super(BasicUnmounter, self).__init__(module, params=['basic'])
 
-        lines = self.run_command('dmsetup info -c -o name')['out_lines']
-        if len(lines) > 1: # There is at least one device.
-            enc_names = map(str.strip, lines[1:])
-            for enc_name in enc_names:
-                self.run_command('cryptsetup luksClose {}'.format(enc_name))
-                result.append({'type': 'encryption', 'name': enc_name})
+    def plan(self, mount_info):
+        '''Return the waves of mounts to be unmounted and the skipped ones.'''
+        selected = mount_info.under(self.basic)
+        mounts = dict((mount['id'], mount) for mount in selected)
+
+        # Height of each mount in the tree: leaves go first.
+        children = dict((mount_id, []) for mount_id in mounts)
+        for mount in mounts.values():
+            if mount['parent'] in children:
+                children[mount['parent']].append(mount['id'])
+        heights = {}
+        def height(mount_id):
+            if not mount_id in heights:
+                heights[mount_id] = 1 + max([height(child)
+                                             for child in children[mount_id]]
+                                            or [-1])
+            return heights[mount_id]
+
+        skipped = {}
+        for mount_id, pids in self.busy_mounts(selected).items():
+            reason = 'busy'
+            while mount_id in mounts and not mount_id in skipped:
+                skipped[mount_id] = {'type': 'mount point',
+                                     'path': mounts[mount_id]['path'],
+                                     'reason': reason,
+                                     'pids': pids}
+                mount_id = mounts[mount_id]['parent']
+                reason, pids = 'busy submount', []
+
+        waves = {}
+        for mount_id in mounts:
+            if not mount_id in skipped:
+                waves.setdefault(height(mount_id), []).append(mounts[mount_id])
+        return ([waves[idx] for idx in sorted(waves)],
+                sorted(skipped.values(), key=lambda item: item['path']))
+
+    def busy_mounts(self, mounts):
+        '''Scan open files, working and root directories of all processes,
+        and map each mount to the processes using it.
+        '''
+        # The mount visible at each path is the last one mounted there.
+        visible = dict((mount['path'], mount['id']) for mount in mounts)
+
+        busy = {}
+        for pid in [pid for pid in os.listdir('/proc') if pid.isdigit()]:
+            links = [os.path.join('/proc', pid, name)
+                     for name in ['cwd', 'root', 'exe']]
+            fd_dir = os.path.join('/proc', pid, 'fd')
+            try:
+                links += [os.path.join(fd_dir, fd) for fd in os.listdir(fd_dir)]
+            except OSError: # The process is gone (or isn't accessible).
+                continue
+            for link in links:
+                try:
+                    path = os.readlink(link)
+                except OSError:
+                    continue
+                if not path.startswith('/'): # Sockets, pipes, ..
+                    continue
+                if path.endswith(' (deleted)'):
+                    path = path[:-len(' (deleted)')]
+                mount_id = self._containing_mount(path, visible)
+                if mount_id is not None:
+                    pids = busy.setdefault(mount_id, [])
+                    if not int(pid) in pids:
+                        pids.append(int(pid))
+        return busy
+
+    def run(self, mount_info):
+        unmounted = []
+        waves, skipped = self.plan(mount_info)
+
+        failed = set()
+
+        for wave in waves:
+            # Ancestors of failed mounts can't be unmounted either.
+            blocked = [mount for mount in wave
+                       if mount['id'] in failed]
+            wave = [mount for mount in wave if not mount in blocked]
+            umount = lambda mount: self.run_command('umount {}'.format(
+                quote(mount['path'])), check_rc=False)['rc']
+            results = run_concurrently(umount, wave)
+
+            errors = [mount['id'] for mount, rc in zip(wave, results) if rc]
+            if errors:
+                # Unmounting a shared mount also unmounts its peers: those
+                # are already gone.
+                mounted = MountInfo().by_id
+                errors = [mount_id for mount_id in errors
+                          if mount_id in mounted]
+            for mount in wave + blocked:
+                if mount['id'] in errors or mount in blocked:
+                    skipped.append({'type': 'mount point',
+                                    'path': mount['path'],
+                                    'reason': ('umount failed'
+                                               if mount['id'] in errors
+                                               else 'busy submount'),
+                                    'pids': []})
+                    failed.add(mount['parent'])
+                else:
+                    unmounted.append({'type': 'mount point',
+                                      'path': mount['path']})
+
+        return unmounted, skipped
+
+    def _containing_mount(self, path, visible):
+        while True:
+            if path in visible:
+                return visible[path]
+            if path == '/':
+                return None
+            path = os.path.dirname(path)
+
+class StackedDeviceUnmounter(BaseObject):
+    ''' Tear down the stacked devices (LVM Logical Volumes and Volume Groups,
+    LUKS mappings, RAID arrays) backing the mounts below `basic` or stacked on
+    `disks`.
+
+    The dependency graph is read from sysfs (`/sys/block/dm-*/dm/{name,uuid}`,
+    `/sys/block/md*/md` and `/sys/block/*/holders`): a device is removed after
+    all its holders,
+    independent chains are torn down concurrently and unrelated devices are
+    left alone. Devices that can't be removed (kind not enabled, or held by
+    devices outside the scope) are skipped, together with their slaves.
+    '''
+    KINDS = {'LVM-': 'lvm', 'CRYPT-': 'encryption'}
 
-        return result
+    def __init__(self, module):
+        super(StackedDeviceUnmounter, self).__init__(module,
+            params=['basic', 'lvm', 'encryption', 'raid', 'disks'])
+
+    @staticmethod
+    def is_stacked(device):
+        '''Tell if `device` is a mapped device or a RAID array.'''
+        return device.dm_uuid is not None or device.read('md/level') is not None
+
+    def scope(self, mount_info):
+        '''Names (e.g. `dm-0`, `md127`) of the devices to be torn down.'''
+        # Devices backing the mounts: walk down through their slaves.
+        pending = []
+        if self.basic:
+            for mount in mount_info.under(self.basic):
+                sysfs_dir = os.path.join('/sys/dev/block', mount['device'])
+                if os.path.isdir(sysfs_dir):
+                    pending.append(os.path.basename(os.path.realpath(sysfs_dir)))
+        scope = set()
+        while pending:
+            device = BlockDevice(os.path.join('/dev', pending.pop()))
+            if self.is_stacked(device) and not device.name in scope:
+                scope.add(device.name)
+                pending += [slave.name for slave in device.slaves]
+
+        # Devices stacked on the disks.
+        disks = set(BlockDevice(disk).name for disk in self.disks or [])
+        if disks:
+            for name in os.listdir(BlockDevice.SYSFS_DIR):
+                device = BlockDevice(os.path.join('/dev', name))
+                if self.is_stacked(device) and self._disks(device) & disks:
+                    scope.add(device.name)
+        return scope
+
+    def plan(self, scope):
+        '''Return the waves of devices to be removed and the skipped ones.'''
+        devices = {}
+        for name in scope:
+            device = BlockDevice(os.path.join('/dev', name))
+            kind = None
+            if device.dm_uuid is None:
+                kind = 'raid'
+            for prefix, prefix_kind in self.KINDS.items():
+                if (device.dm_uuid or '').startswith(prefix):
+                    kind = prefix_kind
+            devices[name] = {'name': device.dm_name or device.name,
+                             'uuid': device.dm_uuid,
+                             'kind': kind,
+                             'holders': [holder.name
+                                         for holder in device.holders]}
+
+        # A device is skipped if it can't be handled or if any holder stays.
+        skipped = {}
+        def skip(name, reason):
+            if not name in skipped:
+                skipped[name] = {'type': devices[name]['kind'] or 'dm',
+                                 'name': devices[name]['name'],
+                                 'reason': reason}
+        for name, device in devices.items():
+            if device['kind'] is None:
+                skip(name, 'unsupported device-mapper target')
+            elif not getattr(self, device['kind']):
+                skip(name, '{} teardown not enabled'.format(device['kind']))
+            else:
+                unrelated = [holder for holder in device['holders']
+                             if not holder in devices]
+                if unrelated:
+                    skip(name, 'held by {}'.format(', '.join(unrelated)))
+        changed = True
+        while changed:
+            changed = False
+            for name, device in devices.items():
+                held = [holder for holder in device['holders']
+                        if holder in skipped]
+                if not name in skipped and held:
+                    skip(name, 'held by {}'.format(', '.join(
+                        devices[holder]['name'] for holder in held)))
+                    changed = True
+
+        # Height of each device in the dependency graph: top-most go first.
+        heights = {}
+        def height(name):
+            if not name in heights:
+                heights[name] = 1 + max([height(holder)
+                                         for holder in devices[name]['holders']]
+                                        or [-1])
+            return heights[name]
+
+        waves = {}
+        for name, device in devices.items():
+            if not name in skipped:
+                waves.setdefault(height(name), []).append(dict(device,
+                                                              dm=name))
+        return ([sorted(waves[idx], key=lambda device: device['name'])
+                 for idx in sorted(waves)],
+                sorted(skipped.values(), key=lambda item: item['name']))
+
+    def run(self, mount_info):
+        unmounted = []
+        waves, skipped = self.plan(self.scope(mount_info))
+        volume_groups = set()
+
+        failed = set()
+
+        for wave in waves:
+            # Slaves of failed devices can't be removed either.
+            blocked = [device for device in wave
+                       if set(device['holders']) & failed]
+            wave = [device for device in wave if not device in blocked]
+            results = run_concurrently(self._remove, wave)
+            for device, result in zip(wave, results):
+                if result is None:
+                    unmounted.append({'type': device['kind'],
+                                      'name': device['name']})
+                else:
+                    skipped.append({'type': device['kind'],
+                                    'name': device['name'],
+                                    'reason': result})
+                    failed.add(device['dm'])
+                if device['kind'] == 'lvm':
+                    volume_groups.add((split_lvm_name(device['name'])[0],
+                                       device['uuid'][4:36]))
+            for device in blocked:
+                skipped.append({'type': device['kind'],
+                                'name': device['name'],
+                                'reason': 'held by a device not removed'})
+                failed.add(device['dm'])
+
+            # Deactivate the Volume Groups left without active volumes.
+            active = set(BlockDevice(os.path.join('/dev', name)).dm_uuid
+                         for name in os.listdir(BlockDevice.SYSFS_DIR))
+            for vg_name, vg_uuid in sorted(volume_groups):
+                if not any(uuid and uuid.startswith('LVM-' + vg_uuid)
+                           for uuid in active):
+                    self.run_command('vgchange -a n {}'.format(vg_name),
+                                     check_rc=False)
+                    unmounted.append({'type': 'lvm-vg', 'name': vg_name})
+                    volume_groups.discard((vg_name, vg_uuid))
+
+        return unmounted, skipped
+
+    def _remove(self, device):
+        '''Remove a stacked device, returning the error (if any).'''
+        current = BlockDevice(os.path.join('/dev', device['dm']))
+        if device['kind'] == 'raid':
+            if current.read('md/level') is None: # Already stopped.
+                return None
+            command = 'mdadm --stop /dev/{}'.format(device['dm'])
+        elif current.dm_uuid != device['uuid']:
+            # Already removed together with its holder (e.g. cache sub-volumes).
+            return None
+        elif device['kind'] == 'lvm':
+            vg_name, lv_name = split_lvm_name(device['name'])
+            command = 'lvchange -a n {}/{}'.format(vg_name, lv_name)
+        else:
+            command = 'cryptsetup close {}'.format(device['name'])
+        out = self.run_command(command, check_rc=False)
+        if out['rc'] != 0:
+            return (out['err'] or out['out']).strip() or 'removal failed'
+        return None
+
+    def _disks(self, device):
+        '''Names of the disks at the bottom of the device stack.'''
+        slaves = device.disk.slaves
+        if not slaves:
+            return set([device.disk.name])
+        return set.union(*[self._disks(slave) for slave in slaves])
 
 # ------------------------------------------------------------------------------
 # MAIN FUNCTION ----------------------------------------------------------------
@@ -179,26 +647,31 @@ def main():
             'basic':      dict(type='str',  default=None),
             'encryption': dict(type='bool', default=False),
             'lvm':        dict(type='bool', default=False),
+            'raid':       dict(type='bool', default=False),
+            'disks':      dict(type='list', default=[]),
         })
 
     unmounted = [] # Informations about unmounted volumes.
+    skipped = []   # Informations about volumes that can't be unmounted.
 
-    if module.params['basic']:
-        unmounted += BasicUnmounter(module).run()
+    # The mount table before unmounting: it defines which mapped devices
+    # are in use by the mounts below `basic`.
+    mount_info = MountInfo()
 
-    if module.params['lvm']:
-        unmounted += LVMUnmounter(module).run()
-        # Maybe some basic partitions can be unmounted now.
-        if module.params['basic']:
-            unmounted += BasicUnmounter(module).run()
-
-    if module.params['encryption']:
-        unmounted += EncryptionUnmounter(module).run()
-        # Maybe some basic partitions can be unmounted now.
-        if module.params['basic']:
-            unmounted += BasicUnmounter(module).run()
-
-    module.exit_json(changed=True, msg='Unmount success', unmounted=unmounted)
+    if module.params['basic']:
+        basic_unmounted, basic_skipped = BasicUnmounter(module).run(mount_info)
+        unmounted += basic_unmounted
+        skipped += basic_skipped
+
+    if (module.params['lvm'] or module.params['encryption'] or
+        module.params['raid']):
+        stacked_unmounted, stacked_skipped = StackedDeviceUnmounter(
+            module).run(mount_info)
+        unmounted += stacked_unmounted
+        skipped += stacked_skipped
+
+    module.exit_json(changed=len(unmounted) > 0, msg='Unmount success',
+                     unmounted=unmounted, skipped=skipped)
 
 # ------------------------------------------------------------------------------
 # ENTRY POINT ------------------------------------------------------------------
@@ -0,0 +1,348 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import os
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+# MODULE INFORMATIONS ----------------------------------------------------------
+
+DOCUMENTATION = '''
+---
+module: wipe_disk
+short_description: Wipe disks before partitioning them
+author:
+    - "Alessandro Molari"
+'''
+
+EXAMPLES = '''
+# Remove every signature and discard the whole content of the disks.
+# Disks are wiped concurrently.
+- name: Wipe disks
+  wipe_disk:
+    disks:
+      - /dev/sda
+      - /dev/nvme0n1
+
+# Only remove signatures and partition tables.
+- name: Wipe disks
+  wipe_disk:
+    disks:   /dev/sda
+    discard: false
+'''
+
+# ------------------------------------------------------------------------------
+# COMMONS (copy&paste) ---------------------------------------------------------
+
+class BaseObject(object):
+    import syslog, os
+
+    '''Base class for all classes that use AnsibleModule.
+    Dependencies:
+    - `chrooted` function.
+    '''
+    def __init__(self, module, params=None):
+        syslog.openlog('ansible-{module}-{name}'.format(
+            module=os.path.basename(__file__), name=self.__class__.__name__))
+        self.work_dir = None
+        self.chroot = None
+        self._module = module
+        self._command_prefix = None
+        if params:
+            self._parse_params(params)
+
+    @property
+    def command_prefix(self):
+        return self._command_prefix
+
+    @command_prefix.setter
+    def command_prefix(self, value):
+        self._command_prefix = value
+
+    def run_command(self, command=None, **kwargs):
+        if not 'check_rc' in kwargs:
+            kwargs['check_rc'] = True
+        if command is None and self.command_prefix is None:
+            self.fail('Invalid command')
+        if self.command_prefix:
+            command = '{prefix} {command}'.format(
+                prefix=self.command_prefix, command=command or '')
+        if self.work_dir and not self.chroot:
+            command = 'cd {work_dir}; {command}'.format(
+                work_dir=self.work_dir, command=command)
+        if self.chroot:
+            command = chrooted(command, self.chroot, work_dir=self.work_dir)
+        self.log('Performing command `{}`'.format(command))
+        rc, out, err = self._module.run_command(command, **kwargs)
+        if rc != 0:
+            self.log('Command `{}` returned invalid status code: `{}`'.format(
+                command, rc), level=syslog.LOG_WARNING)
+        return {'rc': rc,
+                'out': out,
+                'out_lines': [line for line in out.split('\n') if line],
+                'err': err,
+                'err_lines': [line for line in out.split('\n') if line]}
+
+    def log(self, msg, level=syslog.LOG_DEBUG):
+        '''Log to the system logging facility of the target system.'''
+        if os.name == 'posix': # syslog is unsupported on Windows.
+            syslog.syslog(level, str(msg))
+
+    def fail(self, msg):
+        self._module.fail_json(msg=msg)
+
+    def exit(self, changed=True, msg='', result=None):
+        self._module.exit_json(changed=changed, msg=msg, result=result)
+
+    def _parse_params(self, params):
+        for param in params:
+            if param in self._module.params:
+                value = self._module.params[param]
+                t = self._module.argument_spec[param].get('type')
+                if t == 'str' and value in ['None', 'none']:
+                    value = None
+                setattr(self, param, value)
+            else:
+                setattr(self, param, None)
+
+def chrooted(command, path, profile='/etc/profile', work_dir=None):
+    prefix = "chroot {path} bash -c 'source {profile}; ".format(
+        path=path, profile=profile)
+    if work_dir:
+        prefix += 'cd {work_dir}; '.format(work_dir=work_dir)
+    prefix += command
+    prefix += "'"
+    return prefix
+
+class BlockDevice(object):
+    '''Topology of a block device, as exposed by sysfs.
+    Partitions don't have a request queue: queue attributes are read from the
+    disk holding them.
+    '''
+    SYSFS_DIR = '/sys/class/block'
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(os.path.realpath(path))
+        self.sysfs_dir = os.path.realpath(os.path.join(self.SYSFS_DIR,
+                                                       self.name))
+
+    @property
+    def exists(self):
+        return os.path.isdir(self.sysfs_dir)
+
+    @property
+    def is_partition(self):
+        return os.path.isfile(os.path.join(self.sysfs_dir, 'partition'))
+
+    @property
+    def disk(self):
+        '''The whole disk (itself, unless it's a partition).'''
+        if self.is_partition:
+            return BlockDevice(os.path.join(
+                '/dev', os.path.basename(os.path.dirname(self.sysfs_dir))))
+        return self
+
+    def read(self, attr, default=None):
+        try:
+            with open(os.path.join(self.sysfs_dir, attr)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return default
+
+    def read_int(self, attr, default=0):
+        try:
+            return int(self.read(attr))
+        except (TypeError, ValueError):
+            return default
+
+    def queue(self, attr, default=0):
+        return self.disk.read_int(os.path.join('queue', attr), default)
+
+    @property
+    def size(self):
+        '''Size in bytes (sysfs always counts 512-byte sectors).'''
+        return self.read_int('size') * 512
+
+    @property
+    def logical_block_size(self):
+        return self.queue('logical_block_size', 512)
+
+    @property
+    def physical_block_size(self):
+        return self.queue('physical_block_size', 512)
+
+    @property
+    def minimum_io_size(self):
+        return self.queue('minimum_io_size', 0)
+
+    @property
+    def optimal_io_size(self):
+        return self.queue('optimal_io_size', 0)
+
+    @property
+    def rotational(self):
+        return self.queue('rotational', 1) == 1
+
+    @property
+    def discard(self):
+        return self.queue('discard_max_bytes', 0) > 0
+
+    @property
+    def is_nvme(self):
+        if self.disk.name.startswith('nvme'):
+            return True
+        # Stacked devices (dm, md) are NVMe-backed if all their slaves are.
+        slaves = self.disk.slaves
+        return len(slaves) > 0 and all(slave.is_nvme for slave in slaves)
+
+    @property
+    def partitions(self):
+        try:
+            names = sorted(os.listdir(self.sysfs_dir))
+        except OSError:
+            names = []
+        return [BlockDevice(os.path.join('/dev', name)) for name in names
+                if os.path.isfile(os.path.join(self.sysfs_dir, name,
+                                               'partition'))]
+
+    @property
+    def slaves(self):
+        return self._related('slaves')
+
+    @property
+    def holders(self):
+        return self._related('holders')
+
+    @property
+    def dm_name(self):
+        return self.read('dm/name')
+
+    @property
+    def dm_uuid(self):
+        return self.read('dm/uuid')
+
+    def _related(self, kind):
+        try:
+            names = sorted(os.listdir(os.path.join(self.sysfs_dir, kind)))
+        except OSError:
+            names = []
+        return [BlockDevice(os.path.join('/dev', name)) for name in names]
+
+    def to_dict(self):
+        return {'name':                self.name,
+                'size':                self.size,
+                'logical_block_size':  self.logical_block_size,
+                'physical_block_size': self.physical_block_size,
+                'minimum_io_size':     self.minimum_io_size,
+                'optimal_io_size':     self.optimal_io_size,
+                'rotational':          self.rotational,
+                'discard':             self.discard,
+                'nvme':                self.is_nvme}
+
+# ------------------------------------------------------------------------------
+# WIPER ------------------------------------------------------------------------
+
+class WipeError(Exception):
+    pass
+
+class DiskWiper(BaseObject):
+    '''Wipe a disk.
+    Filesystem, RAID and LVM signatures are always removed (first from the
+    partitions, then from the disk itself, taking the partition table away),
+    so that nothing stale is detected on the new partitions.
+    Then, if the disk supports it, its whole content is discarded: the device
+    starts over with no mapped blocks, as if it was new.
+    '''
+    def __init__(self, module, disk):
+        super(DiskWiper, self).__init__(module, params=['discard'])
+        self.disk = disk
+        self.device = BlockDevice(disk)
+
+    def fail(self, msg):
+        # Disks are wiped in worker threads: only the main thread can exit.
+        raise WipeError(msg)
+
+    def run(self):
+        result = {'disk': self.disk,
+                  'method': 'signatures',
+                  'bytes_discarded': 0,
+                  'error': None}
+        start = time.time()
+
+        for device in self.device.partitions + [self.device]:
+            out = self.run_command('wipefs --all --force {}'.format(
+                device.path), check_rc=False)
+            if out['rc'] != 0:
+                result['error'] = out['err'] or out['out']
+                break
+
+        if not result['error'] and self.discard and self.device.discard:
+            out = self.run_command('blkdiscard {}'.format(self.disk),
+                                   check_rc=False)
+            if out['rc'] == 0:
+                result['method'] = 'discard'
+                result['bytes_discarded'] = self.device.size
+            else: # Signatures are already gone: that's enough.
+                self.log('Cannot discard `{}`: {}'.format(self.disk, out['err']))
+
+        result['seconds'] = round(time.time() - start, 3)
+        return result
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    module = AnsibleModule(argument_spec={
+        'disks':   {'type': 'list', 'required': True},
+        'discard': {'type': 'bool', 'required': False, 'default': True},
+        })
+
+    wipers = [DiskWiper(module, disk) for disk in module.params['disks']]
+    missing = [wiper.disk for wiper in wipers if not wiper.device.exists]
+    if missing:
+        module.fail_json(msg='Unknown disks: {}'.format(', '.join(missing)))
+
+    start = time.time()
+    results = [None] * len(wipers)
+
+    def wipe(idx):
+        try:
+            results[idx] = wipers[idx].run()
+        except Exception as err:
+            results[idx] = {'disk':            wipers[idx].disk,
+                            'method':          None,
+                            'bytes_discarded': 0,
+                            'error':           str(err)}
+
+    threads = [threading.Thread(target=wipe, args=(idx,))
+               for idx in range(len(wipers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    failed = [result for result in results if result['error']]
+    if failed:
+        module.fail_json(msg='Cannot wipe disks', result=results)
+
+    module.exit_json(changed=True, msg='Disks successfully wiped',
+                     result=results,
+                     seconds=round(time.time() - start, 3),
+                     bytes_discarded=sum(result['bytes_discarded']
+                                         for result in results))
+
+# ------------------------------------------------------------------------------
+# ENTRY POINT ------------------------------------------------------------------
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :
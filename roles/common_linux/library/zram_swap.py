@@ -0,0 +1,437 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# IMPORTS ----------------------------------------------------------------------
+
+import os
+import re
+import tempfile
+
+# ------------------------------------------------------------------------------
+# MODULE INFORMATIONS ----------------------------------------------------------
+
+DOCUMENTATION = '''
+---
+module: zram_swap
+short_description: Configure compressed swap in RAM (zram)
+author:
+    - "Alessandro Molari"
+'''
+
+EXAMPLES = '''
+# Persist one zram swap device (half of the RAM, at most 8GiB, compressed with
+# zstd) into the system installed in `/mnt/gentoo` using `zram-generator`,
+# and also enable it right now.
+- name: Configure compressed swap
+  zram_swap:
+    devices:
+      - name:      zram
+        algorithm: zstd
+        fraction:  0.5
+        max_size:  8192
+        priority:  100
+    root_dir: /mnt/gentoo
+    activate: true
+
+# Without `zram-generator`: use an udev rule and a systemd swap unit.
+- name: Configure compressed swap
+  zram_swap:
+    devices:
+      - name: zram
+    backend: udev
+'''
+
+# ------------------------------------------------------------------------------
+# COMMONS (copy&paste) ---------------------------------------------------------
+
+class BaseObject(object):
+    import syslog, os
+
+    '''Base class for all classes that use AnsibleModule.
+    Dependencies:
+    - `chrooted` function.
+    '''
+    def __init__(self, module, params=None):
+        syslog.openlog('ansible-{module}-{name}'.format(
+            module=os.path.basename(__file__), name=self.__class__.__name__))
+        self.work_dir = None
+        self.chroot = None
+        self._module = module
+        self._command_prefix = None
+        if params:
+            self._parse_params(params)
+
+    @property
+    def command_prefix(self):
+        return self._command_prefix
+
+    @command_prefix.setter
+    def command_prefix(self, value):
+        self._command_prefix = value
+
+    def run_command(self, command=None, **kwargs):
+        if not 'check_rc' in kwargs:
+            kwargs['check_rc'] = True
+        if command is None and self.command_prefix is None:
+            self.fail('Invalid command')
+        if self.command_prefix:
+            command = '{prefix} {command}'.format(
+                prefix=self.command_prefix, command=command or '')
+        if self.work_dir and not self.chroot:
+            command = 'cd {work_dir}; {command}'.format(
+                work_dir=self.work_dir, command=command)
+        if self.chroot:
+            command = chrooted(command, self.chroot, work_dir=self.work_dir)
+        self.log('Performing command `{}`'.format(command))
+        rc, out, err = self._module.run_command(command, **kwargs)
+        if rc != 0:
+            self.log('Command `{}` returned invalid status code: `{}`'.format(
+                command, rc), level=syslog.LOG_WARNING)
+        return {'rc': rc,
+                'out': out,
+                'out_lines': [line for line in out.split('\n') if line],
+                'err': err,
+                'err_lines': [line for line in out.split('\n') if line]}
+
+    def log(self, msg, level=syslog.LOG_DEBUG):
+        '''Log to the system logging facility of the target system.'''
+        if os.name == 'posix': # syslog is unsupported on Windows.
+            syslog.syslog(level, str(msg))
+
+    def fail(self, msg):
+        self._module.fail_json(msg=msg)
+
+    def exit(self, changed=True, msg='', result=None):
+        self._module.exit_json(changed=changed, msg=msg, result=result)
+
+    def _parse_params(self, params):
+        for param in params:
+            if param in self._module.params:
+                value = self._module.params[param]
+                t = self._module.argument_spec[param].get('type')
+                if t == 'str' and value in ['None', 'none']:
+                    value = None
+                setattr(self, param, value)
+            else:
+                setattr(self, param, None)
+
+def chrooted(command, path, profile='/etc/profile', work_dir=None):
+    prefix = "chroot {path} bash -c 'source {profile}; ".format(
+        path=path, profile=profile)
+    if work_dir:
+        prefix += 'cd {work_dir}; '.format(work_dir=work_dir)
+    prefix += command
+    prefix += "'"
+    return prefix
+
+def _replace_file(tmp_path, path):
+    '''Move the (already synced) `tmp_path` over `path`, keeping its mode.'''
+    if os.path.exists(path):
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    else:
+        os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+
+def atomic_write(path, content):
+    '''Replace the file at `path` with `content`, without leaving it truncated
+    or half-written if something goes wrong.
+    Nothing is written if the file already has that content.
+    Return `True` if the file has been written.
+    '''
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        _replace_file(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+class ConfigEditor(object):
+    '''Edit a line-based configuration file with many rules at once.
+    Each rule is `(regexp, replacement, append_if_missing, template)`: lines
+    matching `regexp` are replaced by `replacement` (`None` removes them),
+    taken literally unless `template` is set (then it's a `re` template). The
+    first matching rule wins. If no line matches a rule with
+    `append_if_missing`, its replacement is appended to the file.
+    The file is read and rewritten in a single streaming pass and replaced
+    atomically, only if its content changes (a missing file is created only
+    if there's something to write).
+    '''
+    def __init__(self, path, rules=None):
+        self.path = path
+        self.rules = []
+        for rule in rules or []:
+            self.rule(*rule)
+
+    def rule(self, regexp, replacement, append_if_missing=False,
+             template=False):
+        self.rules.append((re.compile(regexp), replacement, append_if_missing,
+                           template))
+        return self
+
+    @staticmethod
+    def terminated(line):
+        '''`line` ending with a newline (e.g. the last line of a file).'''
+        if line is None or line.endswith('\n'):
+            return line
+        return line + '\n'
+
+    def edit(self, lines):
+        '''Yield `(old line, new line)` pairs (`None` for missing lines).
+        New lines always end with a newline.
+        '''
+        matched = [False] * len(self.rules)
+        for line in lines:
+            new_line = self.terminated(line)
+            for idx, (regexp, replacement, _, template) in \
+                    enumerate(self.rules):
+                md = regexp.match(line.rstrip('\n'))
+                if md:
+                    matched[idx] = True
+                    if replacement is None:
+                        new_line = None
+                    elif template:
+                        new_line = md.expand(replacement) + '\n'
+                    else:
+                        new_line = replacement + '\n'
+                    break
+            yield line, new_line
+        for idx, (_, replacement, append_if_missing, _) in \
+                enumerate(self.rules):
+            if append_if_missing and not matched[idx] and replacement:
+                yield None, replacement + '\n'
+
+    def apply(self):
+        '''Apply the rules. Return `True` if the file has been changed.'''
+        try:
+            src = open(self.path)
+        except (IOError, OSError):
+            src = None
+        changed = False
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            prefix='.{}.'.format(os.path.basename(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as dst:
+                for old_line, new_line in self.edit(src or []):
+                    # A missing final newline alone isn't a change.
+                    if new_line != self.terminated(old_line):
+                        changed = True
+                    if new_line is not None:
+                        dst.write(new_line)
+                if changed:
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            if changed:
+                _replace_file(tmp_path, self.path)
+            else:
+                os.remove(tmp_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            if src is not None:
+                src.close()
+        return changed
+
+# ------------------------------------------------------------------------------
+# GLOBALS ----------------------------------------------------------------------
+
+HEADER = '# Generated by Ansible: manual changes will be overwritten.\n'
+
+GENERATOR_CONF = 'etc/systemd/zram-generator.conf'
+UDEV_RULES = 'etc/udev/rules.d/99-zram.rules'
+MODULES_LOAD_CONF = 'etc/modules-load.d/zram.conf'
+MODPROBE_CONF = 'etc/modprobe.d/zram.conf'
+SYSTEMD_UNITS_DIR = 'etc/systemd/system'
+
+# ------------------------------------------------------------------------------
+# UTILITIES --------------------------------------------------------------------
+
+def mem_total():
+    '''Total RAM in bytes.'''
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def active_swaps():
+    with open('/proc/swaps') as f:
+        return [line.split()[0] for line in f.readlines()[1:] if line.strip()]
+
+# ------------------------------------------------------------------------------
+# LOGIC ------------------------------------------------------------------------
+
+class ZramSwap(BaseObject):
+    '''Compressed swap devices in RAM.
+    The configuration is persisted into the system at `root_dir`; `activate`
+    also sets the devices up on the running system.
+    '''
+    def __init__(self, module):
+        super(ZramSwap, self).__init__(module, params=[
+            'devices', 'root_dir', 'backend', 'activate'])
+        self.ram = mem_total()
+        self.changed = False
+        self.devices = [self._device(idx, device)
+                        for idx, device in enumerate(self.devices)]
+
+    def _device(self, idx, device):
+        fraction = float(device.get('fraction', 0.5))
+        if fraction <= 0:
+            self.fail('Invalid zram fraction: `{}`'.format(fraction))
+        max_size = device.get('max_size')
+        size = int(self.ram * fraction)
+        if max_size:
+            size = min(size, int(max_size) * 1024 * 1024)
+        return {'name':      device.get('name'),
+                'device':    'zram{}'.format(idx),
+                'algorithm': device.get('algorithm', 'zstd'),
+                'fraction':  fraction,
+                'max_size':  int(max_size) if max_size else None,
+                'size':      size,
+                'priority':  int(device.get('priority', 100))}
+
+    def path(self, relative_path):
+        return os.path.join(self.root_dir or '/', relative_path)
+
+    def write(self, relative_path, content):
+        path = self.path(relative_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if atomic_write(path, content):
+            self.changed = True
+
+    def link(self, target, relative_path):
+        path = self.path(relative_path)
+        if os.path.islink(path) and os.readlink(path) == target:
+            return
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(target, path)
+        self.changed = True
+
+    def persist_generator(self):
+        '''Let `zram-generator` set the devices up at boot.'''
+        content = HEADER
+        for device in self.devices:
+            size = 'ram * {}'.format(device['fraction'])
+            if device['max_size']:
+                size = 'min({}, {})'.format(size, device['max_size'])
+            content += '\n'.join([
+                '',
+                '[{}]'.format(device['device']),
+                'zram-size = {}'.format(size),
+                'compression-algorithm = {}'.format(device['algorithm']),
+                'swap-priority = {}'.format(device['priority']),
+                ''])
+        self.write(GENERATOR_CONF, content)
+
+    def persist_udev(self):
+        '''Set the devices up at boot with an udev rule (sizes are computed
+        now) and enable them with systemd swap units.
+        '''
+        self.write(MODULES_LOAD_CONF, HEADER + 'zram\n')
+        self.write(MODPROBE_CONF, '{}options zram num_devices={}\n'.format(
+            HEADER, len(self.devices)))
+        rules = HEADER
+        for device in self.devices:
+            rules += ('KERNEL=="{device}", ACTION=="add", '
+                      'ATTR{{comp_algorithm}}="{algorithm}", '
+                      'ATTR{{disksize}}="{size}", '
+                      'RUN+="/sbin/mkswap /dev/{device}", '
+                      'TAG+="systemd"\n').format(**device)
+            unit = 'dev-{}.swap'.format(device['device'])
+            self.write(os.path.join(SYSTEMD_UNITS_DIR, unit), '\n'.join([
+                HEADER.rstrip('\n'),
+                '[Unit]',
+                'Description=Compressed swap on /dev/{}'.format(
+                    device['device']),
+                '',
+                '[Swap]',
+                'What=/dev/{}'.format(device['device']),
+                'Priority={}'.format(device['priority']),
+                '',
+                '[Install]',
+                'WantedBy=swap.target',
+                '']))
+            wants_dir = os.path.join(SYSTEMD_UNITS_DIR, 'swap.target.wants')
+            self.link(os.path.join('/', SYSTEMD_UNITS_DIR, unit),
+                      os.path.join(wants_dir, unit))
+        self.write(UDEV_RULES, rules)
+
+    def activate_devices(self):
+        '''Set the devices up on the running system.'''
+        swaps = active_swaps()
+        pending = [device for device in self.devices
+                   if not '/dev/{}'.format(device['device']) in swaps]
+        if not pending:
+            return
+        self.run_command('modprobe zram num_devices={}'.format(
+            len(self.devices)))
+        for device in pending:
+            sysfs_dir = os.path.join('/sys/block', device['device'])
+            if not os.path.isdir(sysfs_dir):
+                self.fail('Missing zram device `{}` (zram already loaded '
+                          'with less devices?)'.format(device['device']))
+            self.run_command('zramctl --algorithm {algorithm} --size {size} '
+                             '/dev/{device}'.format(**device))
+            self.run_command('mkswap /dev/{}'.format(device['device']))
+            self.run_command(
+                'swapon --priority {priority} /dev/{device}'.format(**device))
+            self.changed = True
+
+    def run(self):
+        if self.backend == 'generator':
+            self.persist_generator()
+        else:
+            self.persist_udev()
+        if self.activate:
+            self.activate_devices()
+        return self.devices
+
+# ------------------------------------------------------------------------------
+# MAIN FUNCTION ----------------------------------------------------------------
+
+def main():
+    module = AnsibleModule(argument_spec={
+        'devices':  {'type': 'list', 'required': True},
+        'root_dir': {'type': 'str', 'required': False, 'default': '/'},
+        'backend':  {'choices': ['generator', 'udev'], 'required': False,
+                     'default': 'generator'},
+        'activate': {'type': 'bool', 'required': False, 'default': False},
+        })
+
+    zram_swap = ZramSwap(module)
+    result = zram_swap.run()
+    module.exit_json(changed=zram_swap.changed,
+                     msg='Compressed swap configured', result=result)
+
+# ------------------------------------------------------------------------------
+# ENTRY POINT ------------------------------------------------------------------
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
+# vim: set filetype=python :